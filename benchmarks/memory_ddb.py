@@ -0,0 +1,226 @@
+import copy, math, re, zlib
+from decimal import Decimal
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+class ResourceNotFoundException(Exception):
+    pass
+
+class InMemoryDynamoDB:
+    """
+    A stand-in for a boto3 DynamoDB resource that keeps every table in memory. It only supports the small part of the
+    API that `DDBCache` uses.
+    """
+    # Table name: partition key
+    KEY_ATTRIBUTES = {
+        'GlobalPlaylist-Playlists': 'country_id',
+        'GlobalPlaylist-Tokens': 'id',
+        'GlobalPlaylist-Config': 'key',
+        'GlobalPlaylist-SongHistoryTable': 'id',
+        'GlobalPlaylist-PlaylistTracks': 'id',
+        'GlobalPlaylist-ArtistHistory': 'id',
+        'GlobalPlaylist-SelectionQueue': 'id',
+    }
+    BATCH_GET_MAX_KEYS = 100
+    BATCH_WRITE_MAX_ITEMS = 25
+
+    def __init__(self):
+        self.tables = {}
+        self.operation_counts = {}
+        self.meta = _Meta(self)
+
+    def Table(self, name):
+        if name not in self.tables:
+            self.tables[name] = InMemoryTable(self, name, self.KEY_ATTRIBUTES.get(name, 'id'))
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems, ReturnConsumedCapacity = None):
+        if sum(len(request['Keys']) for request in RequestItems.values()) > self.BATCH_GET_MAX_KEYS:
+            raise Exception(f"Too many keys requested. BatchGetItem allows at most {self.BATCH_GET_MAX_KEYS}.")
+
+        responses = {}
+        consumed_capacity = []
+        for table_name, request in RequestItems.items():
+            table = self.Table(table_name)
+            self.count_operation(table_name, 'batch_get_item')
+
+            items = [copy.deepcopy(table.items[key[table.key_attribute]]) for key in request['Keys'] if key[table.key_attribute] in table.items]
+            responses[table_name] = _project(items, request.get('ProjectionExpression'), request.get('ExpressionAttributeNames'))
+            consumed_capacity.append({'TableName': table_name, 'CapacityUnits': sum(_read_units(item) for item in items)})
+
+        return {'Responses': responses, 'UnprocessedKeys': {}, 'ConsumedCapacity': consumed_capacity}
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity = None):
+        if sum(len(requests) for requests in RequestItems.values()) > self.BATCH_WRITE_MAX_ITEMS:
+            raise Exception(f"Too many items written. BatchWriteItem allows at most {self.BATCH_WRITE_MAX_ITEMS}.")
+
+        consumed_capacity = []
+        for table_name, requests in RequestItems.items():
+            table = self.Table(table_name)
+            self.count_operation(table_name, 'batch_write_item')
+
+            units = 0
+            for request in requests:
+                if 'PutRequest' in request:
+                    item = request['PutRequest']['Item']
+                    table.items[item[table.key_attribute]] = _to_ddb_types(copy.deepcopy(item))
+                    units += math.ceil(_item_size(item) / 1024)
+                else:
+                    table.items.pop(request['DeleteRequest']['Key'][table.key_attribute], None)
+                    units += 1
+            consumed_capacity.append({'TableName': table_name, 'CapacityUnits': units})
+
+        return {'UnprocessedItems': {}, 'ConsumedCapacity': consumed_capacity}
+
+    def count_operation(self, table_name, operation):
+        key = f"{table_name}.{operation}"
+        self.operation_counts[key] = self.operation_counts.get(key, 0) + 1
+
+class InMemoryTable:
+    """
+    Responses report roughly the capacity that DDB would charge: half a read unit per 4KB read (a whole one for
+    consistent reads) and a write unit per 1KB written.
+    """
+    # Stands in for DDB's 1MB scan pages, so that pagination gets exercised
+    SCAN_PAGE_SIZE = 1000
+
+    def __init__(self, resource, name, key_attribute):
+        self.resource = resource
+        self.name = name
+        self.key_attribute = key_attribute
+        self.items = {}
+
+    def get_item(self, Key, ConsistentRead = False, **kwargs):
+        self.resource.count_operation(self.name, 'get_item')
+        item = self.items.get(Key[self.key_attribute])
+
+        response = {'ConsumedCapacity': self.__capacity(_read_units(item or {}) * (2 if ConsistentRead else 1))}
+        if item is not None:
+            response['Item'] = copy.deepcopy(item)
+        return response
+
+    def put_item(self, Item, ConditionExpression = None, ExpressionAttributeValues = None, **kwargs):
+        self.resource.count_operation(self.name, 'put_item')
+        key = Item[self.key_attribute]
+
+        if ConditionExpression and not _condition_holds(ConditionExpression, self.items.get(key), ExpressionAttributeValues or {}):
+            raise ConditionalCheckFailedException(f"Condition {ConditionExpression} failed for {key}")
+
+        self.items[key] = _to_ddb_types(copy.deepcopy(Item))
+        return {'ConsumedCapacity': self.__capacity(math.ceil(_item_size(Item) / 1024))}
+
+    def delete_item(self, Key, **kwargs):
+        self.resource.count_operation(self.name, 'delete_item')
+        self.items.pop(Key[self.key_attribute], None)
+        return {}
+
+    def scan(self, ProjectionExpression = None, ExpressionAttributeNames = None, ExclusiveStartKey = None, Segment = 0, TotalSegments = 1, **kwargs):
+        self.resource.count_operation(self.name, 'scan')
+        # Items are spread over segments by a hash of their key, like DDB does
+        keys = sorted(key for key in self.items.keys() if zlib.crc32(str(key).encode('utf-8')) % TotalSegments == Segment)
+
+        start = 0
+        if ExclusiveStartKey:
+            start = keys.index(ExclusiveStartKey[self.key_attribute]) + 1
+
+        page_keys = keys[start:start + self.SCAN_PAGE_SIZE]
+        items = [copy.deepcopy(self.items[key]) for key in page_keys]
+        # Scans are charged for the whole items that are read, not just the projected attributes
+        read_units = math.ceil(sum(_item_size(item) for item in items) / 4096) / 2
+
+        items = _project(items, ProjectionExpression, ExpressionAttributeNames)
+
+        response = {'Items': items, 'Count': len(items), 'ConsumedCapacity': self.__capacity(read_units)}
+        if start + self.SCAN_PAGE_SIZE < len(keys):
+            response['LastEvaluatedKey'] = {self.key_attribute: page_keys[-1]}
+        return response
+
+    def __capacity(self, units):
+        return {'TableName': self.name, 'CapacityUnits': units}
+
+class _Meta:
+    def __init__(self, resource):
+        self.client = _Client(resource)
+
+class _Client:
+    """
+    Like a DDB resource's own client, this takes and hands back the same plain values as the tables do
+    """
+    def __init__(self, resource):
+        self.resource = resource
+        self.exceptions = _Exceptions()
+
+    def get_item(self, TableName, **kwargs):
+        return self.resource.Table(TableName).get_item(**kwargs)
+
+    def put_item(self, TableName, **kwargs):
+        return self.resource.Table(TableName).put_item(**kwargs)
+
+    def scan(self, TableName, **kwargs):
+        return self.resource.Table(TableName).scan(**kwargs)
+
+    def batch_write_item(self, **kwargs):
+        return self.resource.batch_write_item(**kwargs)
+
+class _Exceptions:
+    ConditionalCheckFailedException = ConditionalCheckFailedException
+    ResourceNotFoundException = ResourceNotFoundException
+
+def _project(items, projection_expression, attribute_names = None):
+    if not projection_expression:
+        return items
+
+    attributes = [(attribute_names or {}).get(attribute.strip(), attribute.strip()) for attribute in projection_expression.split(',')]
+    return [{k: v for k, v in item.items() if k in attributes} for item in items]
+
+def _item_size(item):
+    # Close enough to DDB's own accounting, which adds up the lengths of the attribute names and values
+    return len(str(item).encode('utf-8'))
+
+def _read_units(item):
+    return math.ceil(_item_size(item) / 4096) / 2
+
+def _to_ddb_types(value):
+    # boto3 hands numbers back as Decimals, so the stand-in does too
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: _to_ddb_types(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_to_ddb_types(v) for v in value]
+    return value
+
+def _condition_holds(expression, item, values):
+    """
+    Evaluates the handful of condition expressions that `DDBCache` uses, joined with AND or OR
+    """
+    if ' OR ' in expression:
+        return any(_condition_holds(part, item, values) for part in expression.split(' OR '))
+    if ' AND ' in expression:
+        return all(_condition_holds(part, item, values) for part in expression.split(' AND '))
+
+    expression = expression.strip()
+
+    match = re.fullmatch(r'attribute_(not_)?exists\((\w+)\)', expression)
+    if match:
+        exists = item is not None and match.group(2) in item
+        return not exists if match.group(1) else exists
+
+    match = re.fullmatch(r'(\w+)\s*(=|<>|<|<=|>|>=)\s*(:\w+)', expression)
+    if match:
+        if item is None or match.group(1) not in item:
+            return False
+        actual, expected = item[match.group(1)], _to_ddb_types(values[match.group(3)])
+        return {
+            '=': actual == expected,
+            '<>': actual != expected,
+            '<': actual < expected,
+            '<=': actual <= expected,
+            '>': actual > expected,
+            '>=': actual >= expected,
+        }[match.group(2)]
+
+    raise Exception(f"Unsupported condition expression: {expression}")
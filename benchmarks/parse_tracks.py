@@ -0,0 +1,133 @@
+"""
+Micro-benchmark for turning playlist track pages into songs, comparing how it used to be done (the standard library's
+json.loads on the decoded text, and a `Song` with a per-instance __dict__) with the current parse path. Every parser
+starts from the raw bytes of a response, so the legacy one pays for decoding them to text like `response.text` did.
+
+    python -m benchmarks.parse_tracks [--playlists 60] [--tracks 100] [--artists 2000] [--repeat 20]
+
+Reports the best per-track parse time over `--repeat` runs, and the memory still held by the songs of every playlist
+once the parsed JSON has been thrown away. The track cache holds every regional playlist's songs at once, so that's
+what's measured.
+"""
+import argparse, gc, json, random, time, tracemalloc
+
+from global_playlist import json_backend
+from global_playlist.spotify_client import SpotifyClient
+
+class _LegacySong:
+    def __init__(self, id, name, uri, artist_ids, artist_names):
+        self.id = id
+        self.name = name
+        self.uri = uri
+        self.artist_ids = artist_ids
+        self.artist_names = artist_names
+
+def _legacy_parse(page_bytes):
+    songs = []
+    for item in json.loads(page_bytes.decode('utf-8'))['items']:
+        if not item['track'] or not item['track']['id']:
+            continue
+        songs.append(_LegacySong(
+            item['track']['id'],
+            item['track']['name'],
+            item['track']['uri'],
+            *list(zip(*[(artist['id'], artist['name']) for artist in item['track']['artists']]))
+        ))
+    return songs
+
+def _current_parse(page_bytes):
+    return SpotifyClient.parse_track_items(json_backend.loads(page_bytes)['items'])
+
+def _stdlib_parse(page_bytes):
+    return SpotifyClient.parse_track_items(json.loads(page_bytes)['items'])
+
+def generate_pages(playlist_count, tracks_per_playlist, artist_pool_size, seed = 1):
+    """
+    :return: A list of playlist track pages, as the raw bytes that the API sends back. Artists are drawn from a shared
+        pool, so the same artists show up across playlists like they do in the real charts.
+    """
+    rng = random.Random(seed)
+    pages = []
+
+    for playlist in range(playlist_count):
+        items = []
+        for index in range(tracks_per_playlist):
+            artists = [rng.randrange(artist_pool_size) for _ in range(1 if rng.random() < 0.7 else 2)]
+            items.append({
+                'track': {
+                    'id': f"{playlist:02d}{index:04d}{'x' * 16}",
+                    'name': f"Song {index} from playlist {playlist}",
+                    'uri': f"spotify:track:{playlist:02d}{index:04d}{'x' * 16}",
+                    'artists': [{'id': f"artist{a:06d}{'y' * 10}", 'name': f"Artist {a}"} for a in artists]
+                }
+            })
+        pages.append(json.dumps({'items': items}).encode('utf-8'))
+
+    return pages
+
+def best_times(parsers, pages, repeat):
+    """
+    Times every parser `repeat` times, taking turns, so that a busy machine slows them all down alike
+    :return: A map of parser name: the fastest time it took to parse every page
+    """
+    best = {}
+    for _ in range(repeat):
+        for name, parse in parsers:
+            started = time.perf_counter()
+            for page in pages:
+                parse(page)
+            elapsed = time.perf_counter() - started
+            best[name] = min(best.get(name, elapsed), elapsed)
+    return best
+
+def measure(name, parse, pages, best_time):
+    # Only the songs are kept, like they are in the track cache. The interned string table resizes every so often, and
+    # whichever pass triggers that gets billed for the whole table, so the smallest of a few passes is reported.
+    retained = None
+    for _ in range(3):
+        songs = None
+        gc.collect()
+        tracemalloc.start()
+        songs = [parse(page) for page in pages]
+        gc.collect()
+        pass_retained, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        retained = pass_retained if retained is None else min(retained, pass_retained)
+
+    track_count = sum(len(playlist_songs) for playlist_songs in songs)
+    return {
+        'parser': name,
+        'tracks': track_count,
+        'us_per_track': round(best_time / track_count * 1e6, 2),
+        'retained_kb': round(retained / 1024, 1),
+        'bytes_per_track': round(retained / track_count)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--playlists', type=int, default=60, help='Number of playlist pages to parse')
+    parser.add_argument('--tracks', type=int, default=100, help='Tracks in each page')
+    parser.add_argument('--artists', type=int, default=2000, help='Size of the shared artist pool')
+    parser.add_argument('--repeat', type=int, default=20, help='Timing runs. The fastest is reported.')
+    args = parser.parse_args()
+
+    pages = generate_pages(args.playlists, args.tracks, args.artists)
+
+    parsers = [
+        ('legacy (json, __dict__ Song)', _legacy_parse),
+        ('current (json, slotted Song)', _stdlib_parse)
+    ]
+    if json_backend.BACKEND != 'json':
+        parsers.append((f"current ({json_backend.BACKEND}, slotted Song)", _current_parse))
+
+    best = best_times(parsers, pages, args.repeat)
+    results = [measure(name, parse, pages, best[name]) for name, parse in parsers]
+
+    columns = ['parser', 'tracks', 'us_per_track', 'retained_kb', 'bytes_per_track']
+    widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print('  '.join(str(result[column]).ljust(width) for column, width in zip(columns, widths)))
+
+if __name__ == '__main__':
+    main()
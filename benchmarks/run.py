@@ -0,0 +1,165 @@
+"""
+End-to-end benchmarks for `update_global_playlist`, run against a local Spotify stub and an in-memory DynamoDB, so
+no network or AWS access is needed.
+
+    python -m benchmarks.run [--markets 60] [--latency 0.02] [--rate-limit-every 0] [--stall-every 0]
+                             [--hedge-percentile 95] [--history 50000] [--json out.json]
+
+Each scenario reports wall time, Spotify API calls (in total and by endpoint), bytes transferred, the number of DDB
+operations and peak traced memory. Timings include tracemalloc's overhead.
+"""
+import argparse, json, os, random, tempfile, time, tracemalloc
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from benchmarks.memory_ddb import InMemoryDynamoDB
+from benchmarks.stub_spotify import StubConfig, StubSpotify
+from global_playlist.cache import DDBCache
+from global_playlist.cache_layer import CacheLayer
+from global_playlist.data_types import ConfigKeys
+from global_playlist.spotify_client import SpotifyClient
+from global_playlist.token_manager import TokenManager
+from global_playlist.warm_state import WarmState
+import lambda_function
+
+def seeded_ddb():
+    """
+    Creates an in-memory DDB with app creds and a valid user token, which is everything a first run needs
+    """
+    ddb = InMemoryDynamoDB()
+    ddb.Table(DDBCache.CONFIG_TABLE).put_item(Item={'key': ConfigKeys.APP_ID, 'value': 'bench-app'})
+    ddb.Table(DDBCache.CONFIG_TABLE).put_item(Item={'key': ConfigKeys.APP_SECRET, 'value': 'bench-secret'})
+    ddb.Table(DDBCache.TOKEN_TABLE).put_item(Item={
+        'id': DDBCache.CLIENT_TOKEN_ID,
+        'token': 'bench-token',
+        'refresh_token': 'bench-refresh',
+        'expires_at': Decimal(int((datetime.now() + timedelta(hours=1)).timestamp()))
+    })
+    return ddb
+
+def add_song_history(ddb, count):
+    history_table = ddb.Table(DDBCache.SONG_HISTORY_TABLE)
+    for i in range(count):
+        history_table.put_item(Item={
+            'id': f"history{i:08d}",
+            'used_date': '2022-01-01T00:00:00Z',
+            'name': f"Old song {i}",
+            'artists': 'Somebody'
+        })
+    # Make the next run rebuild the history filter from scratch
+    history_table.delete_item(Key={'id': DDBCache.SONG_HISTORY_FILTER_ID})
+
+def run_scenario(name, stub, ddb, warm_state = None, event = None):
+    """
+    :param warm_state: Pass the same `WarmState` to several scenarios to simulate them running in one warm container
+    """
+    warm_state = warm_state or WarmState()
+    stub.reset_stats()
+    ddb.operation_counts = {}
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    # The caching layer lives in the warm state, just like it does in lambda_handler
+    cache = warm_state.get('cache', None, lambda: CacheLayer(DDBCache(ddb)))
+    lambda_function.update_global_playlist(cache, event, warm_state)
+    wall_time = time.perf_counter() - started
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    api_stats = stub.stats()
+    total = api_stats.pop('total', {'calls': 0, 'rate_limited': 0, 'stalled': 0, 'bytes_in': 0, 'bytes_out': 0})
+
+    return {
+        'scenario': name,
+        'wall_time_s': round(wall_time, 3),
+        'api_calls': total['calls'],
+        'rate_limited': total['rate_limited'],
+        'stalled': total['stalled'],
+        'bytes_sent': total['bytes_in'],
+        'bytes_received': total['bytes_out'],
+        'peak_memory_kb': round(peak_memory / 1024, 1),
+        'ddb_operations': sum(ddb.operation_counts.values()),
+        'endpoints': api_stats,
+        'ddb_operation_counts': ddb.operation_counts
+    }
+
+def print_report(results):
+    columns = ['scenario', 'wall_time_s', 'api_calls', 'rate_limited', 'stalled', 'bytes_sent', 'bytes_received', 'peak_memory_kb', 'ddb_operations']
+    widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print('  '.join(str(result[column]).ljust(width) for column, width in zip(columns, widths)))
+
+    for result in results:
+        print(f"\n{result['scenario']} calls by endpoint:")
+        for endpoint, endpoint_stats in sorted(result['endpoints'].items()):
+            print(f"  {endpoint}: {endpoint_stats['calls']} calls, {endpoint_stats['bytes_out']} bytes received")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--markets', type=int, default=60, help='Markets returned by the stub')
+    parser.add_argument('--tracks', type=int, default=50, help='Tracks in each regional playlist')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds of latency added to every stub response')
+    parser.add_argument('--rate-limit-every', type=int, default=0, help='Send a 429 for every Nth request. 0 turns this off.')
+    parser.add_argument('--stall-every', type=int, default=0, help='Stall every Nth request for a couple of seconds. 0 turns this off.')
+    parser.add_argument('--hedge-percentile', type=float, help='Turn on hedged GETs at this latency percentile')
+    parser.add_argument('--payload-padding', type=int, default=600, help='Unused bytes the stub adds to each object')
+    parser.add_argument('--history', type=int, default=50000, help='Songs in the history for the large history scenario')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for song selection, so that runs are comparable')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    config = StubConfig(
+        market_count=args.markets,
+        tracks_per_playlist=args.tracks,
+        latency=args.latency,
+        rate_limit_every=args.rate_limit_every,
+        stall_every=args.stall_every,
+        payload_padding=args.payload_padding
+    )
+
+    if args.hedge_percentile:
+        os.environ[lambda_function.HEDGE_PERCENTILE_ENV_VAR] = str(args.hedge_percentile)
+
+    with StubSpotify(config) as stub:
+        SpotifyClient.API_ENDPOINT = stub.api_endpoint
+        TokenManager.ACCOUNTS_ENDPOINT = stub.accounts_endpoint
+
+        ddb = seeded_ddb()
+        warm_state = WarmState()
+        results = [
+            run_scenario('cold_discovery', stub, ddb),
+            run_scenario('cold_cached', stub, ddb),
+            run_scenario('warm_container', stub, ddb, warm_state),
+            run_scenario('warm_container_repeat', stub, ddb, warm_state)
+        ]
+
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            snapshot_path = os.path.join(snapshot_dir, 'catalog.gpcs')
+            results.append(run_scenario('snapshot_export', stub, ddb, event={'export_snapshot': snapshot_path}))
+
+            os.environ[lambda_function.SNAPSHOT_ENV_VAR] = snapshot_path
+            try:
+                results.append(run_scenario('snapshot', stub, ddb))
+            finally:
+                del os.environ[lambda_function.SNAPSHOT_ENV_VAR]
+
+        add_song_history(ddb, args.history)
+        results.append(run_scenario('large_history_rebuild', stub, ddb))
+        results.append(run_scenario('large_history', stub, ddb))
+
+        # Last, since every run after this takes its songs from the queue
+        results.append(run_scenario('pregenerate', stub, ddb, event={'pregenerate': 30}))
+        results.append(run_scenario('queued', stub, ddb))
+
+    print_report(results)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=4)
+
+if __name__ == '__main__':
+    main()
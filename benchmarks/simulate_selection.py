@@ -0,0 +1,204 @@
+"""
+Offline simulation of `SongProvider.get_random_global_songs`, for tuning song selection without spending API calls or
+touching real history. Selections run against a catalog snapshot (a synthetic one by default) and a synthetic song and
+artist history, so runs with the same seed are repeatable.
+
+    python -m benchmarks.simulate_selection [--selections 5000] [--history 0,10000,100000] [--snapshot catalog.gpcs]
+
+For each history size, reports selection throughput, how often songs are rejected by the history, how often a playlist
+comes up with nothing usable, and how the chosen songs are spread over countries and languages.
+"""
+import argparse, json, os, random, tempfile, time
+from collections import Counter
+from datetime import datetime
+
+from global_playlist.catalog_snapshot import CatalogSnapshot
+from global_playlist.data_types import Playlist, Song
+from global_playlist.language_quota import load_market_languages
+from global_playlist.song_filter import BloomFilter
+from global_playlist.song_provider import SongProvider
+
+class SyntheticHistory:
+    """
+    Stands in for the cache's song and artist history. A fixed share of the catalog's songs is in the history, so that
+    the rejection rate stays the same as the history grows, and the rest of the history is songs that aren't in it.
+    """
+    def __init__(self, catalog_song_ids, artist_ids, history_size, used_catalog_fraction, recent_artist_fraction, rng):
+        overlap_count = min(history_size, int(len(catalog_song_ids) * used_catalog_fraction))
+        used_song_ids = rng.sample(catalog_song_ids, overlap_count) + [f"old{i:08d}" for i in range(history_size - overlap_count)]
+
+        self.song_filter = _CountingFilter(BloomFilter.for_capacity(max(10000, 2 * history_size), 0.001))
+        self.song_filter.song_filter.update(used_song_ids)
+        self.recent_artist_ids = set(rng.sample(artist_ids, int(len(artist_ids) * recent_artist_fraction)))
+
+    def load_used_song_filter(self):
+        return self.song_filter
+
+    def load_recent_artists(self, artist_ids, since):
+        return self.recent_artist_ids.intersection(artist_ids)
+
+class _CountingFilter:
+    def __init__(self, song_filter):
+        self.song_filter = song_filter
+        self.checks = 0
+        self.rejections = 0
+
+    def __contains__(self, song_id):
+        self.checks += 1
+        rejected = song_id in self.song_filter
+        self.rejections += rejected
+        return rejected
+
+class _CountingSnapshot:
+    """
+    Records which playlists selection actually reads, in order, which are the ones it went through to find its songs
+    """
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.created_at = snapshot.created_at
+        self.read_playlist_ids = []
+
+    def playlists(self):
+        return self.snapshot.playlists()
+
+    def fetched_at(self, playlist_id):
+        return self.snapshot.fetched_at(playlist_id)
+
+    def songs(self, playlist_id):
+        self.read_playlist_ids.append(playlist_id)
+        return self.snapshot.songs(playlist_id)
+
+def write_synthetic_catalog(path, market_count, tracks_per_playlist, artist_pool_size, global_hit_ratio, rng):
+    """
+    Writes a catalog snapshot with a playlist for each of the first `market_count` markets. Artist popularity is skewed,
+    and some songs are global hits that show up in lots of markets, like they do in the real charts.
+    """
+    markets = sorted(load_market_languages().keys())[:market_count]
+    artist_weights = [1 / (rank + 1) for rank in range(artist_pool_size)]
+    global_hits = [_synthetic_song(f"hit{i:04d}", rng, artist_weights) for i in range(tracks_per_playlist * 2)]
+    fetched_at = datetime.now()
+    entries = []
+
+    for market in markets:
+        songs = [
+            rng.choice(global_hits) if rng.random() < global_hit_ratio else _synthetic_song(f"{market}{i:04d}", rng, artist_weights)
+            for i in range(tracks_per_playlist)
+        ]
+        # Charts don't list the same song twice
+        songs = list(dict((song.id, song) for song in songs).values())
+        entries.append((Playlist(f"chart{market}", f"Top 50 - {market}", 'Spotify', market, fetched_at), songs, fetched_at))
+
+    CatalogSnapshot.write(path, entries, fetched_at)
+
+def _synthetic_song(song_id, rng, artist_weights):
+    artists = rng.choices(range(len(artist_weights)), artist_weights, k=1 if rng.random() < 0.7 else 2)
+    return Song(song_id, f"Song {song_id}", Song.URI_PREFIX + song_id, [f"artist{a}" for a in artists], [f"Artist {a}" for a in artists])
+
+def simulate(snapshot, history_size, args, market_languages):
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+
+    playlists = snapshot.playlists()
+    catalog_songs = [song for playlist in playlists for song in snapshot.songs(playlist.id)]
+    catalog_song_ids = sorted(set(song.id for song in catalog_songs))
+    artist_ids = sorted(set(artist_id for song in catalog_songs for artist_id in song.artist_ids))
+
+    history = SyntheticHistory(catalog_song_ids, artist_ids, history_size, args.used_catalog, args.recent_artists, rng)
+    counting_snapshot = _CountingSnapshot(snapshot)
+    # Nothing is prefetched, so that every playlist that's read is one that selection went through
+    provider = SongProvider(None, {}, history, prefetch_depth=0, playlists=playlists, catalog_snapshot=counting_snapshot)
+
+    playlist_song_ids = dict((playlist.id, set(song.id for song in snapshot.songs(playlist.id))) for playlist in playlists)
+    country_of_playlist = dict((playlist.id, playlist.country_id) for playlist in playlists)
+    countries = Counter()
+    shortfalls = 0
+
+    started = time.perf_counter()
+    for _ in range(args.selections):
+        first_read = len(counting_snapshot.read_playlist_ids)
+        songs = provider.get_random_global_songs(args.count)
+        shortfalls += len(songs) < args.count
+        read_playlist_ids = counting_snapshot.read_playlist_ids[first_read:]
+        countries.update(country_of_playlist[playlist_id] for playlist_id in _source_playlist_ids(songs, read_playlist_ids, playlist_song_ids))
+    elapsed = time.perf_counter() - started
+
+    chosen_count = sum(countries.values())
+    languages = Counter()
+    for country_id, country_count in countries.items():
+        languages[market_languages.get(country_id, '??')] += country_count
+
+    return {
+        'history_size': history_size,
+        'selections_per_s': round(args.selections / elapsed),
+        'us_per_selection': round(elapsed / args.selections * 1e6, 1),
+        'song_rejection_rate': round(history.song_filter.rejections / max(1, history.song_filter.checks), 4),
+        'empty_playlist_rate': round((len(counting_snapshot.read_playlist_ids) - chosen_count) / max(1, len(counting_snapshot.read_playlist_ids)), 4),
+        'playlists_per_selection': round(len(counting_snapshot.read_playlist_ids) / args.selections, 2),
+        'short_selections': shortfalls,
+        'countries_used': len(countries),
+        'top_countries': [(country_id, round(count / chosen_count, 4)) for country_id, count in countries.most_common(5)],
+        'languages': [(language, round(count / chosen_count, 4)) for language, count in languages.most_common(8)]
+    }
+
+def _source_playlist_ids(songs, read_playlist_ids, playlist_song_ids):
+    """
+    Yields the playlist that each song was picked from. Selection takes at most one song from each playlist it reads, in
+    the order it reads them, so a song came from the first playlist after the previous song's one that has it. (Had it
+    been in a playlist read in between, that playlist would have had something to pick.) Global hits are in lots of
+    playlists, so looking the song up in the catalog would credit whichever of them comes last.
+    """
+    read_playlist_ids = iter(read_playlist_ids)
+    for song in songs:
+        for playlist_id in read_playlist_ids:
+            if song.id in playlist_song_ids[playlist_id]:
+                yield playlist_id
+                break
+
+def print_report(results):
+    columns = ['history_size', 'selections_per_s', 'us_per_selection', 'song_rejection_rate', 'empty_playlist_rate', 'playlists_per_selection', 'short_selections', 'countries_used']
+    widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print('  '.join(str(result[column]).ljust(width) for column, width in zip(columns, widths)))
+
+    for result in results:
+        print(f"\nhistory of {result['history_size']}:")
+        print(f"  top countries: {', '.join(f'{country} {share:.1%}' for country, share in result['top_countries'])}")
+        print(f"  languages: {', '.join(f'{language} {share:.1%}' for language, share in result['languages'])}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--selections', type=int, default=5000, help='Selections to run for each history size')
+    parser.add_argument('--count', type=int, default=2, help='Songs chosen per selection, like the lambda does')
+    parser.add_argument('--history', default='0,10000,100000', help='Comma-separated history sizes to simulate')
+    parser.add_argument('--used-catalog', type=float, default=0.3, help='Fraction of the catalog that is already in the history')
+    parser.add_argument('--recent-artists', type=float, default=0.05, help='Fraction of artists that were used recently')
+    parser.add_argument('--snapshot', help='A catalog snapshot to use instead of a synthetic one')
+    parser.add_argument('--markets', type=int, default=60, help='Markets in the synthetic catalog')
+    parser.add_argument('--tracks', type=int, default=50, help='Tracks in each synthetic playlist')
+    parser.add_argument('--artists', type=int, default=2000, help='Artists in the synthetic catalog')
+    parser.add_argument('--global-hits', type=float, default=0.2, help='Fraction of each synthetic chart that is global hits')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for the catalog, the history and selection')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    market_languages = load_market_languages()
+
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        snapshot_path = args.snapshot
+        if not snapshot_path:
+            snapshot_path = os.path.join(snapshot_dir, 'catalog.gpcs')
+            write_synthetic_catalog(snapshot_path, args.markets, args.tracks, args.artists, args.global_hits, random.Random(args.seed))
+
+        with CatalogSnapshot(snapshot_path) as snapshot:
+            results = [simulate(snapshot, int(history_size), args, market_languages) for history_size in args.history.split(',')]
+
+    print_report(results)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=4)
+
+if __name__ == '__main__':
+    main()
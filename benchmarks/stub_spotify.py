@@ -0,0 +1,307 @@
+import gzip, json, multiprocessing, random, re, threading, time, urllib.parse, urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StubConfig:
+    def __init__(
+        self,
+        market_count = 60,
+        chart_ratio = 0.7,
+        tracks_per_playlist = 50,
+        artist_pool_size = 2000,
+        user_playlist_count = 120,
+        latency = 0.02,
+        latency_jitter = 0.01,
+        rate_limit_every = 0,
+        retry_after = 1,
+        payload_padding = 600,
+        stall_every = 0,
+        stall_latency = 2,
+        seed = 1
+    ):
+        """
+        :param market_count: The number of markets returned by /markets
+        :param chart_ratio: The fraction of markets that have a Spotify "Top 50" playlist
+        :param latency: Seconds added to every response
+        :param latency_jitter: Up to this many more seconds are added at random
+        :param rate_limit_every: Every Nth API request gets a 429. 0 turns this off.
+        :param retry_after: The Retry-After header sent with a 429, in seconds
+        :param payload_padding: Bytes of extra data (images, descriptions, markets, ...) added to each object, unless
+            the request asks for specific `fields`. This stands in for everything the real API sends that we don't use.
+            Responses are gzipped for clients that accept it, like the real API does.
+        :param stall_every: Every Nth API request takes `stall_latency` more seconds. 0 turns this off.
+        """
+        self.market_count = market_count
+        self.chart_ratio = chart_ratio
+        self.tracks_per_playlist = tracks_per_playlist
+        self.artist_pool_size = artist_pool_size
+        self.user_playlist_count = user_playlist_count
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.payload_padding = payload_padding
+        self.stall_every = stall_every
+        self.stall_latency = stall_latency
+        self.seed = seed
+
+class StubSpotify:
+    """
+    A local HTTP server that mimics the parts of the Spotify accounts and web APIs that `SpotifyClient` uses. It runs
+    in its own process, so that its work doesn't show up in the timings or memory use of the code being benchmarked.
+    """
+    def __init__(self, config = None):
+        self.config = config or StubConfig()
+        self.process = None
+        self.port = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def api_endpoint(self):
+        return f"{self.base_url}/v1"
+
+    @property
+    def accounts_endpoint(self):
+        return self.base_url
+
+    def start(self):
+        port_queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=_serve, args=(self.config, port_queue), daemon=True)
+        self.process.start()
+        self.port = port_queue.get(timeout=10)
+
+    def stop(self):
+        if self.process:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def stats(self):
+        """
+        :return: A map of endpoint: {calls, rate_limited, bytes_in, bytes_out}, plus a 'total' entry
+        """
+        with urllib.request.urlopen(f"{self.base_url}/__stats") as response:
+            return json.loads(response.read())
+
+    def reset_stats(self):
+        urllib.request.urlopen(urllib.request.Request(f"{self.base_url}/__reset", method='POST')).read()
+
+class _Catalog:
+    def __init__(self, config):
+        rng = random.Random(config.seed)
+
+        with open('./resources/country_mapping.json') as file:
+            country_mapping = json.load(file)
+
+        self.config = config
+        self.padding = 'x' * config.payload_padding
+        self.markets = sorted(country_mapping.keys())[:config.market_count]
+        self.chart_markets = set(market for market in self.markets if rng.random() < config.chart_ratio)
+        self.playlists = {}
+        self.snapshots = {}
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+        for market in self.markets:
+            if market not in self.chart_markets:
+                continue
+            self.playlists[f"chart{market}"] = [self.__track(rng, market, i) for i in range(config.tracks_per_playlist)]
+            self.snapshots[f"chart{market}"] = f"snapshot-{market}-1"
+
+        self.user_playlists = [
+            {'id': f"user{i}", 'name': f"User playlist {i}", 'owner': {'display_name': 'bench-user'}}
+            for i in range(config.user_playlist_count)
+        ]
+
+    def __track(self, rng, market, index):
+        artist_count = 1 if rng.random() < 0.7 else 2
+        artists = [rng.randrange(self.config.artist_pool_size) for _ in range(artist_count)]
+
+        return {
+            'track': {
+                'id': f"{market}{index:04d}",
+                'name': f"Song {index} from {market}",
+                'uri': f"spotify:track:{market}{index:04d}",
+                'artists': [{'id': f"artist{a}", 'name': f"Artist {a}", 'padding': self.padding} for a in artists],
+                'padding': self.padding
+            }
+        }
+
+    def mutate(self, playlist_id):
+        with self.lock:
+            self.next_id += 1
+            return f"snapshot-{playlist_id}-{self.next_id}"
+
+def _serve(config, port_queue):
+    catalog = _Catalog(config)
+    stats = {}
+    stats_lock = threading.Lock()
+    request_counter = [0]
+
+    def record(endpoint, key, amount = 1):
+        with stats_lock:
+            for name in (endpoint, 'total'):
+                endpoint_stats = stats.setdefault(name, {'calls': 0, 'rate_limited': 0, 'stalled': 0, 'bytes_in': 0, 'bytes_out': 0})
+                endpoint_stats[key] += amount
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self.__handle('GET')
+
+        def do_POST(self):
+            self.__handle('POST')
+
+        def do_PUT(self):
+            self.__handle('PUT')
+
+        def do_DELETE(self):
+            self.__handle('DELETE')
+
+        def __handle(self, method):
+            url = urllib.parse.urlparse(self.path)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+            if url.path == '/__stats':
+                with stats_lock:
+                    return self.__respond(200, stats)
+            if url.path == '/__reset':
+                with stats_lock:
+                    stats.clear()
+                return self.__respond(200, {})
+
+            # Group requests by endpoint rather than by the exact playlist or user they were for
+            templated_path = re.sub(r'/(playlists|users)/[^/]+', r'/\1/{id}', url.path)
+            endpoint = f"{method} {templated_path}"
+            record(endpoint, 'calls')
+            record(endpoint, 'bytes_in', len(self.requestline) + len(str(self.headers)) + len(body))
+
+            with stats_lock:
+                request_counter[0] += 1
+                rate_limited = config.rate_limit_every and request_counter[0] % config.rate_limit_every == 0
+                stalled = config.stall_every and request_counter[0] % config.stall_every == 0 and url.path.startswith('/v1')
+
+            time.sleep(config.latency + random.random() * config.latency_jitter + (config.stall_latency if stalled else 0))
+            if stalled:
+                record(endpoint, 'stalled')
+
+            if rate_limited and url.path.startswith('/v1'):
+                record(endpoint, 'rate_limited')
+                return self.__respond(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}}, endpoint, {'Retry-After': str(config.retry_after)})
+
+            status, payload = self.__route(method, url.path, query, body)
+            self.__respond(status, payload, endpoint)
+
+        def __route(self, method, path, query, body):
+            padded = 'fields' not in query
+
+            if path == '/api/token':
+                return 200, {'access_token': f"token-{time.time()}", 'token_type': 'Bearer', 'expires_in': 3600, 'refresh_token': 'refresh'}
+            if path == '/v1/markets':
+                return 200, {'markets': catalog.markets}
+            if path == '/v1/me':
+                return 200, {'id': 'bench-user', 'display_name': 'bench-user'}
+            if path == '/v1/me/playlists':
+                return 200, self.__page(catalog.user_playlists, query, 20, padded)
+            if path == '/v1/search':
+                return 200, {'playlists': {'items': self.__search(query)}}
+
+            match = re.fullmatch(r'/v1/users/[^/]+/playlists', path)
+            if match and method == 'POST':
+                playlist_id = f"created{catalog.mutate('new')}"
+                catalog.user_playlists.append({'id': playlist_id, 'name': json.loads(body)['name'], 'owner': {'display_name': 'bench-user'}})
+                return 201, {'id': playlist_id}
+
+            match = re.fullmatch(r'/v1/playlists/([^/]+)(/tracks)?', path)
+            if match:
+                playlist_id, tracks_path = match.group(1), match.group(2)
+                tracks = catalog.playlists.get(playlist_id, [])
+
+                if tracks_path and method != 'GET':
+                    snapshot_id = catalog.mutate(playlist_id)
+                    catalog.snapshots[playlist_id] = snapshot_id
+                    return 200 if method != 'POST' else 201, {'snapshot_id': snapshot_id}
+                if tracks_path:
+                    return 200, self.__page(tracks, query, 100, padded)
+
+                snapshot_id = catalog.snapshots.get(playlist_id, f"snapshot-{playlist_id}")
+                if query.get('fields') == 'snapshot_id':
+                    return 200, {'snapshot_id': snapshot_id}
+                tracks_page = self.__page(tracks, {}, 100, padded)
+                tracks_page['next'] = f"/v1/playlists/{playlist_id}/tracks?offset=100" if len(tracks) > 100 else None
+                return 200, {'id': playlist_id, 'snapshot_id': snapshot_id, 'tracks': tracks_page}
+
+            return 404, {'error': {'status': 404, 'message': 'Not found'}}
+
+        def __search(self, query):
+            market = query.get('market')
+            items = [{
+                'id': f"fan{market}{i}",
+                'name': f"{query.get('q')} fan picks",
+                'owner': {'display_name': 'somebody'},
+                'description': catalog.padding
+            } for i in range(2)]
+
+            if market in catalog.chart_markets and query.get('q', '').startswith('Top 50'):
+                items.insert(0, {
+                    'id': f"chart{market}",
+                    'name': query.get('q'),
+                    'owner': {'display_name': 'Spotify'},
+                    'description': catalog.padding
+                })
+
+            return items[:int(query.get('limit', 20))]
+
+        def __page(self, items, query, default_limit, padded):
+            offset = int(query.get('offset', 0))
+            limit = int(query.get('limit', default_limit))
+            page_items = items[offset:offset + limit]
+
+            if not padded:
+                page_items = [_strip_padding(item) for item in page_items]
+
+            return {'items': page_items, 'total': len(items), 'offset': offset, 'limit': limit, 'next': None}
+
+        def __respond(self, status, payload, endpoint = None, headers = {}):
+            data = json.dumps(payload).encode('utf-8')
+
+            if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+                data = gzip.compress(data, compresslevel=6)
+                headers = {**headers, 'Content-Encoding': 'gzip'}
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+            if endpoint:
+                record(endpoint, 'bytes_out', len(data))
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+def _strip_padding(value):
+    if isinstance(value, dict):
+        return {k: _strip_padding(v) for k, v in value.items() if k not in ('padding', 'description')}
+    if isinstance(value, list):
+        return [_strip_padding(v) for v in value]
+    return value
@@ -1,124 +1,606 @@
-from global_playlist.data_types import Playlist, ClientToken
+from global_playlist.cache_backend import CacheBackend
+from global_playlist.data_types import Playlist, ClientToken, Song
+from global_playlist.song_filter import BloomFilter
+from global_playlist.metrics import timed_cache_operation, current_consumed_capacity
+from global_playlist import json_backend
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from decimal import Decimal
+import random, time
 
-class DDBCache:
+class DDBCache(CacheBackend):
+    # Keyed by country_id, since we keep one playlist per country
     PLAYLIST_TABLE = 'GlobalPlaylist-Playlists'
     # An entire table for a single token is slight overkill, but this leaves
     # the door open for supporting multiple users in future.
     TOKEN_TABLE = 'GlobalPlaylist-Tokens'
     CONFIG_TABLE = 'GlobalPlaylist-Config'
     SONG_HISTORY_TABLE = 'GlobalPlaylist-SongHistoryTable'
+    PLAYLIST_TRACKS_TABLE = 'GlobalPlaylist-PlaylistTracks'
+    # Keyed by artist ID. Items have a DDB TTL on `expires_at`, so artists drop out once they could be used again.
+    ARTIST_HISTORY_TABLE = 'GlobalPlaylist-ArtistHistory'
+    # Keyed by the name of the playlist that the selections are for. Each queue is a single item, so that it can be read
+    # with one get and changed with one conditional put.
+    SELECTION_QUEUE_TABLE = 'GlobalPlaylist-SelectionQueue'
 
-    CLIENT_TOKEN_ID="client_token"
+    # The song history filter lives alongside the songs it summarises, under an ID that no Spotify track can have
+    SONG_HISTORY_FILTER_ID="__song_history_filter__"
+    SONG_HISTORY_FILTER_MIN_CAPACITY = 10000
+    SONG_HISTORY_FILTER_ERROR_RATE = 0.001
+    SONG_HISTORY_FILTER_WRITE_ATTEMPTS = 3
+    # The most keys that a single BatchGetItem can ask for, and the most items that a single BatchWriteItem can write
+    BATCH_GET_MAX_KEYS = 100
+    BATCH_WRITE_MAX_ITEMS = 25
+    BATCH_ATTEMPTS = 5
+    BATCH_BASE_DELAY = 0.05
+    # The song history is the only table that grows without bound, so it's the only one that's scanned in parallel
+    SONG_HISTORY_SCAN_SEGMENTS = 4
+    # DDB items max out at 400KB. Listings bigger than this just don't get cached.
+    MAX_PLAYLIST_TRACKS_BYTES = 350 * 1024
+    MAX_SELECTION_QUEUE_BYTES = 350 * 1024
+    SELECTION_QUEUE_WRITE_ATTEMPTS = 3
 
     def __init__(self, ddb_resource):
         """
         :param ddb_resource: A boto3 DDB resource object
         """
         self.ddb_resource = ddb_resource
-        self.playlist_table = ddb_resource.Table(self.PLAYLIST_TABLE)
-        self.token_table = ddb_resource.Table(self.TOKEN_TABLE)
-        self.config_table = ddb_resource.Table(self.CONFIG_TABLE)
+        # boto3 resources (and their tables) aren't thread-safe, but clients are. Anything that can run on another thread,
+        # like parallel scans, token refreshes and the track listings that prefetching reads and writes, goes through the
+        # client. The resource's client takes and hands back plain values, the same way its tables do.
+        self.client = ddb_resource.meta.client
         self.song_history_table = ddb_resource.Table(self.SONG_HISTORY_TABLE)
+        self.selection_queue_table = ddb_resource.Table(self.SELECTION_QUEUE_TABLE)
+        # Track listings are still cached in memory without their table, so it's only looked for until it's found missing
+        self.playlist_tracks_table_exists = True
 
+    @timed_cache_operation
     def load_app_config(self):
-        playlist_scan_response = self.config_table.scan(
-            Select='ALL_ATTRIBUTES'
+        config_items = self.__scan(
+            self.CONFIG_TABLE,
+            ProjectionExpression='#key, #value',
+            ExpressionAttributeNames={'#key': 'key', '#value': 'value'}
         )
 
-        return dict([(i['key'], i['value']) for i in playlist_scan_response['Items']])
+        return dict([(i['key'], i['value']) for i in config_items])
 
+    @timed_cache_operation
+    def save_app_config(self, config):
+        self.__batch_write(self.CONFIG_TABLE, [
+            {
+                'PutRequest': {
+                    'Item': {
+                        'key': key,
+                        'value': value
+                    }
+                }
+            } for key, value in config.items()
+        ])
+
+    @timed_cache_operation
     def load_client_token(self):
-        token_get_response = self.token_table.get_item(
+        token_get_response = self.client.get_item(
+            TableName=self.TOKEN_TABLE,
             Key={
                 'id': self.CLIENT_TOKEN_ID
-            }
+            },
+            ReturnConsumedCapacity='TOTAL'
         )
+        current_consumed_capacity().add(token_get_response)
 
         if 'Item' in token_get_response:
             token_item = token_get_response['Item']
             return ClientToken(
                 token_item['token'],
                 token_item['refresh_token'],
-                datetime.fromtimestamp(token_item['expires_at'])
+                datetime.fromtimestamp(float(token_item['expires_at']))
             )
 
         return None
     
+    @timed_cache_operation
     def save_client_token(self, token):
-        self.token_table.put_item(
+        token_put_response = self.client.put_item(
+            TableName=self.TOKEN_TABLE,
             Item={
                 'id': self.CLIENT_TOKEN_ID,
                 'token': token.token,
                 'refresh_token': token.refresh_token,
                 'expires_at': Decimal(token.expires_at.timestamp())
-            }
+            },
+            ReturnConsumedCapacity='TOTAL'
         )
+        current_consumed_capacity().add(token_put_response)
 
-    def load_playlists(self):
+    @timed_cache_operation
+    def load_playlist_discovery(self):
         """
-        Retrieves a list of playlists from the cache.
+        Retrieves everything we know about each country's playlist with a single scan: the playlists that were found, and
+        the countries that were searched without finding one.
+        :return: A tuple of the list of playlists and a map of country_id: when it was last searched without a result
         """
-        playlist_scan_response = self.playlist_table.scan(
-            Select='ALL_ATTRIBUTES'
+        playlists = []
+        missing_playlists = {}
+
+        playlist_items = self.__scan(
+            self.PLAYLIST_TABLE,
+            ProjectionExpression='country_id, id, #name, #owner, verified_at, #missing',
+            # These are all reserved words in DDB
+            ExpressionAttributeNames={'#name': 'name', '#owner': 'owner', '#missing': 'missing'}
         )
 
-        playlists = []
+        for playlist_item in playlist_items:
+            # Items from before we tracked this count as verified a long time ago, so they're checked again first
+            verified_at = datetime.fromtimestamp(float(playlist_item.get('verified_at', 0)))
+
+            if playlist_item.get('missing'):
+                missing_playlists[playlist_item['country_id']] = verified_at
+                continue
 
-        for playlist_item in playlist_scan_response['Items']:
             playlists.append(Playlist(
                 playlist_item['id'],
                 playlist_item['name'],
                 playlist_item['owner'],
-                playlist_item['country_id']
+                playlist_item['country_id'],
+                verified_at
             ))
 
-        return playlists
+        return playlists, missing_playlists
 
+    @timed_cache_operation
     def save_playlists(self, playlists):
         """
         Takes a list of playlists and upserts them into the playlist cache.
         """
-        with self.playlist_table.batch_writer() as batch:
-            for playlist in playlists:
-                batch.put_item(
-                    Item={
-                        'country_id': playlist.country_id,
-                        'id': playlist.id,
-                        'name': playlist.name,
-                        'owner': playlist.owner
+        self.__put_playlist_items([
+            {
+                'country_id': playlist.country_id,
+                'id': playlist.id,
+                'name': playlist.name,
+                'owner': playlist.owner,
+                'verified_at': Decimal((playlist.verified_at or datetime.now()).timestamp())
+            } for playlist in playlists
+        ])
+
+    @timed_cache_operation
+    def save_missing_playlists(self, country_ids, verified_at):
+        """
+        Records that the given countries were searched and don't have a playlist, replacing any playlist that they had.
+        """
+        self.__put_playlist_items([
+            {
+                'country_id': country_id,
+                'missing': True,
+                'verified_at': Decimal(verified_at.timestamp())
+            } for country_id in country_ids
+        ])
+
+    @timed_cache_operation
+    def delete_playlists(self, country_ids):
+        """
+        Removes the cached playlists of the given countries
+        """
+        self.__batch_write(self.PLAYLIST_TABLE, [
+            {
+                'DeleteRequest': {
+                    'Key': {
+                        'country_id': country_id
                     }
-                )
+                }
+            } for country_id in country_ids
+        ])
 
-    def load_used_songs(self):
+    @timed_cache_operation
+    def load_playlist_tracks(self, playlist_id):
         """
-        Loads the list of previously used songs.
-        :return A list of song Ids
+        Loads the cached songs of a playlist.
+        :return: A tuple of the snapshot ID the songs were cached at and the songs, or None if there's nothing cached
         """
-        scan_result= self.song_history_table.scan(
-            Select='SPECIFIC_ATTRIBUTES',
-            ProjectionExpression = 'id'
-        )['Items']
+        if not self.playlist_tracks_table_exists:
+            return None
+
+        try:
+            tracks_get_response = self.client.get_item(
+                TableName=self.PLAYLIST_TRACKS_TABLE,
+                Key={
+                    'id': playlist_id
+                },
+                ReturnConsumedCapacity='TOTAL'
+            )
+        except self.client.exceptions.ResourceNotFoundException:
+            self.__playlist_tracks_table_missing()
+            return None
+        current_consumed_capacity().add(tracks_get_response)
+
+        if 'Item' not in tracks_get_response:
+            return None
 
-        return [song['id'] for song in scan_result]
+        tracks_item = tracks_get_response['Item']
+        songs = [Song.from_dict(track) for track in json_backend.loads(tracks_item['tracks'])]
 
+        return tracks_item['snapshot_id'], songs
 
+    @timed_cache_operation
+    def save_playlist_tracks(self, playlist_id, snapshot_id, songs):
+        if not self.playlist_tracks_table_exists:
+            return
+
+        # The tracks are stored as a single JSON string, which is a lot smaller than the equivalent list of DDB maps
+        serialized_tracks = json_backend.dumps([song.dict() for song in songs])
+
+        if len(serialized_tracks.encode('utf-8')) > self.MAX_PLAYLIST_TRACKS_BYTES:
+            print(f"Not caching the tracks of {playlist_id}. There are too many of them.")
+            return
+
+        try:
+            tracks_put_response = self.client.put_item(
+                TableName=self.PLAYLIST_TRACKS_TABLE,
+                Item={
+                    'id': playlist_id,
+                    'snapshot_id': snapshot_id,
+                    'tracks': serialized_tracks
+                },
+                ReturnConsumedCapacity='TOTAL'
+            )
+        except self.client.exceptions.ResourceNotFoundException:
+            self.__playlist_tracks_table_missing()
+            return
+        current_consumed_capacity().add(tracks_put_response)
 
+    def iter_used_songs(self):
+        """
+        Streams the IDs of previously used songs as they're read. The history table is scanned in parallel segments.
+        """
+        song_items = self.__scan(
+            self.SONG_HISTORY_TABLE,
+            self.SONG_HISTORY_SCAN_SEGMENTS,
+            ProjectionExpression='id'
+        )
+
+        return (song['id'] for song in song_items if song['id'] != self.SONG_HISTORY_FILTER_ID)
+
+    @timed_cache_operation
+    def load_used_song_filter(self):
+        """
+        Loads a `BloomFilter` of previously used song IDs with a single read. If there isn't a filter yet (or it's grown
+        past its capacity), it's rebuilt from the full song history and saved.
+        """
+        song_filter, _ = self.__load_song_history_filter()
+
+        if song_filter is None or song_filter.is_saturated():
+            print("Song history filter is missing or full. Rebuilding it from the song history.")
+            song_filter = self.__rebuild_song_history_filter()
+
+        return song_filter
+
+    @timed_cache_operation
     def add_used_songs(self, songs):
         """
         Saves a list of songs so that they won't be used again
         """
         iso_date_string = datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
             
-        with self.song_history_table.batch_writer() as batch:
-            for song in songs:
-                batch.put_item(
-                    Item={
+        self.__batch_write(self.SONG_HISTORY_TABLE, [
+            {
+                'PutRequest': {
+                    'Item': {
                         'id': song.id,
                         'used_date': iso_date_string,
                         # The info below isn't really _useful_, but it makes it easier to read the database items (manually)
                         'name': song.name,
                         'artists': ','.join(song.artist_names)
                     }
-                )
\ No newline at end of file
+                }
+            } for song in songs
+        ])
+
+        self.__add_to_song_history_filter([song.id for song in songs])
+        self.__add_to_artist_history(songs)
+
+    @timed_cache_operation
+    def load_recent_artists(self, artist_ids, since):
+        """
+        Looks up which of the given artists have been used since `since`. Only the given artists are read, 100 per
+        request, so this costs the same however long the history is.
+        :return: A set of the IDs of the recently used artists
+        """
+        artist_ids = list(set(artist_ids))
+        since_timestamp = Decimal(since.timestamp())
+        recent_artist_ids = set()
+
+        for i in range(0, len(artist_ids), self.BATCH_GET_MAX_KEYS):
+            keys = [{'id': artist_id} for artist_id in artist_ids[i:i + self.BATCH_GET_MAX_KEYS]]
+
+            for artist_item in self.__batch_get_artist_history(keys):
+                # DDB can take a while to delete expired items, so the date is checked here too
+                if artist_item['last_used'] >= since_timestamp:
+                    recent_artist_ids.add(artist_item['id'])
+
+        return recent_artist_ids
+
+    @timed_cache_operation
+    def load_queued_selections(self, queue_name):
+        """
+        Loads the song selections that were generated ahead of time for a playlist, oldest first
+        :return: A list of lists of songs
+        """
+        selections, _ = self.__load_selection_queue(queue_name)
+        return selections
+
+    def update_queued_selections(self, queue_name, update):
+        """
+        Saves the updated selections with a conditional put on the queue's version. If somebody else has changed the queue
+        in the meantime, it's loaded again and `update` is applied to that.
+        """
+        for _ in range(self.SELECTION_QUEUE_WRITE_ATTEMPTS):
+            selections, version = self.__load_selection_queue(queue_name)
+            updated_selections = update(selections)
+
+            # `update` hands back the same list when there's nothing to change
+            if updated_selections is selections:
+                return
+
+            serialized_selections = json_backend.dumps([[song.dict() for song in songs] for songs in updated_selections])
+            if len(serialized_selections.encode('utf-8')) > self.MAX_SELECTION_QUEUE_BYTES:
+                raise Exception(f"The selection queue for '{queue_name}' can't hold {len(updated_selections)} selections. Queue fewer of them.")
+
+            condition_kwargs = {
+                'ConditionExpression': 'attribute_not_exists(id)'
+            }
+            if version is not None:
+                condition_kwargs = {
+                    'ConditionExpression': 'version = :expected_version',
+                    'ExpressionAttributeValues': {
+                        ':expected_version': version
+                    }
+                }
+
+            try:
+                queue_put_response = self.selection_queue_table.put_item(
+                    Item={
+                        'id': queue_name,
+                        'selections': serialized_selections,
+                        'version': (version or 0) + 1
+                    },
+                    ReturnConsumedCapacity='TOTAL',
+                    **condition_kwargs
+                )
+                current_consumed_capacity().add(queue_put_response)
+                return
+            except self.ddb_resource.meta.client.exceptions.ConditionalCheckFailedException:
+                continue
+
+        raise Exception(f"Couldn't update the selection queue for '{queue_name}'. It was being modified concurrently.")
+
+# ---------------- ---------------- ---------------------#
+# ----------------     private      ---------------------#
+# ---------------- ---------------- ---------------------#
+
+    def __scan(self, table_name, segments = 1, **scan_kwargs):
+        """
+        Yields every item in a table, following `LastEvaluatedKey` so that nothing past the first 1MB page is missed. With
+        more than one segment, the segments are scanned in parallel and items are yielded as each page comes in.
+        """
+        consumed_capacity = current_consumed_capacity()
+
+        def scan_page(segment, start_key):
+            page_kwargs = dict(scan_kwargs, TableName=table_name, ReturnConsumedCapacity='TOTAL')
+            if segments > 1:
+                page_kwargs.update(Segment=segment, TotalSegments=segments)
+            if start_key:
+                page_kwargs['ExclusiveStartKey'] = start_key
+
+            scan_response = self.client.scan(**page_kwargs)
+            consumed_capacity.add(scan_response)
+            return segment, scan_response
+
+        if segments == 1:
+            start_key = None
+            while True:
+                _, scan_response = scan_page(0, start_key)
+                yield from scan_response['Items']
+
+                start_key = scan_response.get('LastEvaluatedKey')
+                if not start_key:
+                    return
+
+        executor = ThreadPoolExecutor(max_workers=segments)
+        try:
+            in_flight = set(executor.submit(scan_page, segment, None) for segment in range(segments))
+
+            while len(in_flight) > 0:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    segment, scan_response = future.result()
+                    if scan_response.get('LastEvaluatedKey'):
+                        in_flight.add(executor.submit(scan_page, segment, scan_response['LastEvaluatedKey']))
+
+                    yield from scan_response['Items']
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def __playlist_tracks_table_missing(self):
+        # Prefetching reads listings from several threads, so this can be found out more than once
+        if self.playlist_tracks_table_exists:
+            print(f"There's no {self.PLAYLIST_TRACKS_TABLE} table. Playlist track listings are only cached in memory.")
+        self.playlist_tracks_table_exists = False
+
+    def __put_playlist_items(self, playlist_items):
+        self.__batch_write(self.PLAYLIST_TABLE, [{'PutRequest': {'Item': item}} for item in playlist_items])
+
+    def __add_to_artist_history(self, songs):
+        used_at = datetime.now()
+        artists = dict((artist_id, artist_name) for song in songs for artist_id, artist_name in zip(song.artist_ids, song.artist_names))
+
+        self.__batch_write(self.ARTIST_HISTORY_TABLE, [
+            {
+                'PutRequest': {
+                    'Item': {
+                        'id': artist_id,
+                        'last_used': Decimal(used_at.timestamp()),
+                        # DDB TTL attributes have to be whole seconds
+                        'expires_at': int((used_at + self.ARTIST_HISTORY_RETENTION).timestamp()),
+                        'name': artist_name
+                    }
+                }
+            } for artist_id, artist_name in artists.items()
+        ])
+
+    def __batch_write(self, table_name, write_requests):
+        """
+        Sends put and delete requests to a table 25 at a time, so that each write reports the capacity it used. Like batch
+        gets, requests that DDB hands back unprocessed are sent again with a backoff.
+        """
+        for i in range(0, len(write_requests), self.BATCH_WRITE_MAX_ITEMS):
+            request_items = {
+                table_name: write_requests[i:i + self.BATCH_WRITE_MAX_ITEMS]
+            }
+
+            for attempt in range(self.BATCH_ATTEMPTS):
+                batch_response = self.client.batch_write_item(RequestItems=request_items, ReturnConsumedCapacity='TOTAL')
+                current_consumed_capacity().add(batch_response)
+
+                request_items = batch_response.get('UnprocessedItems')
+                if not request_items:
+                    break
+
+                time.sleep(random.uniform(0, self.BATCH_BASE_DELAY * 2 ** attempt))
+            else:
+                raise Exception(f"Couldn't write to {table_name}. {len(request_items[table_name])} requests were still unprocessed.")
+
+    def __batch_get_artist_history(self, keys):
+        """
+        Reads up to 100 artist history items. DDB can hand back some of the keys unread when it's throttling, so those
+        are asked for again with a backoff.
+        """
+        request_items = {
+            self.ARTIST_HISTORY_TABLE: {
+                'Keys': keys,
+                'ProjectionExpression': 'id, last_used'
+            }
+        }
+        items = []
+
+        for attempt in range(self.BATCH_ATTEMPTS):
+            batch_response = self.ddb_resource.batch_get_item(RequestItems=request_items, ReturnConsumedCapacity='TOTAL')
+            current_consumed_capacity().add(batch_response)
+            items.extend(batch_response['Responses'].get(self.ARTIST_HISTORY_TABLE, []))
+
+            request_items = batch_response.get('UnprocessedKeys')
+            if not request_items:
+                return items
+
+            time.sleep(random.uniform(0, self.BATCH_BASE_DELAY * 2 ** attempt))
+
+        raise Exception(f"Couldn't read the artist history. {len(request_items[self.ARTIST_HISTORY_TABLE]['Keys'])} keys were still unprocessed.")
+
+    def __load_song_history_filter(self):
+        """
+        :return: A tuple of the stored filter (or None) and its version
+        """
+        filter_response = self.song_history_table.get_item(
+            Key={
+                'id': self.SONG_HISTORY_FILTER_ID
+            },
+            ConsistentRead=True,
+            ReturnConsumedCapacity='TOTAL'
+        )
+        current_consumed_capacity().add(filter_response)
+
+        if 'Item' not in filter_response:
+            return None, None
+
+        filter_item = filter_response['Item']
+        # boto3 wraps binary attributes in its own Binary type
+        filter_bytes = getattr(filter_item['filter'], 'value', filter_item['filter'])
+
+        return BloomFilter.from_bytes(filter_bytes), filter_item['version']
+
+    def __save_song_history_filter(self, song_filter, expected_version):
+        """
+        Saves the filter, as long as nobody else has saved a different version since we loaded it.
+        :return: Whether the filter was saved
+        """
+        condition_kwargs = {
+            'ConditionExpression': 'attribute_not_exists(id)'
+        }
+        if expected_version is not None:
+            condition_kwargs = {
+                'ConditionExpression': 'version = :expected_version',
+                'ExpressionAttributeValues': {
+                    ':expected_version': expected_version
+                }
+            }
+
+        try:
+            filter_put_response = self.song_history_table.put_item(
+                Item={
+                    'id': self.SONG_HISTORY_FILTER_ID,
+                    'filter': song_filter.to_bytes(),
+                    'version': (expected_version or 0) + 1
+                },
+                ReturnConsumedCapacity='TOTAL',
+                **condition_kwargs
+            )
+            current_consumed_capacity().add(filter_put_response)
+            return True
+        except self.ddb_resource.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def __load_selection_queue(self, queue_name):
+        """
+        :return: A tuple of the queued selections and the queue's version, which is None if there's no queue yet
+        """
+        try:
+            queue_response = self.selection_queue_table.get_item(
+                Key={
+                    'id': queue_name
+                },
+                ConsistentRead=True,
+                ReturnConsumedCapacity='TOTAL'
+            )
+        except self.client.exceptions.ResourceNotFoundException:
+            # The queue is opt-in, so deployments that never pre-generate selections don't have the table
+            return [], None
+        current_consumed_capacity().add(queue_response)
+
+        if 'Item' not in queue_response:
+            return [], None
+
+        queue_item = queue_response['Item']
+        selections = [
+            [Song.from_dict(track) for track in selection]
+            for selection in json_backend.loads(queue_item['selections'])
+        ]
+
+        return selections, queue_item['version']
+
+    def __rebuild_song_history_filter(self):
+        used_song_ids = self.load_used_songs()
+        song_filter = BloomFilter.for_capacity(
+            max(self.SONG_HISTORY_FILTER_MIN_CAPACITY, 2 * len(used_song_ids)),
+            self.SONG_HISTORY_FILTER_ERROR_RATE
+        )
+        song_filter.update(used_song_ids)
+
+        _, version = self.__load_song_history_filter()
+        self.__save_song_history_filter(song_filter, version)
+
+        return song_filter
+
+    def __add_to_song_history_filter(self, song_ids):
+        for _ in range(self.SONG_HISTORY_FILTER_WRITE_ATTEMPTS):
+            song_filter, version = self.__load_song_history_filter()
+
+            if song_filter is None or song_filter.is_saturated():
+                # The songs have already been written to the history table, so the rebuild picks them up
+                self.__rebuild_song_history_filter()
+                return
+
+            song_filter.update(song_ids)
+
+            if self.__save_song_history_filter(song_filter, version):
+                return
+
+        raise Exception("Couldn't update the song history filter. It was being modified concurrently.")
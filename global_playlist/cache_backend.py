@@ -0,0 +1,144 @@
+from global_playlist.metrics import timed_cache_operation
+from datetime import timedelta
+import abc
+
+class CacheBackend(abc.ABC):
+    """
+    Everything that the lambda stores between runs: app config, the user's token, each country's playlist, playlist
+    track listings, the song and artist history, and pre-generated selections. `DDBCache` keeps these in DynamoDB and
+    `SQLiteCache` keeps them in a local file, and `CacheLayer` can sit in front of either of them.
+    """
+    CLIENT_TOKEN_ID="client_token"
+    # How long artist history is kept for. This needs to be at least as long as any exclusion window that it's used for.
+    ARTIST_HISTORY_RETENTION = timedelta(days=90)
+
+    @abc.abstractmethod
+    def load_app_config(self):
+        """
+        :return: A map of config key: value
+        """
+
+    @abc.abstractmethod
+    def save_app_config(self, config):
+        """
+        Upserts the given map of config key: value
+        """
+
+    @abc.abstractmethod
+    def load_client_token(self):
+        """
+        :return: The user's `ClientToken`, or None if there isn't one
+        """
+
+    @abc.abstractmethod
+    def save_client_token(self, token):
+        pass
+
+    def load_playlists(self):
+        """
+        Retrieves a list of playlists from the cache.
+        """
+        playlists, _ = self.load_playlist_discovery()
+        return playlists
+
+    @abc.abstractmethod
+    def load_playlist_discovery(self):
+        """
+        :return: A tuple of the list of playlists and a map of country_id: when it was last searched without a result
+        """
+
+    @abc.abstractmethod
+    def save_playlists(self, playlists):
+        """
+        Upserts the given playlists, one per country
+        """
+
+    @abc.abstractmethod
+    def save_missing_playlists(self, country_ids, verified_at):
+        """
+        Records that the given countries were searched and don't have a playlist, replacing any playlist that they had.
+        """
+
+    @abc.abstractmethod
+    def delete_playlists(self, country_ids):
+        pass
+
+    @abc.abstractmethod
+    def load_playlist_tracks(self, playlist_id):
+        """
+        :return: A tuple of the snapshot ID the songs were cached at and the songs, or None if there's nothing cached
+        """
+
+    @abc.abstractmethod
+    def save_playlist_tracks(self, playlist_id, snapshot_id, songs):
+        pass
+
+    @timed_cache_operation
+    def load_used_songs(self):
+        """
+        Loads the list of previously used songs. This reads the whole history, so prefer `load_used_song_filter` for
+        membership checks.
+        :return A list of song Ids
+        """
+        return list(self.iter_used_songs())
+
+    @abc.abstractmethod
+    def iter_used_songs(self):
+        """
+        Streams the IDs of previously used songs
+        """
+
+    @abc.abstractmethod
+    def load_used_song_filter(self):
+        """
+        :return: Something that answers `song_id in filter` for previously used songs (without ever missing one), and
+            that has an `update(song_ids)` method for adding to it in memory
+        """
+
+    @abc.abstractmethod
+    def add_used_songs(self, songs):
+        """
+        Saves a list of songs, and their artists, so that they won't be used again
+        """
+
+    @abc.abstractmethod
+    def load_recent_artists(self, artist_ids, since):
+        """
+        :return: A set of the IDs of the given artists that have been used since `since`
+        """
+
+    @abc.abstractmethod
+    def load_queued_selections(self, queue_name):
+        """
+        :return: The selections that were generated ahead of time for a playlist, oldest first, as a list of lists of songs
+        """
+
+    @abc.abstractmethod
+    def update_queued_selections(self, queue_name, update):
+        """
+        Applies `update` to a playlist's queued selections and saves what it returns, without losing anyone else's
+        change to the queue in the meantime. `update` returns the list that it was given when there's nothing to change.
+        """
+
+    @timed_cache_operation
+    def add_queued_selections(self, queue_name, selections):
+        """
+        Adds song selections to the end of a playlist's queue
+        """
+        self.update_queued_selections(queue_name, lambda queued: queued + [list(songs) for songs in selections])
+
+    @timed_cache_operation
+    def remove_queued_selection(self, queue_name, songs):
+        """
+        Removes a selection from a playlist's queue once it's been used. Nothing happens if it's no longer there, e.g.
+        because another run used it first.
+        """
+        song_ids = [song.id for song in songs]
+
+        def remove(queued):
+            for i, queued_songs in enumerate(queued):
+                if [song.id for song in queued_songs] == song_ids:
+                    return queued[:i] + queued[i + 1:]
+            return queued
+
+        self.update_queued_selections(queue_name, remove)
@@ -0,0 +1,149 @@
+import threading, time
+from collections import OrderedDict
+
+class CacheLayer:
+    """
+    An in-process, read-through and write-through cache in front of a `CacheBackend` (usually `DDBCache`). Reads are
+    answered from memory until their table's TTL runs out, and writes go to the backend and update the in-memory copy at
+    the same time. Anything that isn't cached here is passed straight through to the wrapped cache.
+
+    Playlist track listings aren't cached here, since `TrackListingCache` already keeps those in memory.
+    """
+    CONFIG = 'config'
+    TOKENS = 'tokens'
+    PLAYLISTS = 'playlists'
+    SONG_HISTORY = 'song_history'
+    TABLES = [CONFIG, TOKENS, PLAYLISTS, SONG_HISTORY]
+
+    # Seconds before a cached read goes back to the backend
+    DEFAULT_TTLS = {
+        CONFIG: 60 * 60,
+        TOKENS: 5 * 60,
+        PLAYLISTS: 60 * 60,
+        SONG_HISTORY: 10 * 60
+    }
+
+    def __init__(self, cache, ttls = None, max_entries = 256, clock = time.monotonic):
+        """
+        :param cache: The `CacheBackend` to wrap
+        :param ttls: A map of table: TTL in seconds, overriding the defaults
+        :param max_entries: The most entries that are kept at once. The least recently used are evicted first.
+        """
+        self.cache = cache
+        self.ttls = {**self.DEFAULT_TTLS, **(ttls or {})}
+        self.max_entries = max_entries
+        self.clock = clock
+        # (table, key): (value, expires_at)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # Only called for attributes that aren't defined here, so everything else goes straight to the backend
+        return getattr(self.cache, name)
+
+    def load_app_config(self):
+        return self.__read_through(self.CONFIG, None, self.cache.load_app_config)
+
+    def save_app_config(self, config):
+        self.cache.save_app_config(config)
+        self.invalidate(self.CONFIG)
+
+    def load_client_token(self):
+        return self.__read_through(self.TOKENS, self.cache.CLIENT_TOKEN_ID, self.cache.load_client_token)
+
+    def save_client_token(self, token):
+        self.cache.save_client_token(token)
+        self.__store(self.TOKENS, self.cache.CLIENT_TOKEN_ID, token)
+
+    def load_playlists(self):
+        playlists, _ = self.load_playlist_discovery()
+        return playlists
+
+    def load_playlist_discovery(self):
+        playlists, missing_playlists = self.__read_through(self.PLAYLISTS, None, self.cache.load_playlist_discovery)
+        return list(playlists), dict(missing_playlists)
+
+    def save_playlists(self, playlists):
+        self.cache.save_playlists(playlists)
+
+        cached_discovery = self.__cached(self.PLAYLISTS, None)
+        if cached_discovery is not None:
+            # Upsert by country, the same way the table does
+            cached_playlists, cached_missing_playlists = cached_discovery
+            saved_country_ids = set(playlist.country_id for playlist in playlists)
+            self.__store(self.PLAYLISTS, None, (
+                [p for p in cached_playlists if p.country_id not in saved_country_ids] + list(playlists),
+                {country_id: verified_at for country_id, verified_at in cached_missing_playlists.items() if country_id not in saved_country_ids}
+            ))
+
+    def save_missing_playlists(self, country_ids, verified_at):
+        self.cache.save_missing_playlists(country_ids, verified_at)
+
+        cached_discovery = self.__cached(self.PLAYLISTS, None)
+        if cached_discovery is not None:
+            cached_playlists, cached_missing_playlists = cached_discovery
+            saved_country_ids = set(country_ids)
+            self.__store(self.PLAYLISTS, None, (
+                [p for p in cached_playlists if p.country_id not in saved_country_ids],
+                {**cached_missing_playlists, **{country_id: verified_at for country_id in country_ids}}
+            ))
+
+    def delete_playlists(self, country_ids):
+        self.cache.delete_playlists(country_ids)
+        self.invalidate(self.PLAYLISTS)
+
+    def load_used_song_filter(self):
+        return self.__read_through(self.SONG_HISTORY, None, self.cache.load_used_song_filter)
+
+    def add_used_songs(self, songs):
+        self.cache.add_used_songs(songs)
+
+        song_filter = self.__cached(self.SONG_HISTORY, None)
+        if song_filter is not None:
+            song_filter.update([song.id for song in songs])
+
+    def invalidate(self, table = None, key = None):
+        """
+        Drops cached values so that the next read goes back to the backend.
+
+        :param table: The table to invalidate (one of `TABLES`). Everything is invalidated if this isn't given.
+        :param key: A single key in the table to invalidate. Tables that are cached as a whole (config, playlists and
+            the song history) are dropped entirely.
+        """
+        if table is not None and table not in self.TABLES:
+            raise Exception(f"Can't invalidate unknown table '{table}'. Expected one of {self.TABLES}")
+
+        with self.lock:
+            for entry_table, entry_key in list(self.entries.keys()):
+                if table is None or (entry_table == table and (key is None or entry_key in (key, None))):
+                    del self.entries[(entry_table, entry_key)]
+
+# ---------------- ---------------- ---------------------#
+# ----------------     private      ---------------------#
+# ---------------- ---------------- ---------------------#
+
+    def __read_through(self, table, key, load):
+        with self.lock:
+            entry = self.entries.get((table, key))
+            if entry and self.clock() < entry[1]:
+                self.entries.move_to_end((table, key))
+                return entry[0]
+
+        value = load()
+        # Misses aren't cached, so that e.g. a missing token is looked up again next time
+        if value is not None:
+            self.__store(table, key, value)
+        return value
+
+    def __cached(self, table, key):
+        with self.lock:
+            entry = self.entries.get((table, key))
+            return entry[0] if entry and self.clock() < entry[1] else None
+
+    def __store(self, table, key, value):
+        with self.lock:
+            self.entries[(table, key)] = (value, self.clock() + self.ttls[table])
+            self.entries.move_to_end((table, key))
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
@@ -0,0 +1,250 @@
+import mmap, os, struct, tempfile, time
+from datetime import datetime
+from global_playlist.data_types import Playlist, Song
+
+class CatalogSnapshot:
+    """
+    A read-only, on-disk copy of everything that `SongProvider` gathers: the regional playlists and the songs in each of
+    them. The file is memory-mapped, so opening it only reads the header and the playlist records. A playlist's songs
+    are only read from disk when they're asked for.
+
+    The layout is a header followed by four sections, all little-endian:
+        - Playlist records, one `PLAYLIST_RECORD` each
+        - Song records, one `SONG_RECORD` each. Each playlist's songs are a run of these.
+        - Artist records, one `ARTIST_RECORD` each. Each song's artists are a run of these.
+        - A string table: `STRING_OFFSET` offsets (one more than there are strings) into a block of UTF-8 data.
+    Every string is stored once, and records refer to strings by their index in the table.
+    """
+    MAGIC = b'GPCS'
+    VERSION = 1
+    # magic, version, created at, playlist count, song count, artist count, string count
+    HEADER = struct.Struct('<4sBdIIII')
+    # id, name, owner, country ID, verified at, fetched at, first song, song count
+    PLAYLIST_RECORD = struct.Struct('<IIIIddII')
+    # id, name, uri, first artist, artist count
+    SONG_RECORD = struct.Struct('<IIIIH')
+    # id, name
+    ARTIST_RECORD = struct.Struct('<II')
+    STRING_OFFSET = struct.Struct('<Q')
+    # Stands in for a song's URI when it's the usual spotify:track:<id>, and for a missing verified at time
+    NO_STRING = 0xFFFFFFFF
+    NO_TIME = -1.0
+
+    def __init__(self, path):
+        """
+        Opens an existing snapshot. Use `write` to create one.
+        """
+        self.path = path
+        with open(path, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, created_at, playlist_count, song_count, artist_count, string_count = self.HEADER.unpack_from(self.data)
+
+        if magic != self.MAGIC or version != self.VERSION:
+            self.data.close()
+            raise Exception(f"Unrecognised catalog snapshot format in {path}: {magic} v{version}")
+
+        self.created_at = datetime.fromtimestamp(created_at)
+        self.playlist_count = playlist_count
+        self.song_count = song_count
+        self.__songs_start = self.HEADER.size + playlist_count * self.PLAYLIST_RECORD.size
+        self.__artists_start = self.__songs_start + song_count * self.SONG_RECORD.size
+        self.__string_offsets_start = self.__artists_start + artist_count * self.ARTIST_RECORD.size
+        self.__strings_start = self.__string_offsets_start + (string_count + 1) * self.STRING_OFFSET.size
+        self.__strings = {}
+        # playlist ID: songs, for the playlists that have been read so far
+        self.__songs = {}
+
+        # playlist ID: (Playlist, fetched at, first song, song count)
+        self.__playlists = {}
+        for i in range(playlist_count):
+            id, name, owner, country_id, verified_at, fetched_at, first_song, playlist_song_count = self.PLAYLIST_RECORD.unpack_from(
+                self.data,
+                self.HEADER.size + i * self.PLAYLIST_RECORD.size
+            )
+            playlist = Playlist(
+                self.__string(id),
+                self.__string(name),
+                self.__string(owner),
+                self.__string(country_id),
+                datetime.fromtimestamp(verified_at) if verified_at != self.NO_TIME else None
+            )
+            self.__playlists[playlist.id] = (playlist, datetime.fromtimestamp(fetched_at), first_song, playlist_song_count)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.data.close()
+
+    def playlists(self):
+        return [entry[0] for entry in self.__playlists.values()]
+
+    def fetched_at(self, playlist_id):
+        """
+        :return: When the playlist's songs were fetched, or None if the playlist isn't in the snapshot
+        """
+        entry = self.__playlists.get(playlist_id)
+        return entry[1] if entry else None
+
+    def songs(self, playlist_id):
+        """
+        Reads a playlist's songs from the snapshot. Each playlist is only decoded once, and later reads share its songs.
+        :return: The songs, or None if the playlist isn't in the snapshot
+        """
+        songs = self.__songs.get(playlist_id)
+        if songs is not None:
+            return songs
+
+        entry = self.__playlists.get(playlist_id)
+        if not entry:
+            return None
+
+        _, _, first_song, song_count = entry
+        songs = []
+
+        for i in range(first_song, first_song + song_count):
+            id, name, uri, first_artist, artist_count = self.SONG_RECORD.unpack_from(self.data, self.__songs_start + i * self.SONG_RECORD.size)
+            artists = [
+                self.ARTIST_RECORD.unpack_from(self.data, self.__artists_start + a * self.ARTIST_RECORD.size)
+                for a in range(first_artist, first_artist + artist_count)
+            ]
+            song_id = self.__string(id)
+
+            songs.append(Song(
+                song_id,
+                self.__string(name),
+                Song.URI_PREFIX + song_id if uri == self.NO_STRING else self.__string(uri),
+                [self.__string(artist_id) for artist_id, _ in artists],
+                [self.__string(artist_name) for _, artist_name in artists]
+            ))
+
+        self.__songs[playlist_id] = songs
+        return songs
+
+    @classmethod
+    def write(cls, path, entries, created_at = None):
+        """
+        Writes a new snapshot. The file is written next to `path` first and then moved into place, so that a reader
+        never sees a half-written snapshot.
+
+        :param entries: A list of (Playlist, songs, fetched at) tuples
+        :param created_at: When the snapshot was taken. Defaults to now.
+        """
+        strings = {}
+        def string_index(value):
+            return strings.setdefault(value, len(strings))
+
+        playlist_records = []
+        song_records = []
+        artist_records = []
+
+        for playlist, songs, fetched_at in entries:
+            playlist_records.append(cls.PLAYLIST_RECORD.pack(
+                string_index(playlist.id),
+                string_index(playlist.name),
+                string_index(playlist.owner),
+                string_index(playlist.country_id),
+                playlist.verified_at.timestamp() if playlist.verified_at else cls.NO_TIME,
+                fetched_at.timestamp(),
+                len(song_records),
+                len(songs)
+            ))
+
+            for song in songs:
+                song_records.append(cls.SONG_RECORD.pack(
+                    string_index(song.id),
+                    string_index(song.name),
+                    cls.NO_STRING if song.uri == Song.URI_PREFIX + song.id else string_index(song.uri),
+                    len(artist_records),
+                    len(song.artist_ids)
+                ))
+                artist_records.extend(
+                    cls.ARTIST_RECORD.pack(string_index(artist_id), string_index(artist_name))
+                    for artist_id, artist_name in zip(song.artist_ids, song.artist_names)
+                )
+
+        encoded_strings = [value.encode('utf-8') for value in strings.keys()]
+        string_offsets = [0]
+        for encoded in encoded_strings:
+            string_offsets.append(string_offsets[-1] + len(encoded))
+
+        header = cls.HEADER.pack(
+            cls.MAGIC,
+            cls.VERSION,
+            (created_at or datetime.now()).timestamp(),
+            len(playlist_records),
+            len(song_records),
+            len(artist_records),
+            len(encoded_strings)
+        )
+
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as file:
+            file.write(header)
+            file.write(b''.join(playlist_records))
+            file.write(b''.join(song_records))
+            file.write(b''.join(artist_records))
+            file.write(b''.join(cls.STRING_OFFSET.pack(offset) for offset in string_offsets))
+            file.write(b''.join(encoded_strings))
+
+        os.replace(file.name, path)
+
+# ---------------- ---------------- ---------------------#
+# ----------------     private      ---------------------#
+# ---------------- ---------------- ---------------------#
+
+    def __string(self, index):
+        # Artists, owners and countries repeat a lot, so each string is only decoded once
+        value = self.__strings.get(index)
+        if value is None:
+            start, end = struct.unpack_from('<QQ', self.data, self.__string_offsets_start + index * self.STRING_OFFSET.size)
+            value = str(self.data[self.__strings_start + start:self.__strings_start + end], 'utf-8')
+            self.__strings[index] = value
+        return value
+
+def load_catalog_snapshot(location, download_dir = '/tmp'):
+    """
+    Opens the snapshot at `location`, which is either a local path or an s3://bucket/key URL. Snapshots in S3 are
+    downloaded first.
+
+    :return: The opened `CatalogSnapshot`, or None if there's no snapshot at `location`
+    """
+    if not location:
+        return None
+
+    if location.startswith('s3://'):
+        bucket, _, key = location[len('s3://'):].partition('/')
+        local_path = os.path.join(download_dir, os.path.basename(key))
+
+        # boto3 is only needed if the snapshot lives in S3
+        import boto3
+        started = time.perf_counter()
+        try:
+            boto3.client('s3').download_file(bucket, key, local_path)
+        except Exception as e:
+            print(f"Couldn't download the catalog snapshot from {location}: {e}")
+            return None
+        print(f"Downloaded the catalog snapshot from {location} in {time.perf_counter() - started:.2f}s")
+        location = local_path
+
+    if not os.path.exists(location):
+        print(f"No catalog snapshot at {location}")
+        return None
+
+    return CatalogSnapshot(location)
+
+def upload_catalog_snapshot(path, location):
+    """
+    Copies a snapshot that was written to `path` to `location`, if that's an s3://bucket/key URL
+    """
+    if not location.startswith('s3://'):
+        return
+
+    bucket, _, key = location[len('s3://'):].partition('/')
+
+    import boto3
+    boto3.client('s3').upload_file(path, bucket, key)
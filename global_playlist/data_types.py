@@ -1,9 +1,15 @@
+import sys
+
+_intern = sys.intern
+
 class Playlist:
-    def __init__(self, id, name, owner, country_id):
+    def __init__(self, id, name, owner, country_id, verified_at = None):
         self.id = id
         self.name = name
         self.owner = owner
         self.country_id = country_id
+        # When we last searched for this country's playlist and found this one. None if it hasn't been cached yet.
+        self.verified_at = verified_at
     
     def __str__(self):
         return f"[{self.id}] '{self.name}' by '{self.owner}' ({self.country_id})"
@@ -20,19 +26,110 @@ class Playlist:
         }
 
 class Song:
+    # We hold every track of every regional playlist at once, so songs skip the per-instance __dict__
+    __slots__ = ('id', 'name', '_uri', 'artist_ids', 'artist_names')
+
+    URI_PREFIX = 'spotify:track:'
+
     def __init__(self, id, name, uri, artist_ids, artist_names):
         self.id = id
         self.name = name
-        self.uri = uri
+        # Almost every URI is just the ID with a prefix, so it's only stored when it's something else
+        self._uri = None if uri == self.URI_PREFIX + id else uri
         # Not super great to store these like this, since there's nothing linking IDs to names,
         # but for now I only use the names when I want some human-readable version of a given
         # song's artists, so this is fine.
-        self.artist_ids = artist_ids
-        self.artist_names = artist_names
+        # The same artists show up across lots of playlists, so each distinct string is only kept once.
+        self.artist_ids = tuple(map(_intern, artist_ids))
+        self.artist_names = tuple(map(_intern, artist_names))
+
+    @classmethod
+    def from_track(cls, track):
+        """
+        Makes a song from a track object from the API. Every track of every listing goes through here, so the slots are
+        filled in directly rather than through `__init__`, and most tracks (which only have one artist) skip building
+        lists of their artists.
+        """
+        song = cls.__new__(cls)
+        song.id = track['id']
+        song.name = track['name']
+        uri = track['uri']
+        song._uri = None if uri == cls.URI_PREFIX + song.id else uri
+
+        artists = track['artists']
+        if len(artists) == 1:
+            artist = artists[0]
+            song.artist_ids = (_intern(artist['id']),)
+            song.artist_names = (_intern(artist['name']),)
+        else:
+            song.artist_ids = tuple([_intern(artist['id']) for artist in artists])
+            song.artist_names = tuple([_intern(artist['name']) for artist in artists])
+
+        return song
+
+    @property
+    def uri(self):
+        return self._uri or self.URI_PREFIX + self.id
 
     def __str__(self):
         return f"[{self.id}] {self.name} ({','.join(self.artist_names)})"
 
+    def dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'uri': self.uri,
+            'artist_ids': list(self.artist_ids),
+            'artist_names': list(self.artist_names)
+        }
+
+    @staticmethod
+    def from_dict(song_dict):
+        return Song(song_dict['id'], song_dict['name'], song_dict['uri'], song_dict['artist_ids'], song_dict['artist_names'])
+
+class PlaylistTarget:
+    """
+    A playlist that we want to build, and the rules for which regional playlists its songs can come from
+    """
+    def __init__(self, name, size, country_ids = None, languages = None, description = None):
+        """
+        :param name: The name of the playlist in the user's account
+        :param size: The number of songs to put in the playlist
+        :param country_ids: If set, songs only come from the playlists of these countries
+        :param languages: If set, songs only come from the playlists of markets with these (ISO 639-1) languages
+        :param description: The description to give the playlist if it has to be created
+        """
+        self.name = name
+        self.size = size
+        self.country_ids = set(country_ids) if country_ids else None
+        self.languages = set(languages) if languages else None
+        self.description = description
+
+    def __str__(self):
+        return f"'{self.name}' ({self.size} songs)"
+
+    def accepts(self, playlist, market_languages):
+        """
+        Whether songs from the given regional playlist can be used for this target
+
+        :param market_languages: A map of country code: language code
+        """
+        if self.country_ids is not None and playlist.country_id not in self.country_ids:
+            return False
+        if self.languages is not None and market_languages.get(playlist.country_id) not in self.languages:
+            return False
+        return True
+
+    @staticmethod
+    def from_dict(target_dict):
+        return PlaylistTarget(
+            target_dict['name'],
+            int(target_dict['size']),
+            target_dict.get('countries'),
+            target_dict.get('languages'),
+            target_dict.get('description')
+        )
+
 class ClientToken:
     def __init__(self, token, refresh_token, expires_at):
         self.token = token
@@ -0,0 +1,72 @@
+import threading, time
+
+class DeadlineExceeded(Exception):
+    pass
+
+class Deadline:
+    """
+    The time that's left for an invocation. Every request's timeout is cut down to fit in it, and nothing new is sent
+    once it's run out, so that a slow API fails the run cleanly instead of Lambda killing it halfway through.
+    """
+    def __init__(self, seconds = None, clock = time.monotonic):
+        """
+        :param seconds: How long from now the deadline is. None means there isn't one.
+        """
+        self.clock = clock
+        self.expires_at = None if seconds is None else clock() + seconds
+
+    @staticmethod
+    def from_lambda_context(context, reserve = 0):
+        """
+        :param reserve: Seconds to hold back for what happens after the last request, e.g. emitting metrics
+        :return: A deadline that runs out `reserve` seconds before Lambda would stop the invocation, or no deadline if
+            there isn't a Lambda context (e.g. when running locally)
+        """
+        get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+        if get_remaining_time is None:
+            return Deadline()
+        return Deadline(max(0, get_remaining_time() / 1000 - reserve))
+
+    def remaining(self):
+        """
+        :return: Seconds left, or None if there's no deadline
+        """
+        if self.expires_at is None:
+            return None
+        return max(0, self.expires_at - self.clock())
+
+    def check(self, description):
+        """
+        Raises `DeadlineExceeded` if the deadline has passed
+        """
+        if self.remaining() == 0:
+            raise DeadlineExceeded(f"Ran out of time before {description}")
+
+    def timeout(self, default):
+        """
+        :param default: A timeout in seconds, or a (connect, read) tuple of them
+        :return: `default`, with every part of it cut down to the time that's left
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return default
+        if isinstance(default, tuple):
+            return tuple(min(part, remaining) for part in default)
+        return min(default, remaining)
+
+_current_deadline = Deadline()
+_current_deadline_lock = threading.Lock()
+
+def current_deadline():
+    return _current_deadline
+
+def reset_deadline(deadline = None):
+    """
+    Sets the deadline that every request is held to. Call this at the start of every invocation, since module state
+    lives on between warm invocations.
+    """
+    global _current_deadline
+
+    with _current_deadline_lock:
+        _current_deadline = deadline or Deadline()
+        return _current_deadline
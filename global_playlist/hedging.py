@@ -0,0 +1,172 @@
+import bisect, math, threading, time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from global_playlist.metrics import current_metrics
+
+class LatencyHistogram:
+    """
+    A thread-safe histogram of latencies in log-spaced buckets, from 1ms up to a minute. Percentiles are read from the
+    buckets, so they're only as precise as a bucket is wide (about 20%), but recording and reading are both cheap.
+    """
+    MIN_LATENCY = 0.001
+    MAX_LATENCY = 60
+    BUCKET_GROWTH = 1.2
+    # Once this many samples have been recorded, every count is halved, so that the histogram follows the API as it
+    # speeds up or slows down
+    MAX_SAMPLES = 10000
+
+    def __init__(self):
+        bucket_count = math.ceil(math.log(self.MAX_LATENCY / self.MIN_LATENCY, self.BUCKET_GROWTH)) + 1
+        # The upper bound of each bucket, in seconds
+        self.bounds = [self.MIN_LATENCY * self.BUCKET_GROWTH ** i for i in range(bucket_count)]
+        self.counts = [0] * (bucket_count + 1)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def record(self, latency):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.bounds, latency)] += 1
+            self.count += 1
+
+            if self.count >= self.MAX_SAMPLES:
+                self.counts = [count // 2 for count in self.counts]
+                self.count = sum(self.counts)
+
+    def percentile(self, percentile):
+        """
+        :param percentile: Between 0 and 100
+        :return: The upper bound of the bucket that the percentile falls in, in seconds, or None if nothing's been recorded
+        """
+        with self.lock:
+            if self.count == 0:
+                return None
+
+            rank = math.ceil(self.count * percentile / 100)
+            seen = 0
+            for i, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank:
+                    return self.bounds[min(i, len(self.bounds) - 1)]
+
+    def buckets(self):
+        """
+        :return: A list of (upper bound in seconds, count) tuples for the buckets that have anything in them. The last
+            bucket's bound is infinity.
+        """
+        with self.lock:
+            return [(bound, count) for bound, count in zip(self.bounds + [math.inf], self.counts) if count > 0]
+
+class RequestHedger:
+    """
+    Sends a second copy of a request when the first one is taking longer than most requests to the same endpoint do,
+    and uses whichever response comes back first. A request only waits as long as the slower tail of the endpoint's
+    latencies before it's hedged, so a single stalled connection doesn't hold the whole run up.
+
+    Only use this for requests that are safe to send twice. The copy that loses isn't cancelled, since requests can't
+    be, so it runs to completion in the background and its response is thrown away.
+    """
+    def __init__(self, percentile = 95, min_samples = 20, initial_threshold = 1.0, max_workers = 32, before_hedge = None, clock = time.perf_counter):
+        """
+        :param percentile: How slow a request has to be, as a percentile of its endpoint's latencies, before it's hedged
+        :param min_samples: How many of an endpoint's latencies have to be recorded before its percentile is used
+        :param initial_threshold: Seconds before a request is hedged until then. None means it isn't hedged at all.
+        :param max_workers: The most requests (including hedges) that can be in flight at once
+        :param before_hedge: Called before a hedge is sent, e.g. to take a token from a rate limiter. It can block.
+        """
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.initial_threshold = initial_threshold
+        self.before_hedge = before_hedge
+        self.clock = clock
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hedge')
+        # endpoint: LatencyHistogram
+        self.histograms = {}
+        # endpoint: {requests, hedged, hedge_wins}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def send(self, endpoint, send):
+        """
+        :param endpoint: The endpoint that the request is for, e.g. "GET /playlists/{id}". Latencies are tracked per
+            endpoint.
+        :param send: A function that sends the request and returns the response
+        :return: The first response to come back
+        """
+        histogram, counts = self.__endpoint_stats(endpoint)
+        threshold = histogram.percentile(self.percentile) if histogram.count >= self.min_samples else self.initial_threshold
+
+        with self.lock:
+            counts['requests'] += 1
+
+        if threshold is None:
+            return self.__timed(histogram, send)
+
+        primary = self.executor.submit(self.__timed, histogram, send)
+        done, _ = wait([primary], timeout=threshold)
+        if done:
+            return primary.result()
+
+        with self.lock:
+            counts['hedged'] += 1
+
+        hedge = self.executor.submit(self.__hedge, histogram, send)
+        done, pending = wait([primary, hedge], return_when=FIRST_COMPLETED)
+        winner = done.pop()
+
+        # If the first one to finish failed, the other one might still work
+        if winner.exception() is not None and len(pending) > 0:
+            winner = pending.pop()
+            winner.exception()
+
+        hedge_won = winner is hedge and winner.exception() is None
+        if hedge_won:
+            with self.lock:
+                counts['hedge_wins'] += 1
+        current_metrics().record_hedge(endpoint, hedge_won)
+
+        return winner.result()
+
+    def stats(self):
+        """
+        :return: A map of endpoint: {requests, hedged, hedge_wins, hedge_rate, p50, p95, p99}, with latencies in
+            milliseconds
+        """
+        with self.lock:
+            endpoints = [(endpoint, dict(counts), self.histograms[endpoint]) for endpoint, counts in self.counts.items()]
+
+        stats = {}
+        for endpoint, counts, histogram in endpoints:
+            percentiles = dict((f"p{p}", histogram.percentile(p)) for p in (50, 95, 99))
+            stats[endpoint] = {
+                **counts,
+                'hedge_rate': round(counts['hedged'] / max(1, counts['requests']), 4),
+                **dict((name, None if value is None else round(value * 1000, 1)) for name, value in percentiles.items())
+            }
+        return stats
+
+    def histogram(self, endpoint):
+        with self.lock:
+            return self.histograms.get(endpoint)
+
+# ---------------- ---------------- ---------------------#
+# ----------------     private      ---------------------#
+# ---------------- ---------------- ---------------------#
+
+    def __endpoint_stats(self, endpoint):
+        with self.lock:
+            if endpoint not in self.histograms:
+                self.histograms[endpoint] = LatencyHistogram()
+                self.counts[endpoint] = {'requests': 0, 'hedged': 0, 'hedge_wins': 0}
+            return self.histograms[endpoint], self.counts[endpoint]
+
+    def __timed(self, histogram, send):
+        # Every copy's own latency is recorded, including the ones that lose, so that hedging doesn't hide how slow the
+        # endpoint really is
+        started = self.clock()
+        response = send()
+        histogram.record(self.clock() - started)
+        return response
+
+    def __hedge(self, histogram, send):
+        if self.before_hedge:
+            self.before_hedge()
+        return self.__timed(histogram, send)
@@ -0,0 +1,73 @@
+import threading
+from global_playlist.deadline import current_deadline
+
+class HttpTransport:
+    """
+    A thin wrapper around a pooled `requests.Session`. Connections are kept alive between calls, so we only pay for the
+    TCP and TLS handshakes once per host instead of once per request.
+    """
+    DEFAULT_POOL_SIZE = 16
+    # (connect, read) in seconds
+    DEFAULT_TIMEOUT = (3.05, 15)
+
+    def __init__(self, pool_size = DEFAULT_POOL_SIZE, timeout = DEFAULT_TIMEOUT):
+        """
+        :param pool_size: The maximum number of connections that are kept open per host. This should be at least as large
+            as the number of threads that make requests at the same time.
+        :param timeout: The default timeout for requests, either a number of seconds or a (connect, read) tuple
+        """
+        # requests is imported here rather than at the top of the module, so that importing the package doesn't pay
+        # for it until the first client actually needs to make a request
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        # Spotify's JSON compresses to a fraction of its size. requests decompresses it transparently.
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+        # Retries are handled by the caller, so the adapter shouldn't do any of its own
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, timeout = None, **kwargs):
+        """
+        Sends a request over the pooled session. Takes the same keyword arguments as `requests.request`. The timeout is
+        cut down to whatever is left of the invocation's deadline.
+        """
+        deadline = current_deadline()
+        deadline.check(f"{method} {url}")
+
+        return self.session.request(method, url, timeout=deadline.timeout(timeout or self.timeout), **kwargs)
+
+    def close(self):
+        self.session.close()
+
+def wire_bytes(response):
+    """
+    :return: The size of the response body as it came over the wire. That's smaller than `response.content` when the
+        response was compressed.
+    """
+    content_length = len(response.content or b'')
+    try:
+        # urllib3 counts the bytes it reads off the socket, before they're decompressed
+        return response.raw.tell() or content_length
+    except (AttributeError, OSError):
+        return content_length
+
+_shared_transport = None
+_shared_transport_lock = threading.Lock()
+
+def shared_transport():
+    """
+    Returns a transport that's shared by everything in this process. Since it lives at the module level, it (and its open
+    connections) survive between warm Lambda invocations.
+    """
+    global _shared_transport
+
+    with _shared_transport_lock:
+        if _shared_transport is None:
+            _shared_transport = HttpTransport()
+        return _shared_transport
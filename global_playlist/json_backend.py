@@ -0,0 +1,29 @@
+"""
+JSON parsing and serialising that uses orjson when it's installed. orjson parses the big track listings that Spotify
+sends back several times faster, but everything works the same with the standard library.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Which backend is in use, for logs and benchmarks
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+def loads(data):
+    """
+    :param data: A str or bytes. Passing a response's raw bytes saves decoding them to a str first.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(value):
+    """
+    Serialises to a compact str, leaving non-ASCII characters as they are
+    """
+    if orjson is not None:
+        return orjson.dumps(value).decode('utf-8')
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
@@ -0,0 +1,91 @@
+import os, json, random
+
+MARKET_LANGUAGES_PATH = os.path.join(os.path.dirname(__file__), '..', 'resources', 'market_languages.json')
+
+def load_market_languages(path = MARKET_LANGUAGES_PATH):
+    """
+    Loads the precomputed map of ISO 3166 country code: ISO 639-1 code of the main language of that market's charts
+    """
+    with open(path) as file:
+        return json.load(file)
+
+class LanguageQuotaSelector:
+    """
+    Chooses songs from a pool of candidate playlists while capping how many songs come from each language, so that the
+    languages with the most markets (Spanish, English, ...) don't crowd out everything else.
+
+    Selection follows the same rules as `SongProvider.get_random_global_songs`: at most one song per playlist, no
+    artist shows up twice, and previously used songs are skipped. Candidates are shuffled lazily and checked in that
+    order, so only the songs that are actually looked at are shuffled or checked against the history.
+    """
+    UNKNOWN_LANGUAGE = '??'
+
+    def __init__(self, market_languages, language_quotas, default_quota = None):
+        """
+        :param market_languages: A map of country code: language code
+        :param language_quotas: A map of language code: the most songs that can be chosen in that language
+        :param default_quota: The most songs that can be chosen for any language without its own quota. None means no limit.
+        """
+        self.market_languages = market_languages
+        self.language_quotas = language_quotas
+        self.default_quota = default_quota
+
+    def select(self, candidates, count, rejected_song_ids = (), rejected_artist_ids = (), rng = None):
+        """
+        :param candidates: A list of (Playlist, songs) tuples
+        :param count: The number of songs to choose
+        :param rejected_song_ids: Anything supporting `in` (a set, a `BloomFilter`, ...) of song IDs that can't be chosen
+        :param rejected_artist_ids: Artist IDs whose songs can't be chosen
+        :param rng: A `random.Random` to draw from, for repeatable selections
+        :return: The chosen songs
+        """
+        rng = rng or random.Random()
+
+        if count <= 0:
+            return []
+
+        languages = [self.market_languages.get(playlist.country_id, self.UNKNOWN_LANGUAGE) for playlist, _ in candidates]
+        quotas = dict((language, self.language_quotas.get(language, self.default_quota)) for language in set(languages))
+        quotas = dict((language, count if quota is None else quota) for language, quota in quotas.items())
+        # How many playlists in each language haven't had a song chosen yet
+        unused_playlists = {}
+        for language in languages:
+            unused_playlists[language] = unused_playlists.get(language, 0) + 1
+        # How many playlists a song could still be chosen from
+        open_playlist_count = sum(unused for language, unused in unused_playlists.items() if quotas[language] > 0)
+
+        # Each song is a (playlist, position in the playlist) pair, so nothing is copied until it's looked at
+        pool = [(playlist, position) for playlist, (_, playlist_songs) in enumerate(candidates) for position in range(len(playlist_songs))]
+        used_artists = set(rejected_artist_ids)
+        used_playlists = set()
+        chosen = []
+
+        for i in range(len(pool)):
+            # Stop once nothing that's left could be chosen, rather than going through the rest of the songs
+            if len(chosen) >= count or open_playlist_count == 0:
+                break
+
+            # One step of a Fisher-Yates shuffle, so the songs come out in a uniformly random order
+            j = rng.randrange(i, len(pool))
+            pool[i], pool[j] = pool[j], pool[i]
+            playlist, position = pool[i]
+
+            language = languages[playlist]
+            if playlist in used_playlists or quotas[language] <= 0:
+                continue
+
+            song = candidates[playlist][1][position]
+            # The history is checked last, since it's the slowest check
+            if not used_artists.isdisjoint(song.artist_ids) or song.id in rejected_song_ids:
+                continue
+
+            chosen.append(song)
+            used_playlists.add(playlist)
+            unused_playlists[language] -= 1
+            open_playlist_count -= 1
+            quotas[language] -= 1
+            if quotas[language] == 0:
+                open_playlist_count -= unused_playlists[language]
+            used_artists.update(song.artist_ids)
+
+        return chosen
@@ -0,0 +1,214 @@
+import functools, json, re, threading, time
+from contextlib import contextmanager
+
+class Metrics:
+    """
+    Collects the measurements for a single invocation: every Spotify request, every cache operation, and how long each
+    phase of the run took. `emit` writes them out as CloudWatch Embedded Metric Format (EMF) log lines, which CloudWatch
+    turns into metrics without any extra API calls.
+    """
+    NAMESPACE = 'GlobalPlaylist'
+    # EMF rejects a metric with more values than this in one record
+    MAX_METRIC_VALUES = 100
+
+    def __init__(self):
+        # endpoint: {calls, errors, retries, bytes, wire_bytes, hedged, hedge_wins, latencies, statuses}
+        self.requests = {}
+        # operation: {calls, errors, latencies, consumed_capacity}
+        self.cache_operations = {}
+        # phase: seconds
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def record_request(self, endpoint, latency, status, retries = 0, response_bytes = 0, wire_bytes = None):
+        """
+        :param endpoint: The request's method and templated path, e.g. "GET /playlists/{id}"
+        :param latency: Seconds from the first attempt to the final response, including retries
+        :param status: The final HTTP status, or None if no response came back
+        :param response_bytes: The size of the response body once it's been decompressed
+        :param wire_bytes: The size of the response body as it was sent. Defaults to `response_bytes`.
+        """
+        with self.lock:
+            stats = self.__request_stats(endpoint)
+            stats['calls'] += 1
+            stats['retries'] += retries
+            stats['bytes'] += response_bytes
+            stats['wire_bytes'] += response_bytes if wire_bytes is None else wire_bytes
+            stats['latencies'].append(latency)
+            stats['statuses'][str(status)] = stats['statuses'].get(str(status), 0) + 1
+            if status is None or status >= 400:
+                stats['errors'] += 1
+
+    def record_hedge(self, endpoint, won):
+        """
+        Records that a second copy of a request was sent because the first was slow
+        :param won: Whether the second copy's response was the one that got used
+        """
+        with self.lock:
+            stats = self.__request_stats(endpoint)
+            stats['hedged'] += 1
+            stats['hedge_wins'] += won
+
+    def record_cache_operation(self, operation, latency, error = False, consumed_capacity = 0):
+        with self.lock:
+            stats = self.cache_operations.setdefault(operation, {'calls': 0, 'errors': 0, 'latencies': [], 'consumed_capacity': 0})
+            stats['calls'] += 1
+            stats['latencies'].append(latency)
+            stats['consumed_capacity'] += consumed_capacity
+            if error:
+                stats['errors'] += 1
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times the code in the `with` block as a phase of the invocation
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - started
+
+    def records(self, invocation_id = None):
+        """
+        :return: A list of EMF records. There's one per endpoint, one per cache operation and one per phase. Endpoints
+            and operations with more than `MAX_METRIC_VALUES` calls have their other latencies in extra records, which
+            have nothing else in them so that counts aren't added up twice.
+        """
+        timestamp = int(time.time() * 1000)
+
+        def record(dimension, value, metrics, properties = {}):
+            return {
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.NAMESPACE,
+                        'Dimensions': [[dimension]],
+                        'Metrics': [{'Name': name, 'Unit': unit} for name, (unit, _) in metrics.items()]
+                    }]
+                },
+                dimension: value,
+                'InvocationId': invocation_id,
+                **{name: metric_value for name, (_, metric_value) in metrics.items()},
+                **properties
+            }
+
+        def records_with_latencies(dimension, value, metrics, latencies, properties = {}):
+            latencies = [round(latency * 1000, 2) for latency in latencies]
+            chunks = [latencies[i:i + self.MAX_METRIC_VALUES] for i in range(0, len(latencies), self.MAX_METRIC_VALUES)]
+            if len(chunks) == 0:
+                return [record(dimension, value, metrics, properties)]
+
+            return [record(dimension, value, {**metrics, 'Latency': ('Milliseconds', chunks[0])}, properties)] + [
+                record(dimension, value, {'Latency': ('Milliseconds', chunk)}) for chunk in chunks[1:]
+            ]
+
+        with self.lock:
+            records = []
+            for endpoint, stats in self.requests.items():
+                records += records_with_latencies('Endpoint', endpoint, {
+                    'Calls': ('Count', stats['calls']),
+                    'Errors': ('Count', stats['errors']),
+                    'Retries': ('Count', stats['retries']),
+                    'ResponseBytes': ('Bytes', stats['bytes']),
+                    'WireBytes': ('Bytes', stats['wire_bytes']),
+                    'Hedged': ('Count', stats['hedged']),
+                    'HedgeWins': ('Count', stats['hedge_wins'])
+                }, stats['latencies'], {'Statuses': stats['statuses']})
+            for operation, stats in self.cache_operations.items():
+                records += records_with_latencies('CacheOperation', operation, {
+                    'Calls': ('Count', stats['calls']),
+                    'Errors': ('Count', stats['errors']),
+                    'ConsumedCapacity': ('Count', stats['consumed_capacity'])
+                }, stats['latencies'])
+            records += [
+                record('Phase', phase, {
+                    'Duration': ('Milliseconds', round(duration * 1000, 2))
+                }) for phase, duration in self.phases.items()
+            ]
+
+        return records
+
+    def emit(self, invocation_id = None):
+        """
+        Prints every record as a single JSON line. In Lambda, these end up in CloudWatch Logs.
+        """
+        for record in self.records(invocation_id):
+            print(json.dumps(record, separators=(',', ':'), default=str))
+
+    def __request_stats(self, endpoint):
+        return self.requests.setdefault(endpoint, {'calls': 0, 'errors': 0, 'retries': 0, 'bytes': 0, 'wire_bytes': 0, 'hedged': 0, 'hedge_wins': 0, 'latencies': [], 'statuses': {}})
+
+_current_metrics = Metrics()
+
+def current_metrics():
+    return _current_metrics
+
+def reset_metrics():
+    """
+    Starts a fresh set of metrics. Call this at the start of every invocation, since module state lives on between warm
+    invocations.
+    """
+    global _current_metrics
+    _current_metrics = Metrics()
+    return _current_metrics
+
+def endpoint_name(method, path):
+    """
+    Templates the IDs out of an API path, so that e.g. all playlist fetches are grouped together
+    """
+    return f"{method} {re.sub(r'/(playlists|users)/[^/?]+', lambda m: f'/{m.group(1)}/{{id}}', path)}"
+
+class ConsumedCapacity:
+    """
+    Adds up the capacity units that DDB reports for the requests made by a single cache operation
+    """
+    def __init__(self):
+        self.units = 0
+        self.lock = threading.Lock()
+
+    def add(self, response):
+        """
+        :param response: A DDB response from a request made with `ReturnConsumedCapacity='TOTAL'`
+        """
+        consumed = response.get('ConsumedCapacity')
+        if not consumed:
+            return
+
+        # Single table requests report one entry, and batch requests report a list of them
+        with self.lock:
+            for entry in consumed if isinstance(consumed, list) else [consumed]:
+                self.units += entry.get('CapacityUnits', 0)
+
+_cache_operation_state = threading.local()
+
+def current_consumed_capacity():
+    """
+    Returns the `ConsumedCapacity` of the cache operation that's running on this thread. Requests that are made on other
+    threads on the operation's behalf need to be handed this explicitly.
+    """
+    return getattr(_cache_operation_state, 'consumed_capacity', None) or ConsumedCapacity()
+
+def timed_cache_operation(method):
+    """
+    Decorates a cache method so that every call to it, and the capacity it consumes, is recorded in the current metrics
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        error = False
+        # Operations that call other operations have their capacity recorded separately
+        outer_consumed_capacity = getattr(_cache_operation_state, 'consumed_capacity', None)
+        consumed_capacity = ConsumedCapacity()
+        _cache_operation_state.consumed_capacity = consumed_capacity
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            _cache_operation_state.consumed_capacity = outer_consumed_capacity
+            current_metrics().record_cache_operation(method.__name__, time.perf_counter() - started, error, consumed_capacity.units)
+
+    return wrapper
@@ -1,51 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor
 
 class PlaylistManager:
-    def __init__(self, client, playlist_name):
+    DEFAULT_DESCRIPTION = "An automatically generated playlist with songs selected from random \"Top 50\" playlists around the world! 🌎"
+
+    def __init__(self, client, playlist_name = None, max_workers = 4):
+        """
+        :param playlist_name: The name of the global playlist. Only needed for `create_global_playlist`.
+        :param max_workers: The most playlists that `create_playlists` updates at once
+        """
         self.client = client
         self.global_playlist_name = playlist_name
+        self.max_workers = max_workers
 
     def create_global_playlist(self, songs):
         """
         Create the global playlist if it doesn't exist and populate it with a new set of songs.
         """
-        playlist_id = self.__get_existing_global_playlist_id()
+        existing_ids = self.__get_existing_playlist_ids([self.global_playlist_name])
 
-        if not playlist_id:
-            print("Creating new global playlist")
-            playlist_id = self.__create_global_playlist()
-        else:
-            print("Cleaning up existing global playlist")
-            self.__clear_out_global_playlist(playlist_id)
+        self.__populate_playlist(self.global_playlist_name, existing_ids.get(self.global_playlist_name), songs, self.DEFAULT_DESCRIPTION)
+
+    def create_playlists(self, targets_and_songs):
+        """
+        Creates or repopulates several playlists at once. The user's playlists are only listed once for all of them.
+
+        :param targets_and_songs: A list of (PlaylistTarget, songs) tuples
+        """
+        existing_ids = self.__get_existing_playlist_ids([target.name for target, _ in targets_and_songs])
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                executor.submit(
+                    self.__populate_playlist,
+                    target.name,
+                    existing_ids.get(target.name),
+                    songs,
+                    target.description or self.DEFAULT_DESCRIPTION
+                ) for target, songs in targets_and_songs
+            ]
 
-        print("Populating global playlist")
-        self.__add_songs_to_global_playlist(playlist_id, songs)
+            # Surfaces the first failure, after every playlist has had its chance to update
+            for future in futures:
+                future.result()
 
 # ---------------- ---------------- ---------------------#
 # ----------------     private      ---------------------#
 # ---------------- ---------------- ---------------------#   
 
-    def __get_existing_global_playlist_id(self):
-        current_user_playlists = self.client.get_current_user_playlists()
-
-        filtered_playlists = list(filter(lambda playlist: playlist['name'] == self.global_playlist_name, current_user_playlists))
-
-        if (len(filtered_playlists) == 1):
-            return filtered_playlists[0]['id']
+    def __populate_playlist(self, name, playlist_id, songs, description):
+        if not playlist_id:
+            print(f"Creating new playlist '{name}'")
+            playlist_id = self.client.create_playlist_for_current_user(name, description)
 
-        if (len(filtered_playlists) == 0):
-            return None
+            print(f"Populating playlist '{name}'")
+            self.client.add_items_to_playlist(playlist_id, songs)
+        else:
+            print(f"Replacing the songs in the existing playlist '{name}'")
+            self.client.replace_playlist_items(playlist_id, songs)
 
-        raise Exception("Multiple playlists matched the global playlist search")
+    def __get_existing_playlist_ids(self, names):
+        """
+        :return: A map of name: playlist ID for the names that the user already has playlists for
+        """
+        remaining_names = set(names)
+        existing_ids = {}
 
-    def __create_global_playlist(self):
-        return self.client.create_playlist_for_current_user(
-            self.global_playlist_name,
-            "An automatically generated playlist with songs selected from random \"Top 50\" playlists around the world! 🌎"
-        )
+        # Stop paging through the user's playlists as soon as we've found all of them
+        for playlist in self.client.iter_current_user_playlists():
+            if playlist.name in remaining_names:
+                existing_ids[playlist.name] = playlist.id
+                remaining_names.discard(playlist.name)
 
-    def __clear_out_global_playlist(self, playlist_id):
-        tracks = self.client.get_playlist_tracks(playlist_id)
-        self.client.remove_items_from_playlist(playlist_id, tracks)
+            if len(remaining_names) == 0:
+                break
 
-    def __add_songs_to_global_playlist(self, playlist_id, songs):
-        self.client.add_items_to_playlist(playlist_id, songs)
+        return existing_ids
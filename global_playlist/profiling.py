@@ -0,0 +1,71 @@
+import cProfile, io, os, pstats, tracemalloc
+from contextlib import contextmanager
+
+# A comma-separated list of the profilers to run: "cpu", "memory" or "cpu,memory". Unset means no profiling.
+PROFILE_ENV_VAR = 'GLOBAL_PLAYLIST_PROFILE'
+# Where profile artifacts are written. /tmp is the only writable directory in Lambda.
+PROFILE_DIR_ENV_VAR = 'GLOBAL_PLAYLIST_PROFILE_DIR'
+# If set, artifacts are also uploaded to this S3 bucket, since Lambda's /tmp doesn't outlive the container
+PROFILE_BUCKET_ENV_VAR = 'GLOBAL_PLAYLIST_PROFILE_BUCKET'
+
+SUMMARY_LINES = 20
+
+@contextmanager
+def maybe_profile(invocation_id):
+    """
+    Profiles the code in the `with` block if the profile env var asks for it. The CPU profile is written as a pstats
+    file and the memory profile as a tracemalloc snapshot. Both get a short summary printed to the logs.
+    """
+    modes = set(mode.strip() for mode in os.environ.get(PROFILE_ENV_VAR, '').split(',') if mode.strip())
+
+    if len(modes) == 0:
+        yield
+        return
+
+    profile_dir = os.environ.get(PROFILE_DIR_ENV_VAR, '/tmp')
+    artifacts = []
+
+    profiler = cProfile.Profile() if 'cpu' in modes else None
+    if 'memory' in modes:
+        tracemalloc.start(25)
+    if profiler:
+        profiler.enable()
+
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            cpu_path = os.path.join(profile_dir, f"cpu-{invocation_id}.prof")
+            profiler.dump_stats(cpu_path)
+            artifacts.append(cpu_path)
+
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(SUMMARY_LINES)
+            print(summary.getvalue())
+
+        if 'memory' in modes:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            memory_path = os.path.join(profile_dir, f"memory-{invocation_id}.tracemalloc")
+            snapshot.dump(memory_path)
+            artifacts.append(memory_path)
+
+            print(f"Peak traced memory: {peak / 1024:.1f}KB. Largest allocations:")
+            for stat in snapshot.statistics('lineno')[:SUMMARY_LINES]:
+                print(stat)
+
+        print(f"Wrote profile artifacts: {artifacts}")
+        _upload_artifacts(artifacts)
+
+def _upload_artifacts(artifacts):
+    bucket = os.environ.get(PROFILE_BUCKET_ENV_VAR)
+    if not bucket:
+        return
+
+    import boto3
+    s3 = boto3.client('s3')
+    for artifact in artifacts:
+        s3.upload_file(artifact, bucket, f"profiles/{os.path.basename(artifact)}")
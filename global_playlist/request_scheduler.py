@@ -0,0 +1,202 @@
+import random, threading, time
+from global_playlist.metrics import current_metrics
+from global_playlist.http_transport import wire_bytes
+from global_playlist.deadline import DeadlineExceeded, current_deadline
+
+class RequestFailedException(Exception):
+    def __init__(self, message, status_code = None, response_text = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response_text = response_text
+
+class TokenBucket:
+    """
+    A thread-safe token bucket. Tokens are added at `rate` per second, up to `capacity`, and each request takes one.
+    """
+    def __init__(self, rate, capacity, clock = time.monotonic, sleep = time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.last_refill = clock()
+        # Set when the server tells us to back off. Nobody gets a token until then.
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available, then takes it.
+        :return: The number of seconds spent waiting
+        """
+        waited = 0
+
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                else:
+                    wait = (1 - self.tokens) / self.rate
+
+            self.sleep(wait)
+            waited += wait
+
+    def block_for(self, seconds):
+        """
+        Stops handing out tokens to anybody for the given number of seconds
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, self.clock() + seconds)
+            self.tokens = 0
+
+class RequestScheduler:
+    """
+    Paces requests through a token bucket and retries failures with exponential backoff and jitter. A single scheduler is
+    meant to be shared by every thread making requests, so that together they stay under the API's rate limits.
+    """
+    RETRYABLE_STATUS_CODES = {500, 502, 503, 504}
+    TOO_MANY_REQUESTS = 429
+
+    def __init__(self, rate = 10, burst = 10, max_attempts = 4, base_delay = 0.5, max_delay = 30, sleep = time.sleep):
+        """
+        :param rate: The sustained number of requests per second
+        :param burst: The number of requests that can be sent at once after a quiet period
+        :param max_attempts: The number of times a request is sent before we give up on it
+        :param base_delay: The backoff before the first retry, in seconds. It doubles with each attempt.
+        :param max_delay: The longest we'll back off between attempts, in seconds. A server's `Retry-After` is always
+            waited out in full, as long as the deadline allows it.
+        """
+        self.bucket = TokenBucket(rate, burst, sleep=sleep)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+
+    def execute(self, send, description, idempotent = True, endpoint = None):
+        """
+        Sends a request, retrying it when it fails in a way that might succeed on a second try.
+
+        :param send: A function that sends the request and returns the response
+        :param description: A human-readable description of the request, used in logs and errors
+        :param idempotent: Whether it's safe to send the request again after a server error. Rate-limited (429) requests
+            are always retried, since the server didn't act on them.
+        :param endpoint: The name that the request is recorded under in the metrics. Defaults to `description`.
+        :return: The successful response
+        """
+        started = time.perf_counter()
+        # Filled in as the request goes, so that the metrics are right however it ends
+        outcome = {'attempts': 0, 'response': None}
+
+        try:
+            return self.__execute(send, description, idempotent, outcome)
+        finally:
+            response = outcome['response']
+            current_metrics().record_request(
+                endpoint or description,
+                time.perf_counter() - started,
+                response.status_code if response is not None else None,
+                max(0, outcome['attempts'] - 1),
+                len(response.content or b'') if response is not None else 0,
+                wire_bytes(response) if response is not None else 0
+            )
+
+# ---------------- ---------------- ---------------------#
+# ----------------     private      ---------------------#
+# ---------------- ---------------- ---------------------#
+
+    def __execute(self, send, description, idempotent, outcome):
+        last_error = None
+
+        for attempt in range(self.max_attempts):
+            self.bucket.acquire()
+            outcome['attempts'] += 1
+            outcome['response'] = None
+
+            try:
+                response = send()
+            except OSError as e:
+                # requests' exceptions are all OSErrors. Connection problems are worth another try.
+                if not idempotent:
+                    raise RequestFailedException(f"{description} failed: {e}") from e
+                print(f"{description} failed with {e}. Retrying.")
+                last_error = RequestFailedException(f"{description} failed: {e}")
+                self.__wait_before_retry(attempt)
+                continue
+
+            outcome['response'] = response
+
+            if response.ok:
+                return response
+
+            last_error = RequestFailedException(
+                f"{description} failed with status {response.status_code}: {response.text}",
+                response.status_code,
+                response.text
+            )
+
+            if response.status_code == self.TOO_MANY_REQUESTS:
+                delay = self.__retry_after(response, attempt)
+                print(f"{description} was rate limited. Backing off for {delay:.2f}s.")
+                self.__check_deadline_allows(delay)
+                # Everybody sharing this scheduler has to wait, otherwise the other threads just get rate limited too
+                self.bucket.block_for(delay)
+            elif response.status_code in self.RETRYABLE_STATUS_CODES and idempotent:
+                print(f"Response was not OK ({response.status_code}): {response.text}")
+                self.__wait_before_retry(attempt)
+            else:
+                raise last_error
+
+        raise RequestFailedException(
+            f"Gave up on {description} after {self.max_attempts} attempts. Last error: {last_error}",
+            last_error.status_code if last_error else None,
+            last_error.response_text if last_error else None
+        )
+
+    def __wait_before_retry(self, attempt):
+        # No point waiting if there isn't going to be another attempt
+        if attempt < self.max_attempts - 1:
+            self.__sleep_within_deadline(self.__backoff(attempt))
+
+    def __sleep_within_deadline(self, delay):
+        self.__check_deadline_allows(delay)
+        self.sleep(delay)
+
+    def __check_deadline_allows(self, delay):
+        remaining = current_deadline().remaining()
+        # Giving up now leaves the rest of the time for whatever can still be done without this request
+        if remaining is not None and delay >= remaining:
+            raise DeadlineExceeded(f"Backing off for {delay:.2f}s would take us past the deadline")
+
+    def __backoff(self, attempt):
+        # "Full jitter" backoff, so that threads that failed together don't all retry together
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def __retry_after(self, response, attempt):
+        retry_after = response.headers.get('Retry-After')
+
+        try:
+            # Retrying any sooner would only get us rate limited again. The deadline decides whether we can wait this long.
+            return float(retry_after)
+        except (TypeError, ValueError):
+            return self.__backoff(attempt) + self.base_delay
+
+_shared_scheduler = None
+_shared_scheduler_lock = threading.Lock()
+
+def shared_scheduler():
+    """
+    Returns a scheduler that's shared by everything in this process, so that all threads draw from the same rate budget.
+    """
+    global _shared_scheduler
+
+    with _shared_scheduler_lock:
+        if _shared_scheduler is None:
+            _shared_scheduler = RequestScheduler()
+        return _shared_scheduler
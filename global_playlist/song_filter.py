@@ -0,0 +1,73 @@
+import hashlib, math, struct
+
+class BloomFilter:
+    """
+    A compact set of strings that can answer "have we seen this before?" without storing the strings themselves.
+    It never misses something that was added, but occasionally claims to have seen something that wasn't (at roughly
+    `error_rate`, as long as no more than `capacity` items are added). For song history, that only means we now and
+    then skip a song that we could have used.
+
+    The whole filter serializes to a single blob, so it can be stored and loaded in one read.
+    """
+    MAGIC = b'GPBF'
+    VERSION = 1
+    # magic, version, hash count, bit count, item count, capacity
+    HEADER = struct.Struct('>4sBBIII')
+
+    def __init__(self, bit_count, hash_count, capacity, count = 0, bits = None):
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        self.capacity = capacity
+        self.count = count
+        self.bits = bits if bits is not None else bytearray((bit_count + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate):
+        """
+        Creates an empty filter that's sized to hold `capacity` items at the given false positive rate
+        """
+        bit_count = max(8, math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        hash_count = max(1, round(bit_count / capacity * math.log(2)))
+        return cls(bit_count, hash_count, capacity)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, hash_count, bit_count, count, capacity = cls.HEADER.unpack_from(data)
+
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise Exception(f"Unrecognised bloom filter format: {magic} v{version}")
+
+        return cls(bit_count, hash_count, capacity, count, bytearray(data[cls.HEADER.size:]))
+
+    def to_bytes(self):
+        return self.HEADER.pack(self.MAGIC, self.VERSION, self.hash_count, self.bit_count, self.count, self.capacity) + bytes(self.bits)
+
+    def add(self, key):
+        for index in self.__indexes(key):
+            self.bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def is_saturated(self):
+        """
+        Whether more items have been added than the filter was sized for. Past that point the false positive rate climbs
+        quickly, so the filter should be rebuilt with a larger capacity.
+        """
+        return self.count > self.capacity
+
+    def __contains__(self, key):
+        return all(self.bits[index >> 3] & (1 << (index & 7)) for index in self.__indexes(key))
+
+    def __len__(self):
+        return self.count
+
+    def __indexes(self, key):
+        # Double hashing: derive all of the indexes from two halves of a single digest
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+
+        return ((first + i * second) % self.bit_count for i in range(self.hash_count))
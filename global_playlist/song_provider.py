@@ -1,48 +1,185 @@
-import os, json, random
-from global_playlist.data_types import Playlist
+import math, os, json, random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from global_playlist.catalog_snapshot import CatalogSnapshot
+from global_playlist.language_quota import LanguageQuotaSelector, load_market_languages
 
 class SongProvider:
-    def __init__(self, client, countries, cache, re_cache_playlists = False):
+    def __init__(self, client, countries, cache, re_cache_playlists = False, discovery_concurrency = 8, discovery_batch_size = 20, prefetch_depth = 4, playlists = None, refresh_country_ids = [], playlist_ttl = timedelta(days=7), missing_playlist_ttl = timedelta(days=30), max_stale_refreshes = 10, catalog_snapshot = None, snapshot_max_age = timedelta(days=1), artist_exclusion_window = timedelta(days=30)):
+        """
+        :param playlists: Regional playlists to use instead of discovering them, for tests and the selection simulation.
+            The lambda leaves this out, since `CacheLayer` already keeps discovered playlists between warm invocations.
+        :param refresh_country_ids: Countries whose playlists should be searched for again, even though they're cached
+        :param discovery_concurrency: The maximum number of countries that are searched for playlists at the same time
+        :param discovery_batch_size: The number of discovered playlists that are collected before they're saved to the cache
+        :param prefetch_depth: The number of playlists whose tracks are fetched in the background while we're choosing a
+            song from the current one
+        :param playlist_ttl: How long a country's playlist is trusted before we search for it again
+        :param missing_playlist_ttl: How long we trust that a country doesn't have a playlist before searching again.
+            This is longer than `playlist_ttl`, since Spotify rarely adds new regional playlists.
+        :param max_stale_refreshes: The most countries whose TTL has run out that are searched again per run. The
+            longest-unchecked ones go first, so the work is spread over several runs rather than done all at once.
+        :param catalog_snapshot: An optional `CatalogSnapshot`. Playlists and songs are taken from it rather than from
+            the API, as long as they're no older than `snapshot_max_age`.
+        :param artist_exclusion_window: Songs by artists that were used within this long are skipped. None turns this off.
+        """
         self.client = client
         self.re_cache_playlists = re_cache_playlists
-        self.playlists = []
+        self.playlists = list(playlists or [])
         self.cache = cache
+        self.discovery_concurrency = discovery_concurrency
+        self.discovery_batch_size = discovery_batch_size
+        self.prefetch_depth = prefetch_depth
+        self.refresh_country_ids = set(refresh_country_ids)
+        self.playlist_ttl = playlist_ttl
+        self.missing_playlist_ttl = missing_playlist_ttl
+        self.max_stale_refreshes = max_stale_refreshes
+        self.catalog_snapshot = catalog_snapshot
+        self.snapshot_max_age = snapshot_max_age
+        self.artist_exclusion_window = artist_exclusion_window
+        # Each artist's history is only looked up once per provider
+        self.checked_artist_ids = set()
+        self.recent_artist_ids = set()
         self.__get_global_playlists(countries)
 
     def get_random_global_songs(self, count):
         """
         Retrieve `count` songs from different playlists
         """
-        playlist_ordering = self.__random_playlist_ordering()
+        if count <= 0:
+            return []
 
-        artists = set()
-        songs = []
+        rejection_filter = self.cache.load_used_song_filter()
 
-        # If the number of artists in the song's list is decreased when we remove all already chosen artists, 
-        # we can drop the song because we don't want artists showing up multiple times
-        artist_not_present = lambda s: len(set(s.artist_ids) - artists) == len(s.artist_ids)
+        playlist_tracks = self.__prefetched_playlist_tracks(self.__random_playlist_ordering())
+        # Artists are looked up one playlist at a time, since we usually only get through a few playlists
+        playlist_songs = (self.__without_recent_artists(songs) for songs in playlist_tracks)
 
-        used_songs = self.cache.load_used_songs()
+        songs = self.__choose_songs(count, playlist_songs, lambda song: song.id not in rejection_filter)
 
-        rejection_set = set(used_songs)
+        # Cancels the fetches for any playlists that we didn't get to
+        playlist_tracks.close()
 
-        song_not_rejected = lambda song: song.id not in rejection_set
+        return songs
 
-        while (len(songs) < count and len(playlist_ordering) > 0):
-            # The ordering is random, so it doesn't really matter if we take from the front or back
-            next_playlist = playlist_ordering.pop()
+    def get_songs_for_targets(self, targets):
+        """
+        Chooses songs for several playlists at once. Every regional playlist that any of the targets can use is fetched
+        exactly once, and then shared between the targets. A song is never chosen for more than one target.
 
-            valid_songs = self.__valid_songs_from_playlist(next_playlist.id, [artist_not_present, song_not_rejected])
+        :param targets: A list of `PlaylistTarget`s
+        :return: A list of (target, songs) tuples, in the same order as `targets`
+        """
+        market_languages = load_market_languages()
+        target_sources = [[playlist for playlist in self.playlists if target.accepts(playlist, market_languages)] for target in targets]
 
-            if (len(valid_songs) == 0):
-                continue
-            
-            chosen_song = valid_songs[random.randint(0, len(valid_songs) - 1)]
+        distinct_sources = list(dict((playlist.id, playlist) for sources in target_sources for playlist in sources).values())
+        print(f"Fetching {len(distinct_sources)} regional playlists for {len(targets)} targets")
+        source_songs = dict(zip([playlist.id for playlist in distinct_sources], self.__prefetched_playlist_tracks(distinct_sources)))
 
-            songs.append(chosen_song)     
-            artists.update(chosen_song.artist_ids)           
+        # Every candidate's artists are looked up at once
+        self.__recent_artists([artist_id for songs in source_songs.values() for song in songs for artist_id in song.artist_ids])
+        source_songs = dict((playlist_id, self.__without_recent_artists(songs)) for playlist_id, songs in source_songs.items())
 
-        return songs
+        rejection_filter = self.cache.load_used_song_filter()
+        chosen_song_ids = set()
+        song_not_rejected = lambda song: song.id not in rejection_filter and song.id not in chosen_song_ids
+
+        targets_and_songs = []
+
+        for target, sources in zip(targets, target_sources):
+            playlist_ordering = random.sample(sources, len(sources))
+            songs = self.__choose_songs(target.size, (source_songs[playlist.id] for playlist in playlist_ordering), song_not_rejected)
+
+            chosen_song_ids.update(song.id for song in songs)
+            targets_and_songs.append((target, songs))
+
+        return targets_and_songs
+
+    def get_random_global_song_batch(self, selection_count, count, queued_selections = [], selection_interval = timedelta(days=1)):
+        """
+        Chooses songs for several future runs at once, from a single fetch of every regional playlist. Each selection
+        follows the same rules as `get_random_global_songs`. On top of those, no song shows up twice across the batch
+        (or the selections that are already queued), and an artist isn't chosen again until the exclusion window has
+        passed, counting one `selection_interval` per selection.
+
+        Artists that the history says were used recently are skipped for the whole batch, since the history only says
+        that they were used within the window, not when.
+
+        :param count: The number of songs in each selection
+        :param queued_selections: Selections that are already queued up ahead of these ones, oldest first
+        :return: A list of `selection_count` lists of songs. A selection has fewer than `count` songs if there aren't
+            enough left to choose from.
+        """
+        print(f"Fetching {len(self.playlists)} regional playlists for {selection_count} selections")
+        source_songs = dict(zip([playlist.id for playlist in self.playlists], self.__prefetched_playlist_tracks(self.playlists)))
+
+        self.__recent_artists([artist_id for songs in source_songs.values() for song in songs for artist_id in song.artist_ids])
+        source_songs = dict((playlist_id, self.__without_recent_artists(songs)) for playlist_id, songs in source_songs.items())
+
+        rejection_filter = self.cache.load_used_song_filter()
+
+        # How many selections have to go by before an artist can be chosen again
+        artist_gap = 0 if self.artist_exclusion_window is None else math.ceil(self.artist_exclusion_window / selection_interval)
+        chosen_song_ids = set()
+        # artist ID: the position of the last selection that used it, where the queued selections come first
+        artist_positions = {}
+
+        def record(position, songs):
+            chosen_song_ids.update(song.id for song in songs)
+            artist_positions.update((artist_id, position) for song in songs for artist_id in song.artist_ids)
+
+        for position, songs in enumerate(queued_selections):
+            record(position, songs)
+
+        selections = []
+
+        for position in range(len(queued_selections), len(queued_selections) + selection_count):
+            song_not_rejected = lambda song: (
+                song.id not in rejection_filter
+                and song.id not in chosen_song_ids
+                and all(position - artist_positions.get(artist_id, -math.inf) > artist_gap for artist_id in song.artist_ids)
+            )
+
+            playlist_ordering = self.__random_playlist_ordering()
+            songs = self.__choose_songs(count, (source_songs[playlist.id] for playlist in playlist_ordering), song_not_rejected)
+
+            record(position, songs)
+            selections.append(songs)
+
+        return selections
+
+    def export_catalog_snapshot(self, path):
+        """
+        Fetches the songs of every regional playlist and writes them, along with the playlists, to a `CatalogSnapshot`
+        at `path`. Songs are always fetched from the API, even if there's already a snapshot.
+        """
+        fetched_at = datetime.now()
+        playlist_tracks = self.__prefetched_playlist_tracks(self.playlists, self.client.get_playlist_tracks)
+        entries = [(playlist, songs, fetched_at) for playlist, songs in zip(self.playlists, playlist_tracks)]
+
+        CatalogSnapshot.write(path, entries, fetched_at)
+        print(f"Wrote a catalog snapshot of {len(entries)} playlists and {sum(len(songs) for _, songs, _ in entries)} songs to {path}")
+
+    def get_language_balanced_songs(self, count, language_quotas, default_quota = None, max_playlists = None):
+        """
+        Retrieve `count` songs from different playlists, with no more than the given number of songs in each language.
+
+        :param language_quotas: A map of ISO 639-1 language code: the most songs to choose in that language
+        :param default_quota: The most songs to choose in any language without its own quota. None means no limit.
+        :param max_playlists: The most playlists to draw candidates from. All of them are used if this isn't set.
+        """
+        playlist_ordering = self.__random_playlist_ordering()[:max_playlists]
+
+        # Unlike `get_random_global_songs`, every candidate playlist is needed up front
+        candidates = list(zip(playlist_ordering, self.__prefetched_playlist_tracks(playlist_ordering)))
+
+        selector = LanguageQuotaSelector(load_market_languages(), language_quotas, default_quota)
+
+        recent_artist_ids = self.__recent_artists([artist_id for _, songs in candidates for song in songs for artist_id in song.artist_ids])
+
+        return selector.select(candidates, count, self.cache.load_used_song_filter(), recent_artist_ids)
 
 # ---------------- ---------------- ---------------------#
 # ----------------     private      ---------------------#
@@ -52,52 +189,214 @@ class SongProvider:
         if len(self.playlists) > 0:
             return self.playlists
 
+        if self.catalog_snapshot and len(self.refresh_country_ids) == 0 and self.__is_fresh(self.catalog_snapshot.created_at):
+            print(f"Loading regional playlists from the catalog snapshot taken at {self.catalog_snapshot.created_at}")
+            self.playlists = [playlist for playlist in self.catalog_snapshot.playlists() if playlist.country_id in countries]
+            return self.playlists
+
         cached_playlists = []
+        missing_playlists = {}
         if not self.re_cache_playlists:
-            cached_playlists = self.cache.load_playlists()
+            cached_playlists, missing_playlists = self.cache.load_playlist_discovery()
 
         # Fetch from cache
-        if len(cached_playlists) == 0:
+        if len(cached_playlists) == 0 and len(missing_playlists) == 0:
             print("No cached regional playlists found. Fetching a new list.")
-            self.playlists = list(filter(None, [self.__get_spotify_playlist_for_country(id, countries[id]) for id in countries.keys()]))
-            self.cache.save_playlists(self.playlists)
+            self.playlists = self.__discover_playlists(list(countries.keys()), countries)
         else:
             print("Found a regional playlist cache. Loading.")
-            self.playlists = self.cache.load_playlists()
-            cached_country_ids = set([playlist.country_id for playlist in self.playlists])
+            self.playlists = cached_playlists
             requested_country_ids = set([id for id in countries.keys()])
-            missing_country_ids = requested_country_ids - cached_country_ids
+            refresh_country_ids = self.refresh_country_ids & requested_country_ids
 
-            if (len(missing_country_ids) > 0 and self.re_cache_playlists):
-                print(f"{len(missing_country_ids)} countries were missing from the regional playlist cache.")
-                updated_cache = False
+            stale_country_ids = [id for id in self.__stale_country_ids(countries, cached_playlists, missing_playlists) if id not in refresh_country_ids]
+            if len(stale_country_ids) > 0:
+                print(f"{len(stale_country_ids)} countries are due to be checked again. Checking {min(len(stale_country_ids), self.max_stale_refreshes)} of them.")
+                refresh_country_ids |= set(stale_country_ids[:self.max_stale_refreshes])
 
-                for country_id in missing_country_ids:
-                    playlist = self.__get_spotify_playlist_for_country(country_id, countries[country_id])
-                    if playlist:
-                        self.playlists.append(playlist)
-                        updated_cache = True
-
-                if updated_cache:
-                    self.cache.save_playlists(self.playlists)
+            if len(refresh_country_ids) > 0:
+                print(f"Searching for the playlists of {len(refresh_country_ids)} countries again.")
+                # Keep the same ordering as the requested countries so that results are stable between runs
+                ordered_refresh_ids = [id for id in countries.keys() if id in refresh_country_ids]
+                known_playlists = dict((playlist.country_id, playlist) for playlist in self.playlists if playlist.country_id in refresh_country_ids)
+                self.playlists = [playlist for playlist in self.playlists if playlist.country_id not in refresh_country_ids]
+                self.playlists.extend(self.__discover_playlists(ordered_refresh_ids, countries, known_playlists))
             
         return self.playlists
 
-    def __valid_songs_from_playlist(self, playlist_id, predicates = []):
-        songs = self.client.get_playlist_tracks(playlist_id)
+    def __stale_country_ids(self, countries, cached_playlists, missing_playlists):
+        """
+        :return: The IDs of the countries that haven't been searched within their TTL, the longest-unchecked first.
+            Countries that have never been searched come before everything else.
+        """
+        now = datetime.now()
+        verified_at = dict((playlist.country_id, playlist.verified_at) for playlist in cached_playlists)
+        stale = []
+
+        for country_id in countries.keys():
+            if country_id in missing_playlists:
+                if missing_playlists[country_id] + self.missing_playlist_ttl <= now:
+                    stale.append((missing_playlists[country_id], country_id))
+            elif country_id in verified_at:
+                if verified_at[country_id] is None or verified_at[country_id] + self.playlist_ttl <= now:
+                    stale.append((verified_at[country_id] or datetime.min, country_id))
+            else:
+                stale.append((datetime.min, country_id))
 
-        # This beauty applies all the predicates
-        return list(filter(lambda song: all([predicate(song) for predicate in predicates]), songs))
+        # Stable, so ties keep the requested countries' order
+        stale.sort(key=lambda entry: entry[0])
+        return [country_id for _, country_id in stale]
 
+    def __discover_playlists(self, country_ids, countries, known_playlists = {}):
+        """
+        Searches for each country's playlist concurrently. Discovered playlists are saved to the cache in batches as
+        they come in, so that if we run out of time partway through, the work that's already been done isn't lost.
 
-    def __random_playlist_ordering(self):
-        candidates = self.playlists.copy()
-        chosen = []
+        :param country_ids: The ISO 3166 codes of the countries to search, in the order that results should be returned
+        :param known_playlists: A map of country_id: the playlist that was cached for it. A country whose search comes back
+            empty keeps its known playlist, rather than being recorded as not having one.
+        :return: The discovered playlists, in the same order as `country_ids`
+        """
+        found = {}
+        pending_batch = []
+        pending_missing_ids = []
+        verified_at = datetime.now()
 
-        for i in range(0, len(self.playlists)):
-            chosen.append(candidates.pop(random.randint(0, len(candidates) - 1)))
-        
-        return chosen
+        def save_pending():
+            if len(pending_batch) > 0:
+                self.cache.save_playlists(pending_batch)
+            if len(pending_missing_ids) > 0:
+                self.cache.save_missing_playlists(pending_missing_ids, verified_at)
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, self.discovery_concurrency)) as executor:
+                futures = {
+                    executor.submit(self.__get_spotify_playlist_for_country, country_id, countries[country_id]): country_id
+                    for country_id in country_ids
+                }
+
+                for future in as_completed(futures):
+                    try:
+                        playlist = future.result()
+                    except Exception as e:
+                        # The country isn't recorded either way, so it's searched for again next run
+                        print(f"Couldn't search for the playlist of {futures[future]}: {e}")
+                        continue
+
+                    # Search results vary between calls, so one empty search doesn't mean that a known playlist has gone
+                    if not playlist and futures[future] in known_playlists:
+                        playlist = known_playlists[futures[future]]
+                        print(f"Didn't find a playlist for {futures[future]} this time. Keeping {playlist}.")
+
+                    # Countries without a playlist are recorded too, so that they aren't searched again on every run
+                    if not playlist:
+                        pending_missing_ids.append(futures[future])
+                    else:
+                        playlist.verified_at = verified_at
+                        found[futures[future]] = playlist
+                        pending_batch.append(playlist)
+
+                    if len(pending_batch) + len(pending_missing_ids) >= self.discovery_batch_size:
+                        save_pending()
+                        pending_batch = []
+                        pending_missing_ids = []
+        finally:
+            save_pending()
+
+        return [found[country_id] for country_id in country_ids if country_id in found]
+
+    def __choose_songs(self, count, playlist_song_lists, song_not_rejected):
+        """
+        Chooses up to one random song from each playlist, in order, until we have `count` of them
+
+        :param playlist_song_lists: An iterable of the songs in each playlist
+        :param song_not_rejected: A predicate that's false for songs that can't be chosen
+        """
+        artists = set()
+        songs = []
+
+        # If the number of artists in the song's list is decreased when we remove all already chosen artists, 
+        # we can drop the song because we don't want artists showing up multiple times
+        artist_not_present = lambda s: len(set(s.artist_ids) - artists) == len(s.artist_ids)
+
+        if count <= 0:
+            return songs
+
+        for playlist_songs in playlist_song_lists:
+            valid_songs = self.__valid_songs(playlist_songs, [artist_not_present, song_not_rejected])
+
+            if (len(valid_songs) > 0):
+                chosen_song = valid_songs[random.randint(0, len(valid_songs) - 1)]
+
+                songs.append(chosen_song)     
+                artists.update(chosen_song.artist_ids)           
+
+                # Stop before asking for the next playlist, which would otherwise be fetched for nothing
+                if len(songs) >= count:
+                    break
+
+        return songs
+
+    def __recent_artists(self, artist_ids):
+        """
+        :return: Which of the given artists were used within the exclusion window
+        """
+        if self.artist_exclusion_window is None:
+            return set()
+
+        unchecked_artist_ids = set(artist_ids) - self.checked_artist_ids
+        if len(unchecked_artist_ids) > 0:
+            self.recent_artist_ids |= self.cache.load_recent_artists(unchecked_artist_ids, datetime.now() - self.artist_exclusion_window)
+            self.checked_artist_ids |= unchecked_artist_ids
+
+        return self.recent_artist_ids.intersection(artist_ids)
+
+    def __without_recent_artists(self, songs):
+        recent_artist_ids = self.__recent_artists([artist_id for song in songs for artist_id in song.artist_ids])
+        return [song for song in songs if recent_artist_ids.isdisjoint(song.artist_ids)]
+
+    def __valid_songs(self, songs, predicates = []):
+        # This beauty applies all the predicates, stopping at the first one that fails
+        return list(filter(lambda song: all(predicate(song) for predicate in predicates), songs))
+
+    def __prefetched_playlist_tracks(self, playlists, get_playlist_tracks = None):
+        """
+        Yields the songs of each playlist in order. While the caller works through one playlist, the next few are already
+        being fetched in the background. Closing the generator cancels any fetches that haven't started yet.
+
+        :param get_playlist_tracks: How to fetch a playlist's songs, given its ID. Defaults to the catalog snapshot, with
+            the API as the fallback.
+        """
+        get_playlist_tracks = get_playlist_tracks or self.__get_playlist_tracks
+        executor = ThreadPoolExecutor(max_workers=max(1, self.prefetch_depth))
+        remaining = deque(playlists)
+        in_flight = deque()
+
+        try:
+            while len(remaining) > 0 or len(in_flight) > 0:
+                # Keep the current playlist and `prefetch_depth` more in flight
+                while len(remaining) > 0 and len(in_flight) <= self.prefetch_depth:
+                    in_flight.append(executor.submit(get_playlist_tracks, remaining.popleft().id))
+
+                yield in_flight.popleft().result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def __get_playlist_tracks(self, playlist_id):
+        # Only playlists that are missing from the snapshot, or that it's too old for, are fetched from the API
+        if self.catalog_snapshot:
+            fetched_at = self.catalog_snapshot.fetched_at(playlist_id)
+            if fetched_at and self.__is_fresh(fetched_at):
+                return self.catalog_snapshot.songs(playlist_id)
+
+        return self.client.get_playlist_tracks(playlist_id)
+
+    def __is_fresh(self, snapshot_time):
+        return snapshot_time + self.snapshot_max_age > datetime.now()
+
+    def __random_playlist_ordering(self):
+        # A uniformly random permutation in O(n), rather than popping random indexes out of a list
+        return random.sample(self.playlists, len(self.playlists))
         
     def __get_spotify_playlist_for_country(self, country_id, country_name):
         """
@@ -111,12 +410,12 @@ class SongProvider:
         for term in search_terms:
             playlists = self.client.search_playlists(f"{term} {country_name}", country_id, False)
 
-            filtered_playlists = [Playlist(playlist['id'], playlist['name'], playlist['owner']['display_name'], country_id) for playlist in playlists if self.__meets_playlist_requirements(playlist)]
+            filtered_playlists = [playlist for playlist in playlists if self.__meets_playlist_requirements(playlist)]
             
             if (len(filtered_playlists) > 0):
                 print(f"Found playlist for {country_name}: {filtered_playlists[0].name}")
                 return filtered_playlists[0]
         return None
 
-    def __meets_playlist_requirements(self, playlist_json):
-        return playlist_json['owner']['display_name'] == 'Spotify' and "50" in playlist_json['name']
+    def __meets_playlist_requirements(self, playlist):
+        return playlist.owner == 'Spotify' and "50" in playlist.name
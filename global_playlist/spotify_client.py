@@ -1,20 +1,53 @@
-import requests, base64, json, urllib.parse, os, re
-from datetime import datetime, timedelta
-from global_playlist.data_types import Song, ClientToken
+import functools, json, os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from global_playlist.data_types import Playlist, Song
+from global_playlist import json_backend
+from global_playlist.http_transport import shared_transport
+from global_playlist.request_scheduler import RequestFailedException, shared_scheduler
+from global_playlist.token_manager import TokenManager
+from global_playlist.metrics import endpoint_name
 
 class SpotifyClient:
-    ACCOUNTS_ENDPOINT = 'https://accounts.spotify.com'
     API_ENDPOINT = 'https://api.spotify.com/v1'
 
-    def __init__(self, api_id, api_secret, cache):
+    # Only what `Song` holds. Everything else about a track (album, images, markets, ...) is most of the payload.
+    TRACK_FIELDS = 'track(name,id,uri,artists(id,name))'
+    # The largest page sizes that the API allows for each endpoint
+    PLAYLIST_TRACKS_PAGE_SIZE = 100
+    USER_PLAYLISTS_PAGE_SIZE = 50
+    # The most items that a single playlist mutation can touch
+    MAX_ITEMS_PER_MUTATION = 100
+    UNAUTHORIZED = 401
+
+    def __init__(self, api_id, api_secret, cache, transport = None, scheduler = None, page_prefetch = 4, track_cache = None, token_manager = None, hedger = None, request_timeout = None):
+        """
+        :param token_manager: The `TokenManager` that hands out tokens. Pass one that outlives the client (e.g. in the
+            warm state) to keep tokens across clients. Defaults to a new one for this client.
+        :param hedger: An optional `RequestHedger`. If it's set, GETs that are slower than usual are sent a second time.
+        :param request_timeout: The timeout for each request, in seconds or as a (connect, read) tuple. Defaults to the
+            transport's. Either way, it's cut down to whatever is left of the invocation's deadline.
+        :param transport: The `HttpTransport` that all requests are sent through. Defaults to the process-wide shared
+            transport, so that connections are reused across clients and warm Lambda invocations.
+        :param scheduler: The `RequestScheduler` that paces and retries API requests. Defaults to the process-wide shared
+            scheduler, so that every thread stays within the same rate budget.
+        :param page_prefetch: The maximum number of pages of a paginated listing that are fetched ahead of the one that's
+            currently being read
+        :param track_cache: An optional `TrackListingCache`. If it's set, playlist tracks are only fetched when the
+            playlist has changed since they were cached.
+        """
         self.api_id = api_id
         self.api_secret = api_secret
+        self.transport = transport or shared_transport()
+        self.scheduler = scheduler or shared_scheduler()
+        self.page_prefetch = page_prefetch
+        self.track_cache = track_cache
+        self.token_manager = token_manager or TokenManager(api_id, api_secret, cache, self.transport)
+        self.hedger = hedger
+        self.request_timeout = request_timeout
         self.countries = None
-        self.app_token = None
-        self.client_token = None
         self.cache = cache
-        self.__country_mapping = SpotifyClient.__iso3166_mapping()
-        self.__local_auth_flow()
+        self.__country_mapping = iso3166_mapping()
         self.current_user_id = None
 
     def get_countries(self, invalidate = False):
@@ -26,13 +59,17 @@ class SpotifyClient:
                 "/markets"
             )
 
-            markets = json.loads(markets_response)['markets']
+            markets = json_backend.loads(markets_response)['markets']
 
             self.countries = [(m, self.__country_mapping[m]) for m in markets if m in self.__country_mapping]
         return dict(self.countries)
 
     # Returns a maximum of 3 playlists for the given search
     def search_playlists(self, search_string, marketplace, global_creds=False):
+        """
+        :return: The matching playlists, with `marketplace` as their country. /search doesn't take a `fields` filter,
+            so the parsing is the only thing we can trim.
+        """
         response = self.__get_request(
             "/search",
             [
@@ -44,38 +81,110 @@ class SpotifyClient:
             global_creds
         )
 
-        return json.loads(response)['playlists']['items']
+        return self.parse_playlist_items(json_backend.loads(response)['playlists']['items'], marketplace)
 
     def get_current_user_playlists(self):
-        return json.loads(self.__get_request(
-            "/me/playlists"
-        ))['items']
+        return list(self.iter_current_user_playlists())
+
+    def iter_current_user_playlists(self):
+        """
+        Lazily yields the current user's playlists, fetching more pages only as they're needed. Like /search,
+        /me/playlists doesn't take a `fields` filter.
+        """
+        path = "/me/playlists"
+        page_size = self.USER_PLAYLISTS_PAGE_SIZE
+
+        first_page = json_backend.loads(self.__get_request(
+            path,
+            [
+                ('limit', page_size)
+            ]
+        ))
+
+        for page in self.__iter_pages(path, [], first_page, page_size):
+            yield from self.parse_playlist_items(page)
 
     def get_playlist_tracks(self, playlist_id):
-        response = self.__get_request(
+        if not self.track_cache:
+            return list(self.iter_playlist_tracks(playlist_id))
+
+        # Checking the snapshot ID is a lot cheaper than fetching every track
+        snapshot_id = self.get_playlist_snapshot_id(playlist_id)
+        songs = self.track_cache.get(playlist_id, snapshot_id)
+
+        if songs is None:
+            songs = list(self.iter_playlist_tracks(playlist_id))
+            self.track_cache.put(playlist_id, snapshot_id, songs)
+
+        return songs
+
+    def get_playlist_snapshot_id(self, playlist_id):
+        """
+        Fetches the playlist's snapshot ID, which changes whenever the playlist's contents do
+        """
+        return json_backend.loads(self.__get_request(
+            f"/playlists/{playlist_id}",
+            [
+                ('fields', 'snapshot_id')
+            ]
+        ))['snapshot_id']
+
+    def iter_playlist_tracks(self, playlist_id):
+        """
+        Lazily yields the songs in a playlist, fetching more pages only as they're needed
+        """
+        first_page = json_backend.loads(self.__get_request(
             f"/playlists/{playlist_id}",
             [
-                ('fields', 'tracks.items(track(name,id,uri,artists))')
+                ('fields', f'tracks(total,next,items({self.TRACK_FIELDS}))')
             ]
+        ))['tracks']
+
+        pages = self.__iter_pages(
+            f"/playlists/{playlist_id}/tracks",
+            [
+                ('fields', f'items({self.TRACK_FIELDS})')
+            ],
+            first_page,
+            self.PLAYLIST_TRACKS_PAGE_SIZE
         )
 
+        for page in pages:
+            yield from self.parse_track_items(page)
 
+    @staticmethod
+    def parse_playlist_items(items, country_id = None):
+        """
+        Turns a page of simplified playlist objects into playlists
+        """
         return [
-            Song(
-                item['track']['id'], 
-                item['track']['name'], 
-                item['track']['uri'], 
-                # Dear reader, forgive me, for I have sinned. This pairs up artist names and IDs, splats them, zips the pairs
-                # (which creates two lists, where the first contains all first elements of the tuple and the second contains all the seconds), 
-                # makes that into a list, and splats it again
-                *list(zip(*[(artist['id'], artist['name']) for artist in item['track']['artists']]))
-            ) for item in json.loads(response)['tracks']['items']
+            Playlist(item['id'], item['name'], item['owner']['display_name'], country_id)
+            # Search results sometimes have nulls in them
+            for item in items if item
         ]
-        
+
+    @staticmethod
+    def parse_track_items(items):
+        """
+        Turns a page of playlist track items into songs
+        """
+        from_track = Song.from_track
+        songs = []
+
+        for item in items:
+            track = item['track']
+            # Tracks that have been removed from Spotify show up as nulls
+            if not track or not track['id']:
+                continue
+
+            songs.append(from_track(track))
+
+        return songs
+
     def get_current_user_id(self):
         if not self.current_user_id:
             response = self.__get_request("/me")
-            self.current_user_id = json.loads(response)['id']
+            self.current_user_id = json_backend.loads(response)['id']
         
         return self.current_user_id
     
@@ -83,211 +192,197 @@ class SpotifyClient:
     def create_playlist_for_current_user(self, name, description):
         print("Creating a new playlist")
         user_id = self.get_current_user_id()
-        response = requests.request(
+        response = self.__authorized_request(
             'POST',
-            f"{self.API_ENDPOINT}/users/{user_id}/playlists",
-            headers = {
-                'Authorization': f"Bearer {self.client_token.token}",
-                'Content-Type': 'application/json'
-            },
+            f"/users/{user_id}/playlists",
             data = json.dumps({
                     'name': name,
                     'description': description
-                }, ensure_ascii=False).encode('utf-8')
+                }, ensure_ascii=False).encode('utf-8'),
+            # Sending this twice would leave us with two playlists
+            idempotent=False
         ).text
 
-        return json.loads(response)['id']
-
-    def remove_items_from_playlist(self, playlist_id, songs):
-        return self.__mutate_playlist_request(
-            'DELETE',
-            playlist_id,
-            json.dumps({
-               'tracks': [{'uri': song.uri} for song in songs]
-            })
-        )
-        
-    def add_items_to_playlist(self, playlist_id, songs):
-        return self.__mutate_playlist_request(
-            'POST',
-            playlist_id,
-            json.dumps({
-                'uris': [song.uri for song in songs],
-                'position': '0'
-            })
-        )
-
+        return json_backend.loads(response)['id']
 
-# ---------------- ---------------- ---------------------#
-# ----------------     private      ---------------------#
-# ---------------- ---------------- ---------------------#
-
-    def __mutate_playlist_request(self, request_type, playlist_id, data):
-        retries = 3
+    def remove_items_from_playlist(self, playlist_id, songs, snapshot_id = None):
+        """
+        Removes songs from a playlist, 100 at a time. Each request is made against the snapshot produced by the one before
+        it, so that Spotify applies them in order.
 
-        while retries > 0:
-            response = requests.request(
-                request_type,
-                f"{self.API_ENDPOINT}/playlists/{playlist_id}/tracks",
-                headers = {
-                    'Authorization': f"Bearer {self.client_token.token}",
-                    'Content-Type': 'application/json'
-                },
-                data = data
-            )
+        :param snapshot_id: The playlist snapshot that the first removal should apply to
+        :return: The playlist's snapshot ID after the removal
+        """
+        for chunk in self.__mutation_chunks(songs):
+            body = {
+                'tracks': [{'uri': song.uri} for song in chunk]
+            }
+            if snapshot_id:
+                body['snapshot_id'] = snapshot_id
 
-            if response.ok:
-                return response.text
-            else:
-                print("Response was not OK: " + response.text)
-            
-            retries = retries - 1
-            
+            # Without a snapshot to pin it to, a removal that's sent again could apply to a newer version of the playlist
+            snapshot_id = self.__snapshot_id(self.__mutate_playlist_request('DELETE', playlist_id, json.dumps(body), idempotent=bool(snapshot_id)))
 
-    def __get_request(self, path, params = [], use_app_creds=False):
-        retries = 3
-
-        while retries > 0:
-            token = self.client_token.token
-            if use_app_creds:
-                token = self.app_token
-            response = requests.request(
-                'GET',
-                f"{self.API_ENDPOINT}{path}",
-                headers = {
-                    'Authorization': f"Bearer {token}",
-                    'Content-Type': 'application/json'
-                },
-                params = params
-            )
-
-            if (response.ok):
-                return response.text
-            else:
-                print("Response was not OK: " + response.text)
+        return snapshot_id
+        
+    def add_items_to_playlist(self, playlist_id, songs, position = 0):
+        """
+        Adds songs to a playlist, 100 at a time. Every chunk is inserted at an explicit position, so the songs end up in
+        the same order as `songs`.
 
-            retries = retries - 1
+        :return: The playlist's snapshot ID after the songs were added
+        """
+        snapshot_id = None
 
-    def __local_auth_flow(self):
-        self.app_token = self.__get_token()
+        for i, chunk in enumerate(self.__mutation_chunks(songs)):
+            snapshot_id = self.__snapshot_id(self.__mutate_playlist_request(
+                'POST',
+                playlist_id,
+                json.dumps({
+                    'uris': [song.uri for song in chunk],
+                    'position': position + i * self.MAX_ITEMS_PER_MUTATION
+                }),
+                # Spotify might have added the chunk before the request failed, and sending it again would add it twice
+                idempotent=False
+            ))
+
+        return snapshot_id
+
+    def replace_playlist_items(self, playlist_id, songs):
+        """
+        Replaces the whole contents of a playlist with `songs`. Up to 100 songs take a single request. Any beyond that
+        are appended in order afterwards.
 
-        self.client_token = self.cache.load_client_token()
+        :return: The playlist's snapshot ID after the replacement
+        """
+        first_chunk = songs[:self.MAX_ITEMS_PER_MUTATION]
 
-        if (not self.client_token):
-            print("Creds cache existed, but was not well formed")
-            self.client_token = self.__generate_and_save_new_creds()
-            self.cache.save_client_token(self.client_token)
-        elif (self.client_token.expires_at < datetime.now()):
-            self.client_token = self.__refresh_and_save_new_creds()
-            self.cache.save_client_token(self.client_token)
-        else:
-            print('Found valid cached creds. Using those')
+        snapshot_id = self.__snapshot_id(self.__mutate_playlist_request(
+            'PUT',
+            playlist_id,
+            json.dumps({
+                'uris': [song.uri for song in first_chunk]
+            })
+        ))
 
-    def __generate_and_save_new_creds(self):
-        print("Starting new auth process")
-        print("Please follow this link. Once you have, paste the redirect link back here:")
-        print(self.__generate_auth_link())
-        redirect_link = input("Redirect link:")
+        remaining_songs = songs[self.MAX_ITEMS_PER_MUTATION:]
 
-        code_matcher = r'http://localhost:8888/callback\?code=(.+?)(?:&.+|$)'
+        if len(remaining_songs) > 0:
+            snapshot_id = self.add_items_to_playlist(playlist_id, remaining_songs, len(first_chunk))
 
-        match = re.match(code_matcher, redirect_link)
+        return snapshot_id
 
-        if (not match.lastindex or match.lastindex < 1):
-            raise Exception(f"Invalid callback: {redirect_link}")
-        else:
-            print(f"Using code {match.group(1)}")
 
-        code = match.group(1)
+# ---------------- ---------------- ---------------------#
+# ----------------     private      ---------------------#
+# ---------------- ---------------- ---------------------#
 
-        auth_token_response = self.__request_user_auth_token(code)
+    def __iter_pages(self, path, params, first_page, page_size):
+        """
+        Yields the items in each page of a paginated listing, in order. If the first page tells us how many items there are,
+        the following pages are prefetched concurrently, a few at a time. Otherwise we follow the `next` links one by one.
+        Closing the generator early cancels any outstanding prefetches.
 
-        if ('access_token' not in auth_token_response):
-            raise Exception(f"Something went wrong while getting client creds. API response: {auth_token_response}")
+        :param path: The path that returns a single page of the listing, given `offset` and `limit`
+        :param first_page: The already-fetched first page of the listing
+        """
+        yield first_page['items']
+
+        total = first_page.get('total')
+
+        if total is None:
+            next_url = first_page.get('next')
+            while next_url:
+                page = json_backend.loads(self.__get_request(next_url[len(self.API_ENDPOINT):]))
+                yield page['items']
+                next_url = page.get('next')
+            return
+
+        offsets = deque(range(len(first_page['items']), total, page_size))
+        if len(offsets) == 0:
+            return
+
+        fetch_page = lambda offset: json_backend.loads(self.__get_request(
+            path,
+            params + [
+                ('offset', offset),
+                ('limit', page_size)
+            ]
+        ))['items']
 
-        return self.__client_token_from_auth_response(auth_token_response)
+        executor = ThreadPoolExecutor(max_workers=max(1, self.page_prefetch))
+        in_flight = deque()
 
-    def __refresh_and_save_new_creds(self):
-        print('No valid cached creds')
-        # Creds have expired, so get some new ones
-        response = self.__request_refreshed_user_auth_token()
+        try:
+            while len(offsets) > 0 or len(in_flight) > 0:
+                while len(offsets) > 0 and len(in_flight) < max(1, self.page_prefetch):
+                    in_flight.append(executor.submit(fetch_page, offsets.popleft()))
 
-        return self.__client_token_from_auth_response(response)
+                page = in_flight.popleft().result()
+                yield page
 
-    def __client_token_from_auth_response(self, response):
-        refresh_token = None
-        if (self.client_token):
-            refresh_token = self.client_token.refresh_token
-        if ('refresh_token' in response):
-            refresh_token = response['refresh_token']
+                # The listing can shrink while we're reading it
+                if len(page) == 0:
+                    return
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
 
-        expiry_delta = int(response['expires_in'])
+    def __mutation_chunks(self, songs):
+        return [songs[i:i + self.MAX_ITEMS_PER_MUTATION] for i in range(0, len(songs), self.MAX_ITEMS_PER_MUTATION)]
 
-        client_token = ClientToken(
-            response['access_token'],
-            refresh_token,
-            # Take 5 seconds off for safety
-            datetime.now() + timedelta(seconds=expiry_delta - 5)
-        )
+    def __snapshot_id(self, mutation_response):
+        return json_backend.loads(mutation_response)['snapshot_id']
 
-        return client_token
+    def __mutate_playlist_request(self, request_type, playlist_id, data, idempotent = True):
+        return self.__authorized_request(request_type, f"/playlists/{playlist_id}/tracks", data=data, idempotent=idempotent).text
 
-    def __generate_auth_link(self):
-        url = f"{self.ACCOUNTS_ENDPOINT}/authorize?" + '&'.join([
-                f"client_id={self.api_id}",
-                "response_type=code",
-                "redirect_uri=http://localhost:8888/callback",
-                "scope=playlist-read-private playlist-modify-private playlist-modify-public playlist-read-collaborative"
-                ])
-        return urllib.parse.quote_plus(url, safe=';/?:@&=+$,')
+    def __get_request(self, path, params = [], use_app_creds=False):
+        # The raw bytes are parsed directly, which skips decoding the whole response to a str first
+        return self.__authorized_request('GET', path, params=params, use_app_creds=use_app_creds).content
 
-    def __auth_token_request(self, additional_data):
+    def __authorized_request(self, method, path, params = None, data = None, use_app_creds = False, idempotent = True):
         """
-        :param additional_data: A list of key:value tuples that will be sent in the client auth token request
+        Sends an API request through the scheduler with a current token. If the token is turned down, it's refreshed and
+        the request is sent once more.
         """
-        return self.__validated_json_auth_response(
-            requests.request(
-                'POST',
-                f"{self.ACCOUNTS_ENDPOINT}/api/token",
+        token_kind = TokenManager.APP if use_app_creds else TokenManager.USER
+        token = self.token_manager.app_token() if use_app_creds else self.token_manager.user_token()
+
+        def send_once():
+            return self.transport.request(
+                method,
+                f"{self.API_ENDPOINT}{path}",
+                timeout = self.request_timeout,
                 headers = {
-                    'Content-Type': 'application/x-www-form-urlencoded'
+                    'Authorization': f"Bearer {token}",
+                    'Content-Type': 'application/json'
                 },
-                data = [
-                    ('client_id', self.api_id),
-                    ('client_secret', self.api_secret)
-                ] + additional_data
-            ).text
-        )
-
-    def __request_user_auth_token(self, user_auth_code):
-        return self.__auth_token_request([
-                ('grant_type', 'authorization_code'),
-                ('code', user_auth_code),
-                ('redirect_uri', 'http://localhost:8888/callback')
-            ])
-    
-    def __request_refreshed_user_auth_token(self):
-        return self.__auth_token_request([
-                ('grant_type', 'refresh_token'),
-                ('refresh_token', self.client_token.refresh_token)
-            ])
-
-    def __get_token(self):
-        return self.__auth_token_request([
-                ('grant_type', 'client_credentials')
-            ])
-
-    def __validated_json_auth_response(self, response):
-        """
-        Validates an auth response by checking whether it has an access token. Raises an exception if it doesn't
+                params = params,
+                data = data
+            )
 
-        :param response: The serialized response from the Spotify API
-        """
-        response_json = json.loads(response)
-        if 'access_token' not in response_json:
-            raise Exception(f"Something went wrong while fetching an API token. The response was: {response_json}")
-        return response_json
-
-    def __iso3166_mapping():
-        with open('./resources/country_mapping.json') as file:
-            return json.loads(''.join(file.readlines()))
\ No newline at end of file
+        description = f"{method} {path}"
+        endpoint = endpoint_name(method, path)
+
+        send = send_once
+        if self.hedger and method == 'GET':
+            send = lambda: self.hedger.send(endpoint, send_once)
+
+        try:
+            return self.scheduler.execute(send, description, idempotent, endpoint)
+        except RequestFailedException as e:
+            if e.status_code != self.UNAUTHORIZED:
+                raise
+
+        # Nothing was done with a request that was turned away at the door, so it's safe to send it again, even if it
+        # isn't idempotent
+        token = self.token_manager.token_rejected(token_kind, token)
+        return self.scheduler.execute(send, description, idempotent, endpoint)
+
+@functools.lru_cache(maxsize=None)
+def iso3166_mapping():
+    """
+    Loads the map of ISO 3166 country code: country name. It's only read from disk once per process.
+    """
+    with open(os.path.join(os.path.dirname(__file__), '..', 'resources', 'country_mapping.json')) as file:
+        return json.load(file)
@@ -0,0 +1,235 @@
+from global_playlist.cache_backend import CacheBackend
+from global_playlist.data_types import Playlist, ClientToken, Song
+from global_playlist.metrics import timed_cache_operation
+from global_playlist import json_backend
+from contextlib import contextmanager
+from datetime import datetime
+import sqlite3, threading
+
+class SQLiteCache(CacheBackend):
+    """
+    Keeps everything that `DDBCache` does in a single SQLite file, so that local runs and tests don't need AWS. The
+    tables mirror the DynamoDB ones, and timestamps are stored as seconds since the epoch, the same as they are there.
+
+    The database runs in WAL mode, so one process can read it while another writes to it. Within a process, a single
+    connection is shared by every thread, and each write is its own transaction.
+    """
+    SCHEMA_VERSION = 1
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS tokens (id TEXT PRIMARY KEY, token TEXT NOT NULL, refresh_token TEXT, expires_at REAL NOT NULL)',
+        # Keyed by country_id, since we keep one playlist per country. Countries that were searched without finding one
+        # are `missing`, and have no playlist.
+        'CREATE TABLE IF NOT EXISTS playlists (country_id TEXT PRIMARY KEY, id TEXT, name TEXT, owner TEXT, verified_at REAL NOT NULL, missing INTEGER NOT NULL DEFAULT 0)',
+        'CREATE INDEX IF NOT EXISTS playlists_by_id ON playlists (id)',
+        'CREATE TABLE IF NOT EXISTS playlist_tracks (id TEXT PRIMARY KEY, snapshot_id TEXT NOT NULL, tracks TEXT NOT NULL)',
+        # The history tables are clustered on their keys, so lookups by song or artist ID are a single index search
+        'CREATE TABLE IF NOT EXISTS song_history (id TEXT PRIMARY KEY, used_date TEXT NOT NULL, name TEXT, artists TEXT) WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS song_history_by_used_date ON song_history (used_date)',
+        'CREATE TABLE IF NOT EXISTS artist_history (id TEXT PRIMARY KEY, last_used REAL NOT NULL, name TEXT) WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS artist_history_by_last_used ON artist_history (last_used)',
+        'CREATE TABLE IF NOT EXISTS selection_queue (id TEXT PRIMARY KEY, selections TEXT NOT NULL)'
+    ]
+    # Older builds of SQLite allow at most 999 parameters in a query
+    MAX_QUERY_PARAMETERS = 500
+    # Milliseconds to wait for another process's write to finish before giving up
+    BUSY_TIMEOUT = 10000
+
+    def __init__(self, path):
+        """
+        :param path: The database file, which is created if it doesn't exist. ':memory:' keeps everything in memory.
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.RLock()
+
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode = WAL')
+            # WAL only needs a sync at checkpoints to stay consistent, rather than at every commit
+            self.connection.execute('PRAGMA synchronous = NORMAL')
+            self.connection.execute(f"PRAGMA busy_timeout = {self.BUSY_TIMEOUT}")
+
+            with self.__transaction() as cursor:
+                for statement in self.SCHEMA:
+                    cursor.execute(statement)
+                cursor.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    @timed_cache_operation
+    def load_app_config(self):
+        return dict(self.__query('SELECT key, value FROM config'))
+
+    @timed_cache_operation
+    def save_app_config(self, config):
+        with self.__transaction() as cursor:
+            cursor.executemany('INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)', config.items())
+
+    @timed_cache_operation
+    def load_client_token(self):
+        rows = self.__query('SELECT token, refresh_token, expires_at FROM tokens WHERE id = ?', (self.CLIENT_TOKEN_ID,))
+        if not rows:
+            return None
+
+        token, refresh_token, expires_at = rows[0]
+        return ClientToken(token, refresh_token, datetime.fromtimestamp(expires_at))
+
+    @timed_cache_operation
+    def save_client_token(self, token):
+        with self.__transaction() as cursor:
+            cursor.execute(
+                'INSERT OR REPLACE INTO tokens (id, token, refresh_token, expires_at) VALUES (?, ?, ?, ?)',
+                (self.CLIENT_TOKEN_ID, token.token, token.refresh_token, token.expires_at.timestamp())
+            )
+
+    @timed_cache_operation
+    def load_playlist_discovery(self):
+        playlists = []
+        missing_playlists = {}
+
+        for country_id, id, name, owner, verified_at, missing in self.__query('SELECT country_id, id, name, owner, verified_at, missing FROM playlists'):
+            if missing:
+                missing_playlists[country_id] = datetime.fromtimestamp(verified_at)
+            else:
+                playlists.append(Playlist(id, name, owner, country_id, datetime.fromtimestamp(verified_at)))
+
+        return playlists, missing_playlists
+
+    @timed_cache_operation
+    def save_playlists(self, playlists):
+        with self.__transaction() as cursor:
+            cursor.executemany(
+                'INSERT OR REPLACE INTO playlists (country_id, id, name, owner, verified_at, missing) VALUES (?, ?, ?, ?, ?, 0)',
+                [
+                    (playlist.country_id, playlist.id, playlist.name, playlist.owner, (playlist.verified_at or datetime.now()).timestamp())
+                    for playlist in playlists
+                ]
+            )
+
+    @timed_cache_operation
+    def save_missing_playlists(self, country_ids, verified_at):
+        with self.__transaction() as cursor:
+            cursor.executemany(
+                'INSERT OR REPLACE INTO playlists (country_id, verified_at, missing) VALUES (?, ?, 1)',
+                [(country_id, verified_at.timestamp()) for country_id in country_ids]
+            )
+
+    @timed_cache_operation
+    def delete_playlists(self, country_ids):
+        with self.__transaction() as cursor:
+            cursor.executemany('DELETE FROM playlists WHERE country_id = ?', [(country_id,) for country_id in country_ids])
+
+    @timed_cache_operation
+    def load_playlist_tracks(self, playlist_id):
+        rows = self.__query('SELECT snapshot_id, tracks FROM playlist_tracks WHERE id = ?', (playlist_id,))
+        if not rows:
+            return None
+
+        snapshot_id, tracks = rows[0]
+        return snapshot_id, [Song.from_dict(track) for track in json_backend.loads(tracks)]
+
+    @timed_cache_operation
+    def save_playlist_tracks(self, playlist_id, snapshot_id, songs):
+        with self.__transaction() as cursor:
+            cursor.execute(
+                'INSERT OR REPLACE INTO playlist_tracks (id, snapshot_id, tracks) VALUES (?, ?, ?)',
+                (playlist_id, snapshot_id, json_backend.dumps([song.dict() for song in songs]))
+            )
+
+    def iter_used_songs(self):
+        # The rows are all read up front, since the connection is shared with other threads
+        return (song_id for song_id, in self.__query('SELECT id FROM song_history'))
+
+    @timed_cache_operation
+    def load_used_song_filter(self):
+        """
+        Reading every song ID straight off the history's index is cheap here, so this is an exact set rather than a
+        `BloomFilter`, and never rejects a song that hasn't been used.
+        """
+        return set(self.iter_used_songs())
+
+    @timed_cache_operation
+    def add_used_songs(self, songs):
+        """
+        Saves the songs and their artists in a single transaction, so the song and artist history never disagree
+        """
+        iso_date_string = datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+        used_at = datetime.now()
+        artists = dict((artist_id, artist_name) for song in songs for artist_id, artist_name in zip(song.artist_ids, song.artist_names))
+
+        with self.__transaction() as cursor:
+            cursor.executemany(
+                'INSERT OR REPLACE INTO song_history (id, used_date, name, artists) VALUES (?, ?, ?, ?)',
+                [(song.id, iso_date_string, song.name, ','.join(song.artist_names)) for song in songs]
+            )
+            cursor.executemany(
+                'INSERT OR REPLACE INTO artist_history (id, last_used, name) VALUES (?, ?, ?)',
+                [(artist_id, used_at.timestamp(), artist_name) for artist_id, artist_name in artists.items()]
+            )
+            # This stands in for the TTL that cleans up the DynamoDB table
+            cursor.execute('DELETE FROM artist_history WHERE last_used < ?', ((used_at - self.ARTIST_HISTORY_RETENTION).timestamp(),))
+
+    @timed_cache_operation
+    def load_recent_artists(self, artist_ids, since):
+        artist_ids = list(set(artist_ids))
+        recent_artist_ids = set()
+
+        for i in range(0, len(artist_ids), self.MAX_QUERY_PARAMETERS):
+            batch = artist_ids[i:i + self.MAX_QUERY_PARAMETERS]
+            recent_artist_ids.update(artist_id for artist_id, in self.__query(
+                f"SELECT id FROM artist_history WHERE id IN ({','.join('?' * len(batch))}) AND last_used >= ?",
+                batch + [since.timestamp()]
+            ))
+
+        return recent_artist_ids
+
+    @timed_cache_operation
+    def load_queued_selections(self, queue_name):
+        rows = self.__query('SELECT selections FROM selection_queue WHERE id = ?', (queue_name,))
+        return self.__selections_from_json(rows[0][0]) if rows else []
+
+    def update_queued_selections(self, queue_name, update):
+        # Reading and writing in one transaction stands in for the versioned, conditional put that DDBCache needs
+        with self.__transaction() as cursor:
+            rows = cursor.execute('SELECT selections FROM selection_queue WHERE id = ?', (queue_name,)).fetchall()
+            selections = self.__selections_from_json(rows[0][0]) if rows else []
+            updated_selections = update(selections)
+
+            # `update` hands back the same list when there's nothing to change
+            if updated_selections is selections:
+                return
+
+            cursor.execute(
+                'INSERT OR REPLACE INTO selection_queue (id, selections) VALUES (?, ?)',
+                (queue_name, json_backend.dumps([[song.dict() for song in songs] for songs in updated_selections]))
+            )
+
+# ---------------- ---------------- ---------------------#
+# ----------------     private      ---------------------#
+# ---------------- ---------------- ---------------------#
+
+    @contextmanager
+    def __transaction(self):
+        """
+        Runs the block's writes as one transaction, which is committed if the block finishes and rolled back if it
+        raises. The write lock is taken up front, so the block's reads see nothing that changes before it commits.
+        """
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+
+    def __query(self, sql, parameters = ()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def __selections_from_json(self, serialized_selections):
+        return [[Song.from_dict(track) for track in selection] for selection in json_backend.loads(serialized_selections)]
+
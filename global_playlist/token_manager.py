@@ -0,0 +1,228 @@
+import re, threading, time, urllib.parse
+from datetime import datetime, timedelta
+from global_playlist.data_types import ClientToken
+from global_playlist import json_backend
+from global_playlist.http_transport import shared_transport, wire_bytes
+from global_playlist.metrics import current_metrics
+
+class TokenManager:
+    """
+    Looks after both of the tokens that the client uses: the user's token, which is stored in DDB, and the app's own
+    (client credentials) token, which is only kept in memory. A manager is meant to live for as long as the Lambda
+    container does, so warm invocations reuse its tokens without going back to DDB or the accounts API.
+
+    Tokens are refreshed in the background once they're within `refresh_margin` of expiring, while the current one is
+    still handed out. Only a token that's about to expire is refreshed while the caller waits.
+    """
+    ACCOUNTS_ENDPOINT = 'https://accounts.spotify.com'
+
+    USER = 'user'
+    APP = 'app'
+
+    def __init__(self, api_id, api_secret, cache, transport = None, refresh_margin = timedelta(minutes=5), expiry_margin = timedelta(seconds=30), clock = datetime.now):
+        """
+        :param transport: The `HttpTransport` that token requests are sent through. Defaults to the process-wide one.
+        :param refresh_margin: How long before a token expires that it starts being refreshed in the background
+        :param expiry_margin: How long before a token expires that it's no longer handed out. Requests wait for a new
+            one instead.
+        """
+        self.api_id = api_id
+        self.api_secret = api_secret
+        self.cache = cache
+        self.transport = transport or shared_transport()
+        self.refresh_margin = refresh_margin
+        self.expiry_margin = expiry_margin
+        self.clock = clock
+        # USER / APP: ClientToken
+        self.tokens = {}
+        # The user token that's in DDB, as far as we know, so that it's only written when it changes
+        self.__saved_user_token = None
+        # The kinds of token that are being refreshed in the background
+        self.__refreshing = set()
+        # Guards `tokens` and `__refreshing`, and is only ever held briefly
+        self.lock = threading.Lock()
+        # Held for the whole of a refresh, so that only one runs at a time
+        self.refresh_lock = threading.Lock()
+
+    def user_token(self):
+        """
+        :return: The user's access token
+        """
+        return self.__current(self.USER).token
+
+    def app_token(self):
+        """
+        :return: The app's own access token. It's only fetched the first time it's needed, since most runs never use it.
+        """
+        return self.__current(self.APP).token
+
+    def token_rejected(self, kind, rejected_token):
+        """
+        Called when the API turns a token down (a 401), which happens when it's been revoked or expired early. The token
+        is refreshed, unless another request has already done that since `rejected_token` was handed out.
+
+        :param kind: `USER` or `APP`
+        :return: The access token to retry with
+        """
+        print(f"The {kind} token was rejected")
+        return self.__refresh_if(kind, lambda token: token is None or token.token == rejected_token).token
+
+# ---------------- ---------------- ---------------------#
+# ----------------     private      ---------------------#
+# ---------------- ---------------- ---------------------#
+
+    def __current(self, kind):
+        with self.lock:
+            token = self.tokens.get(kind)
+
+        if token is None or self.__expiring(token, self.expiry_margin):
+            return self.__refresh_if(kind, lambda token: token is None or self.__expiring(token, self.expiry_margin))
+
+        if self.__expiring(token, self.refresh_margin):
+            with self.lock:
+                start_refresh = kind not in self.__refreshing
+                self.__refreshing.add(kind)
+            if start_refresh:
+                threading.Thread(target=self.__background_refresh, args=(kind,), daemon=True).start()
+
+        return token
+
+    def __background_refresh(self, kind):
+        try:
+            # A request that couldn't wait might have got there first
+            self.__refresh_if(kind, lambda token: token is None or self.__expiring(token, self.refresh_margin))
+        except Exception as e:
+            # The next request refreshes it in the foreground if it has to
+            print(f"Couldn't refresh the {kind} token in the background: {e}")
+        finally:
+            with self.lock:
+                self.__refreshing.discard(kind)
+
+    def __expiring(self, token, margin):
+        return token.expires_at - self.clock() <= margin
+
+    def __refresh_if(self, kind, needs_refresh):
+        """
+        Refreshes the token if `needs_refresh` says it has to be, once any refresh that's already going has finished.
+        Only one refresh runs at a time, so a burst of requests for an expired token only refreshes it once.
+        """
+        with self.refresh_lock:
+            with self.lock:
+                token = self.tokens.get(kind)
+
+            if not needs_refresh(token):
+                return token
+
+            token = self.__new_app_token() if kind == self.APP else self.__new_user_token(token)
+
+            with self.lock:
+                self.tokens[kind] = token
+            return token
+
+    def __new_app_token(self):
+        return self.__client_token_from_auth_response(self.__auth_token_request([
+            ('grant_type', 'client_credentials')
+        ]), None)
+
+    def __new_user_token(self, current_token):
+        # The token in DDB is used if it's newer than ours, e.g. on a cold start or when another container has
+        # already refreshed it
+        stored_token = self.cache.load_client_token()
+        if stored_token and (current_token is None or stored_token.token != current_token.token):
+            self.__saved_user_token = stored_token.token
+            if not self.__expiring(stored_token, self.expiry_margin if current_token is None else self.refresh_margin):
+                print('Found valid cached creds. Using those')
+                return stored_token
+            current_token = current_token or stored_token
+
+        if not current_token or not current_token.refresh_token:
+            print("Creds cache existed, but was not well formed")
+            token = self.__generate_user_token()
+        else:
+            print('Refreshing the user creds')
+            token = self.__client_token_from_auth_response(self.__auth_token_request([
+                ('grant_type', 'refresh_token'),
+                ('refresh_token', current_token.refresh_token)
+            ]), current_token.refresh_token)
+
+        self.__save_user_token(token)
+        return token
+
+    def __save_user_token(self, token):
+        if token.token != self.__saved_user_token:
+            self.cache.save_client_token(token)
+            self.__saved_user_token = token.token
+
+    def __generate_user_token(self):
+        print("Starting new auth process")
+        print("Please follow this link. Once you have, paste the redirect link back here:")
+        print(self.__generate_auth_link())
+        redirect_link = input("Redirect link:")
+
+        code_matcher = r'http://localhost:8888/callback\?code=(.+?)(?:&.+|$)'
+
+        match = re.match(code_matcher, redirect_link)
+
+        if (not match or not match.lastindex or match.lastindex < 1):
+            raise Exception(f"Invalid callback: {redirect_link}")
+        else:
+            print(f"Using code {match.group(1)}")
+
+        auth_token_response = self.__auth_token_request([
+                ('grant_type', 'authorization_code'),
+                ('code', match.group(1)),
+                ('redirect_uri', 'http://localhost:8888/callback')
+            ])
+
+        return self.__client_token_from_auth_response(auth_token_response, None)
+
+    def __client_token_from_auth_response(self, response, refresh_token):
+        expiry_delta = int(response['expires_in'])
+
+        return ClientToken(
+            response['access_token'],
+            # Spotify only sends a new refresh token sometimes. Otherwise the old one is still good.
+            response.get('refresh_token', refresh_token),
+            # Take 5 seconds off for safety
+            self.clock() + timedelta(seconds=expiry_delta - 5)
+        )
+
+    def __generate_auth_link(self):
+        url = f"{self.ACCOUNTS_ENDPOINT}/authorize?" + '&'.join([
+                f"client_id={self.api_id}",
+                "response_type=code",
+                "redirect_uri=http://localhost:8888/callback",
+                "scope=playlist-read-private playlist-modify-private playlist-modify-public playlist-read-collaborative"
+                ])
+        return urllib.parse.quote_plus(url, safe=';/?:@&=+$,')
+
+    def __auth_token_request(self, additional_data):
+        """
+        :param additional_data: A list of key:value tuples that will be sent in the client auth token request
+        """
+        started = time.perf_counter()
+        response = self.transport.request(
+            'POST',
+            f"{self.ACCOUNTS_ENDPOINT}/api/token",
+            headers = {
+                'Content-Type': 'application/x-www-form-urlencoded'
+            },
+            data = [
+                ('client_id', self.api_id),
+                ('client_secret', self.api_secret)
+            ] + additional_data
+        )
+        current_metrics().record_request('POST /api/token', time.perf_counter() - started, response.status_code, 0, len(response.content or b''), wire_bytes(response))
+
+        return self.__validated_json_auth_response(response.text)
+
+    def __validated_json_auth_response(self, response):
+        """
+        Validates an auth response by checking whether it has an access token. Raises an exception if it doesn't
+
+        :param response: The serialized response from the Spotify API
+        """
+        response_json = json_backend.loads(response)
+        if 'access_token' not in response_json:
+            raise Exception(f"Something went wrong while fetching an API token. The response was: {response_json}")
+        return response_json
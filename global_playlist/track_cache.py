@@ -0,0 +1,54 @@
+import threading
+
+class TrackListingCache:
+    """
+    Caches the songs in playlists, keyed by the playlist's snapshot ID. Spotify gives a playlist a new snapshot ID
+    whenever its contents change, so a cached listing is good for exactly as long as its snapshot ID matches.
+
+    Listings are kept in memory, and optionally persisted to a backing store (e.g. `DDBCache`) that provides
+    `load_playlist_tracks` and `save_playlist_tracks`.
+    """
+    def __init__(self, backing_cache = None):
+        self.backing_cache = backing_cache
+        # playlist ID: (snapshot ID, songs)
+        self.listings = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, playlist_id, snapshot_id):
+        """
+        :return: The cached songs for the given snapshot of the playlist, or None if we don't have them
+        """
+        with self.lock:
+            listing = self.listings.get(playlist_id)
+
+        if (not listing or listing[0] != snapshot_id) and self.backing_cache:
+            listing = self.backing_cache.load_playlist_tracks(playlist_id)
+            if listing:
+                with self.lock:
+                    self.listings[playlist_id] = listing
+
+        with self.lock:
+            if listing and listing[0] == snapshot_id:
+                self.hits += 1
+                return listing[1]
+
+            self.misses += 1
+            return None
+
+    def put(self, playlist_id, snapshot_id, songs):
+        with self.lock:
+            self.listings[playlist_id] = (snapshot_id, songs)
+
+        if self.backing_cache:
+            self.backing_cache.save_playlist_tracks(playlist_id, snapshot_id, songs)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0
+            }
@@ -0,0 +1,45 @@
+import threading, time
+
+class WarmState:
+    """
+    Holds values that should outlive a single invocation. Lambda reuses containers between invocations, so anything
+    kept at the module level (clients, tokens, config, discovered playlists) can be picked up again by the next warm
+    invocation instead of being rebuilt. Each value has its own TTL, after which it's loaded again.
+    """
+    def __init__(self, clock = time.monotonic):
+        # name: (value, expires_at). An expiry of None means the value never expires.
+        self.entries = {}
+        self.clock = clock
+        self.lock = threading.Lock()
+
+    def get(self, name, ttl, load, is_valid = None):
+        """
+        Returns the stored value for `name`, or loads and stores a new one if there isn't one, it's expired, or it
+        fails the `is_valid` check.
+
+        :param ttl: Seconds that a newly loaded value is good for. None means forever.
+        :param load: A function that loads the value
+        :param is_valid: An optional function that takes the stored value and says whether it can still be used
+        """
+        with self.lock:
+            entry = self.entries.get(name)
+
+        if entry and (entry[1] is None or self.clock() < entry[1]) and (is_valid is None or is_valid(entry[0])):
+            return entry[0]
+
+        value = load()
+
+        with self.lock:
+            self.entries[name] = (value, None if ttl is None else self.clock() + ttl)
+
+        return value
+
+    def invalidate(self, name = None):
+        """
+        Drops the value for `name`, or every value if no name is given
+        """
+        with self.lock:
+            if name is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(name, None)
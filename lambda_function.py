@@ -1,32 +1,328 @@
 from global_playlist.spotify_client import SpotifyClient
+from global_playlist.token_manager import TokenManager
+from global_playlist.deadline import Deadline, reset_deadline
+from global_playlist.hedging import RequestHedger
+from global_playlist.request_scheduler import shared_scheduler
 from global_playlist.song_provider import SongProvider
 from global_playlist.playlist_manager import PlaylistManager
-import boto3
-from global_playlist.data_types import ConfigKeys
+from global_playlist.data_types import ConfigKeys, PlaylistTarget
 from global_playlist.cache import DDBCache
+from global_playlist.cache_layer import CacheLayer
+from global_playlist.track_cache import TrackListingCache
+from global_playlist.metrics import current_metrics, reset_metrics
+from global_playlist.profiling import maybe_profile
+from global_playlist.warm_state import WarmState
+from global_playlist.catalog_snapshot import load_catalog_snapshot, upload_catalog_snapshot
+import argparse, json, os, time
 
 GLOBAL_PLAYLIST_NAME = "A beta trip around the world"
 
+# How long things can be reused across warm invocations, in seconds. Cached backend reads have their own TTLs in
+# `CacheLayer`.
+CLIENT_TTL = 60 * 60
+COUNTRIES_TTL = 24 * 60 * 60
+SNAPSHOT_TTL = 24 * 60 * 60
+
+# Where to find a catalog snapshot: a path (e.g. one packaged next to this file) or an s3://bucket/key URL
+SNAPSHOT_ENV_VAR = 'GLOBAL_PLAYLIST_SNAPSHOT'
+# Where the cache lives: 'ddb' (the default) for DynamoDB, or 'sqlite:<path>' for a local SQLite file
+CACHE_ENV_VAR = 'GLOBAL_PLAYLIST_CACHE'
+# Turns on hedged GETs. A GET that's slower than this percentile of its endpoint's latencies is sent a second time.
+HEDGE_PERCENTILE_ENV_VAR = 'GLOBAL_PLAYLIST_HEDGE_PERCENTILE'
+# Seconds before Lambda's timeout that requests stop being sent, which leaves time to log metrics
+DEADLINE_RESERVE = 5
+
+# This lives for as long as the Lambda container does, so warm invocations can pick up where the last one left off
+_warm_state = WarmState()
+
 def lambda_handler(event, context):
-    cache = DDBCache(boto3.resource('dynamodb'))
+    invocation_id = getattr(context, 'aws_request_id', None) or str(int(time.time()))
+    metrics = reset_metrics()
+    reset_deadline(Deadline.from_lambda_context(context, DEADLINE_RESERVE))
+
+    with maybe_profile(invocation_id):
+        try:
+            cache = _warm_state.get('cache', None, _new_cache)
+            update_global_playlist(cache, event, _warm_state)
+        finally:
+            metrics.emit(invocation_id)
+
+def update_global_playlist(cache, event, warm_state = None):
+    """
+    Does all of the actual work of an invocation against the given cache. It's split out from `lambda_handler` so that
+    it can be run against other caches (e.g. in the benchmarks).
+
+    :param cache: A `CacheLayer`
+    :param warm_state: The `WarmState` to reuse clients and market lists from. Nothing is reused if it isn't given.
+    """
+    warm_state = warm_state or WarmState()
+    metrics = current_metrics()
+
+    refresh_country_ids = _apply_invalidations(event, cache, warm_state)
 
-    config = cache.load_app_config()
+    with metrics.phase('config'):
+        config = cache.load_app_config()
 
     if not (ConfigKeys.APP_ID in config and ConfigKeys.APP_SECRET in config):
+        cache.invalidate(CacheLayer.CONFIG)
         raise Exception(f"The app credentials are not configured correctly. \
             Set the {ConfigKeys.APP_ID} and {ConfigKeys.APP_SECRET} keys")
 
-    client = SpotifyClient(config[ConfigKeys.APP_ID], config[ConfigKeys.APP_SECRET], cache)
-    song_provider = SongProvider(client, client.get_countries(), cache)
+    with metrics.phase('auth'):
+        track_cache = warm_state.get('track_cache', None, lambda: TrackListingCache(cache))
+        # The token manager refreshes its own tokens before they expire, so it never has to be thrown away
+        token_manager = warm_state.get('token_manager', None, lambda: TokenManager(config[ConfigKeys.APP_ID], config[ConfigKeys.APP_SECRET], cache))
+        # The latency histograms that hedging goes by build up over warm invocations
+        hedger = warm_state.get('hedger', None, _hedger_from_env)
+        client = warm_state.get(
+            'client',
+            CLIENT_TTL,
+            lambda: SpotifyClient(config[ConfigKeys.APP_ID], config[ConfigKeys.APP_SECRET], cache, track_cache=track_cache, token_manager=token_manager, hedger=hedger)
+        )
+
+    if _uses_selection_queue(event) and _update_from_selection_queue(cache, client, (event or {}).get('song_count')):
+        _print_client_stats(track_cache, hedger)
+        return
+
+    with metrics.phase('discovery'):
+        countries = warm_state.get('countries', COUNTRIES_TTL, client.get_countries)
+
+        if event and event.get('export_snapshot'):
+            # The export should reflect what's out there now, not what an earlier snapshot saw
+            song_provider = SongProvider(client, countries, cache, refresh_country_ids=refresh_country_ids)
+            _export_catalog_snapshot(song_provider, event['export_snapshot'], warm_state)
+            return
+
+        catalog_snapshot = warm_state.get('catalog_snapshot', SNAPSHOT_TTL, lambda: load_catalog_snapshot(os.environ.get(SNAPSHOT_ENV_VAR)))
+        song_provider = SongProvider(client, countries, cache, refresh_country_ids=refresh_country_ids, catalog_snapshot=catalog_snapshot)
+
+    if event and event.get('pregenerate'):
+        _pregenerate_selections(cache, song_provider, int(event['pregenerate']), event.get('song_count', 2))
+    elif event and event.get('targets'):
+        _update_target_playlists(cache, song_provider, client, [PlaylistTarget.from_dict(target) for target in event['targets']])
+    else:
+        _update_single_playlist(cache, event, song_provider, client)
+
+    _print_client_stats(track_cache, hedger)
+
+def _print_client_stats(track_cache, hedger):
+    print(f"Playlist track cache: {track_cache.stats()}")
+    if hedger:
+        print(f"Request hedging: {hedger.stats()}")
+
+def _hedger_from_env():
+    percentile = os.environ.get(HEDGE_PERCENTILE_ENV_VAR)
+    if not percentile:
+        return None
+    # Hedges count against the same rate budget as every other request
+    return RequestHedger(float(percentile), before_hedge=shared_scheduler().bucket.acquire)
+
+def _update_single_playlist(cache, event, song_provider, client):
+    metrics = current_metrics()
     playlist_manager = PlaylistManager(client, GLOBAL_PLAYLIST_NAME)
 
-    songs = song_provider.get_random_global_songs(2)
+    with metrics.phase('selection'):
+        if event and 'language_quotas' in event:
+            songs = song_provider.get_language_balanced_songs(
+                event.get('song_count', 2),
+                event['language_quotas'],
+                event.get('default_language_quota')
+            )
+        else:
+            songs = song_provider.get_random_global_songs((event or {}).get('song_count', 2))
+
+    with metrics.phase('playlist_mutation'):
+        playlist_manager.create_global_playlist(songs)    
+
+    with metrics.phase('history_write'):
+        # We only do this here because we don't want to add them earlier and have the playlist update fail.
+        # That could leave us rejecting songs that we haven't _actually_ had in a playlist yet.
+        cache.add_used_songs(songs)
+
+def _uses_selection_queue(event):
+    # Anything that asks for specific songs or playlists skips the queue, and so does invalidation, since the countries
+    # that it drops have to be searched for again
+    return not any((event or {}).get(key) for key in ['targets', 'language_quotas', 'export_snapshot', 'pregenerate', 'invalidate'])
+
+def _update_from_selection_queue(cache, client, song_count = None):
+    """
+    Updates the global playlist with the oldest queued selection, which skips discovery and song selection entirely
+    :param song_count: Only selections of this many songs are used, if it's given. Others are left in the queue.
+    :return: Whether there was a usable selection in the queue
+    """
+    metrics = current_metrics()
+
+    with metrics.phase('selection'):
+        queued_selections = cache.load_queued_selections(GLOBAL_PLAYLIST_NAME)
+        if len(queued_selections) == 0:
+            print("No queued selections. Choosing songs now.")
+            return False
+
+        # The history might have moved on since the selections were made, e.g. if there was a run with other songs
+        rejection_filter = cache.load_used_song_filter()
+        stale_selections = []
+        songs = None
+
+        for queued_songs in queued_selections:
+            if song_count is not None and len(queued_songs) != song_count:
+                continue
+            if all(song.id not in rejection_filter for song in queued_songs):
+                songs = queued_songs
+                break
+            stale_selections.append(queued_songs)
+
+        for stale_songs in stale_selections:
+            cache.remove_queued_selection(GLOBAL_PLAYLIST_NAME, stale_songs)
+
+        if songs is None:
+            print(f"None of the {len(queued_selections)} queued selections can be used. Choosing songs now.")
+            return False
+
+        print(f"Using a queued selection. {len(queued_selections) - len(stale_selections) - 1} more are queued.")
+
+    with metrics.phase('playlist_mutation'):
+        PlaylistManager(client, GLOBAL_PLAYLIST_NAME).create_global_playlist(songs)
+
+    with metrics.phase('history_write'):
+        # Same as for a fresh selection, it only counts as used once the playlist has been updated
+        cache.add_used_songs(songs)
+        cache.remove_queued_selection(GLOBAL_PLAYLIST_NAME, songs)
 
-    playlist_manager.create_global_playlist(songs)    
+    return True
 
-    # We only do this here because we don't want to add them earlier and have the playlist update fail.
-    # That could leave us rejecting songs that we haven't _actually_ had in a playlist yet.
-    cache.add_used_songs(songs)
+def _pregenerate_selections(cache, song_provider, selection_count, song_count):
+    """
+    Handles the event's `pregenerate` field, which is the number of future runs to choose songs for, e.g.
+        {"pregenerate": 30}
+    The selections are added to the end of the global playlist's queue, which later runs take them from.
+    """
+    metrics = current_metrics()
+
+    with metrics.phase('selection'):
+        queued_selections = cache.load_queued_selections(GLOBAL_PLAYLIST_NAME)
+        selections = song_provider.get_random_global_song_batch(selection_count, song_count, queued_selections)
+        # The catalog can run out, and there's no point queueing a run that doesn't have any songs
+        selections = [songs for songs in selections if len(songs) > 0]
+
+    with metrics.phase('queue_write'):
+        cache.add_queued_selections(GLOBAL_PLAYLIST_NAME, selections)
+
+    print(f"Queued {len(selections)} selections. {len(queued_selections) + len(selections)} are queued now.")
+
+def _update_target_playlists(cache, song_provider, client, targets):
+    """
+    Builds every playlist in the event's `targets` from a single fetch of the regional playlists, e.g.
+        [{"name": "Around the world", "size": 30}, {"name": "Nordic mix", "size": 10, "countries": ["SE", "NO", "DK"]}]
+    """
+    metrics = current_metrics()
+    playlist_manager = PlaylistManager(client)
+
+    with metrics.phase('selection'):
+        targets_and_songs = song_provider.get_songs_for_targets(targets)
+
+    for target, songs in targets_and_songs:
+        print(f"Chose {len(songs)} songs for {target}")
+
+    with metrics.phase('playlist_mutation'):
+        playlist_manager.create_playlists(targets_and_songs)
+
+    with metrics.phase('history_write'):
+        # Same as for a single playlist, but only once every playlist has been updated
+        cache.add_used_songs([song for _, songs in targets_and_songs for song in songs])
+
+def _export_catalog_snapshot(song_provider, location, warm_state):
+    """
+    Handles the event's `export_snapshot` field, which is where to write the snapshot to: a path, an s3://bucket/key
+    URL, or `true` for wherever the snapshot env var points
+    """
+    if location is True:
+        location = os.environ.get(SNAPSHOT_ENV_VAR)
+        if not location:
+            raise Exception(f"Can't export a catalog snapshot. No location was given and {SNAPSHOT_ENV_VAR} isn't set.")
+
+    local_path = os.path.join('/tmp', os.path.basename(location)) if location.startswith('s3://') else location
+
+    with current_metrics().phase('snapshot_export'):
+        song_provider.export_catalog_snapshot(local_path)
+        upload_catalog_snapshot(local_path, location)
+
+    # The next run should pick up the new snapshot
+    warm_state.invalidate('catalog_snapshot')
+
+def _apply_invalidations(event, cache, warm_state):
+    """
+    Handles the event's `invalidate` field, which is either "all" or a list like:
+        [{"table": "playlists", "keys": ["SE", "NO"]}, {"table": "config"}]
+
+    Invalidating the playlists of specific countries also deletes them from the cache backend, so that they're searched
+    for again. Everything else only drops what's cached in memory.
+
+    :return: The IDs of the countries whose playlists should be searched for again
+    """
+    invalidations = (event or {}).get('invalidate')
+
+    if not invalidations:
+        return []
+
+    if invalidations == 'all':
+        print("Invalidating everything that's cached in memory")
+        cache.invalidate()
+        for name in ['token_manager', 'hedger', 'client', 'countries', 'track_cache', 'catalog_snapshot']:
+            warm_state.invalidate(name)
+        return []
+
+    refresh_country_ids = []
+
+    for invalidation in invalidations:
+        table = invalidation['table']
+        keys = invalidation.get('keys') or []
+        print(f"Invalidating {table} {keys if len(keys) > 0 else ''}")
+
+        for key in keys or [None]:
+            cache.invalidate(table, key)
+
+        if table == CacheLayer.TOKENS:
+            # The token manager holds onto its own copy of the tokens, and the client holds onto the token manager
+            warm_state.invalidate('token_manager')
+            warm_state.invalidate('client')
+        elif table == CacheLayer.PLAYLISTS and len(keys) > 0:
+            cache.delete_playlists(keys)
+            refresh_country_ids.extend(keys)
+
+    return refresh_country_ids
+
+def _new_cache():
+    return CacheLayer(_cache_backend(os.environ.get(CACHE_ENV_VAR)))
+
+def _cache_backend(location):
+    """
+    :param location: 'ddb', or 'sqlite:<path>'. Defaults to 'ddb'.
+    :return: A `CacheBackend` for the location
+    """
+    if not location or location == 'ddb':
+        return DDBCache(_ddb_resource())
+    if location.startswith('sqlite:'):
+        # Like boto3, sqlite3 is only imported when it's used, which it never is on Lambda
+        from global_playlist.sqlite_cache import SQLiteCache
+        return SQLiteCache(location[len('sqlite:'):])
+    raise Exception(f"Unknown cache location '{location}'. Expected 'ddb' or 'sqlite:<path>'.")
+
+def _ddb_resource():
+    # boto3 is slow to import, so it's only imported when the first cold invocation needs it
+    import boto3
+    return boto3.resource('dynamodb')
 
 if __name__ == "__main__":
-    lambda_handler(None, None)
+    parser = argparse.ArgumentParser(description='Runs the lambda locally')
+    parser.add_argument('--cache', help=f"Where the cache lives: 'ddb' or 'sqlite:<path>'. Overrides {CACHE_ENV_VAR}.")
+    parser.add_argument('--set-config', action='append', default=[], metavar='KEY=VALUE', help='Save a config value (e.g. app_id=...) to the cache before running')
+    parser.add_argument('--event', help='The event to run with, as JSON')
+    args = parser.parse_args()
+
+    if args.cache:
+        os.environ[CACHE_ENV_VAR] = args.cache
+    if args.set_config:
+        cache = _warm_state.get('cache', None, _new_cache)
+        cache.save_app_config(dict(item.split('=', 1) for item in args.set_config))
+
+    lambda_handler(json.loads(args.event) if args.event else None, None)